@@ -0,0 +1,84 @@
+#
+# Depends
+# Copyright (C) 2014 by Andrew Gardner & Jonas Unger.  All rights reserved.
+# BSD license (LICENSE.txt for details).
+#
+
+import os
+import gc
+import sys
+import copy
+import resource
+
+
+"""
+Measures the memory footprint of node properties and DataPackets: the size of
+a single instance (object plus instance dict, if any) and the peak RSS growth
+from creating many of each.  Run it against the deplish package of this tree,
+or of any other checkout to compare, for instance the one before __slots__
+were added in 4e42028:
+
+    git worktree add /tmp/depends_before 4e42028~1
+    python bench/slots_footprint.py /tmp/depends_before/deplish
+    python bench/slots_footprint.py
+
+Each run should use a fresh interpreter, as peak RSS never goes down.
+
+Only the DataPacket base class is measured.  Plugin DataPackets that don't
+declare __slots__ of their own still get an instance dict, so __slots__ on
+the base class saves them nothing.
+"""
+
+
+###########################################################################
+###########################################################################
+INSTANCE_COUNT = 100000
+
+
+def peakRss():
+    """
+    Return the peak resident set size of the process in kilobytes (Linux).
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def instanceSize(obj):
+    """
+    Return the size of an object plus its instance dict, if it has one.
+    """
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def main(packageDirectory):
+    """
+    Print the footprint of the node and data_packet modules found in the
+    given package directory.
+    """
+    sys.path.insert(0, os.path.abspath(packageDirectory))
+    import node
+    import data_packet
+
+    gc.collect()
+    rssBefore = peakRss()
+    attributes = [node.DagNodeAttribute('a%d' % (i % 10), '', False, None, None) for i in range(INSTANCE_COUNT)]
+    inputs = [node.DagNodeInput('i', data_packet.DataPacket, True) for i in range(INSTANCE_COUNT)]
+    dataPackets = [data_packet.DataPacket(None, 'o') for i in range(INSTANCE_COUNT)]
+    rssAfter = peakRss()
+
+    print "Package: %s" % os.path.abspath(packageDirectory)
+    print "Per instance (object + instance dict):"
+    print "  DagNodeAttribute  %5d B" % instanceSize(attributes[0])
+    print "  DagNodeInput      %5d B" % instanceSize(inputs[0])
+    print "  DataPacket        %5d B" % instanceSize(dataPackets[0])
+    print "Peak RSS growth for %d of each: %.1f MB" % (INSTANCE_COUNT, (rssAfter - rssBefore) / 1024.0)
+
+    # Copies (as made by DagNode.duplicate) must keep working
+    attributeCopy = copy.deepcopy(attributes[0])
+    assert (attributeCopy.name, attributeCopy.value) == (attributes[0].name, attributes[0].value)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "deplish"))
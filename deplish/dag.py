@@ -22,9 +22,15 @@ import networkx
 
 import node
 import util
+import variables
 import data_packet
 
 
+# The number of frames a frame-independent node processes per execution when
+# rerunning missing frames
+DEFAULT_CHUNK_SIZE = 10
+
+
 class DAG(object):
     """Container of DiGraph and DagNode
 
@@ -41,9 +47,25 @@ class DAG(object):
         # A list of node group sets
         self.nodeGroupDict = dict()
 
+        # The snapshot representation of the edges, rebuilt only when they change
+        self._edgeRecords = None
+
+        # Nodes keyed by UUID for constant-time lookups
+        self._nodesByUUID = dict()
+
+        # The variables each node's properties use, keyed by node, and the
+        # reverse index of the (node, kind, property name) triples using each
+        # variable, keyed by (dollar count, variable name).  Nodes modified 
+        # since they were last indexed are reindexed when the index is queried.
+        self._nodeVariables = dict()
+        self._variableUsers = dict()
+        self._variableIndexStale = set()
+
 
     def node(self, name=None, nUUID=None):
         """Return a node with the given name or UUID"""
+        if nUUID and not name:
+            return self._nodesByUUID.get(nUUID)
         for dagNode in self.network:
             if name and dagNode.name == name:
                 return dagNode
@@ -94,7 +116,18 @@ class DAG(object):
         """Adds a node to the DAG."""
         if self.node(dagNode.name):
             raise RuntimeError('Cannot add node named %s, as it already exists.' % dagNode.name)
+        self._addNode(dagNode)
+
+
+    def _addNode(self, dagNode):
+        """
+        Add a node to the graph and the DAG's indexes without checking its 
+        name.
+        """
         self.network.add_node(dagNode)
+        self._nodesByUUID[dagNode.uuid] = dagNode
+        dagNode.changeCallback = self._nodeModified
+        self._variableIndexStale.add(dagNode)
 
 
     def remove_node(self, dagNode=None, name=None):
@@ -102,6 +135,18 @@ class DAG(object):
         if not dagNode:
             dagNode = self.node(name=name)
         self.network.remove_node(dagNode)
+        self._forgetNode(dagNode)
+        self._edgeRecords = None
+
+
+    def _forgetNode(self, dagNode):
+        """
+        Drop a node that has left the graph from the DAG's indexes.
+        """
+        self._nodesByUUID.pop(dagNode.uuid, None)
+        dagNode.changeCallback = None
+        self._variableIndexStale.discard(dagNode)
+        self._unindexNodeVariables(dagNode)
 
 
     def connect_nodes(self, startNode, endNode):
@@ -116,6 +161,7 @@ class DAG(object):
         if startNode in self.nodeConnectionsIn(endNode):
             raise RuntimeError("Attempting to duplicate outgoing connection.")
         self.network.add_edge(endNode, startNode)
+        self._edgeRecords = None
         if not networkx.is_directed_acyclic_graph(self.network):
             raise RuntimeError('The directed graph is nolonger acyclic!')
 
@@ -130,6 +176,7 @@ class DAG(object):
         if endNode not in self.network:
             raise RuntimeError('Node %s does not exist in DAG.' % endNode.name)
         self.network.remove_edge(endNode, startNode)
+        self._edgeRecords = None
     
 
     ###########################################################################
@@ -151,12 +198,18 @@ class DAG(object):
         return dagPathList
 
 
-    def execute_node(self, node, contexts=None):
-        """ Executes a single node with the given list of contexts  """
-        print 'EXECUTING NODE::', node.name
+    def execute_node(self, node, contexts=None, frames=None):
+        """ Executes a single node with the given list of contexts, limited to the given FrameSet for frame-independent nodes  """
+        if frames is None:
+            print 'EXECUTING NODE::', node.name
+        else:
+            print 'EXECUTING NODE::', node.name, 'FRAMES::', str(frames)
 
         node.preProcess()
-        data = node.execute()
+        if frames is None:
+            data = node.execute()
+        else:
+            data = node.execute(frames=frames)
         node.postProcess()
 
         return data
@@ -187,6 +240,90 @@ class DAG(object):
             self.execute_node(node)
 
 
+    def execute_missing_up_to_node(self, node, chunkSize=DEFAULT_CHUNK_SIZE):
+        """
+            Execute only what is missing from disk for and up to the given node.
+            Frame-independent nodes run the frames they need in chunks of up to
+            `chunkSize` frames; other nodes run whole, or not at all.
+        """
+        node_eval_order = list(networkx.dfs_postorder_nodes(self.network, node))
+        framesByNode = self.framesToExecute(node_eval_order)
+        for dagNode in node_eval_order:
+            frames = framesByNode[dagNode]
+            if frames is None:
+                self.execute_node(dagNode)
+                continue
+            for chunk in frames.chunks(chunkSize):
+                self.execute_node(dagNode, frames=chunk)
+
+
+    def nodeOutputFrames(self, dagNode):
+        """
+        Return a FrameSet of all the frames the node's outputs cover.
+        """
+        outputFrames = util.FrameSet()
+        for dataPacket in self.nodeOutputDataPackets(dagNode):
+            if dataPacket.frameSet() is not None:
+                outputFrames = outputFrames.union(dataPacket.frameSet())
+        return outputFrames
+
+
+    def missingOutputFrames(self, dagNode, listings=None):
+        """
+        Return a tuple holding a FrameSet of the frames of the node's outputs
+        that are missing from disk, and a boolean stating whether any files of
+        outputs without a sequence range are missing.
+        """
+        missingFrames = util.FrameSet()
+        filesMissing = False
+        for dataPacket in self.nodeOutputDataPackets(dagNode):
+            if dataPacket.frameSet() is None:
+                missingFiles = dataPacket.missingFiles(listings=listings)
+                filesMissing = filesMissing or any(missingFiles.values())
+                continue
+            for frames in dataPacket.missingFrames(listings=listings).values():
+                missingFrames = missingFrames.union(frames)
+        return (missingFrames, filesMissing)
+
+
+    def framesToExecute(self, dagNodes, listings=None):
+        """
+        Given a list of nodes in execution order, return a dictionary keyed by
+        node holding what each one needs to execute to fill in what is missing
+        on disk.  Frame-independent nodes get a FrameSet of their missing 
+        frames plus the frames rerun upstream of them, which may be empty.  
+        Other nodes get None if anything of theirs or upstream of them is 
+        rerun, meaning they run whole, and an empty FrameSet otherwise.
+        """
+        if listings is None:
+            listings = dict()
+        framesByNode = dict()
+        for dagNode in dagNodes:
+            # The frames rerun upstream, or None if an upstream node runs whole
+            upstreamFrames = util.FrameSet()
+            for upstreamNode in self.all_nodes_before(dagNode):
+                if upstreamNode not in framesByNode:
+                    continue
+                if framesByNode[upstreamNode] is None:
+                    upstreamFrames = None
+                    break
+                upstreamFrames = upstreamFrames.union(framesByNode[upstreamNode])
+
+            (missingFrames, filesMissing) = self.missingOutputFrames(dagNode, listings)
+            outputFrames = self.nodeOutputFrames(dagNode)
+
+            if not dagNode.framesIndependent or not outputFrames or filesMissing:
+                if filesMissing or missingFrames or upstreamFrames is None or upstreamFrames:
+                    framesByNode[dagNode] = None
+                else:
+                    framesByNode[dagNode] = util.FrameSet()
+            elif upstreamFrames is None:
+                framesByNode[dagNode] = outputFrames
+            else:
+                framesByNode[dagNode] = missingFrames.union(upstreamFrames).intersection(outputFrames)
+        return framesByNode
+
+
     def nodeOrderedDataPackets(self, dagNode, onlyUnfulfilled=False, onlyFulfilled=False):
         """
         Given a node, return which datapackets are povided to it, filtered by some flags.
@@ -196,15 +333,18 @@ class DAG(object):
         orderedDataPackets = self.buildSceneGraph(dagNode)
         scenegraphInputAndConnectedNode = [(i, self.nodeInputComesFromNode(dagNode, i)[0]) for i in dagNode.inputs()]
 
+        connectedNodes = [i[1] for i in scenegraphInputAndConnectedNode]
+        orderedDataPackets = [dp for dp in orderedDataPackets if dp.sourceNode is not dagNode and dp.sourceNode in connectedNodes]
+
+        # Check the presence of every packet's data in one batch
+        if onlyFulfilled or onlyUnfulfilled:
+            dataPresent = data_packet.packetsDataPresent(orderedDataPackets)
+
         # Loop over the data packets in order, picking out the input associated with it (TODO: functionize)
         for dataPacket in orderedDataPackets:
-            if dataPacket.sourceNode is dagNode:
+            if onlyFulfilled and not dataPresent[dataPacket]:
                 continue
-            if dataPacket.sourceNode not in [i[1] for i in scenegraphInputAndConnectedNode]:
-                continue
-            if onlyFulfilled and not dataPacket.dataPresent():
-                continue
-            if onlyUnfulfilled and dataPacket.dataPresent():
+            if onlyUnfulfilled and dataPresent[dataPacket]:
                 continue
             
             # Recover the input that matches the current datapacket
@@ -344,13 +484,19 @@ class DAG(object):
         """
         if dagNode is None:
             return None
-        
+        # TODO: scene_graph_handle should not return an array - it should take a single output.
+        return self.nodeOutputDataPackets(dagNode)[0]
+
+
+    def nodeOutputDataPackets(self, dagNode):
+        """
+        Return a list of the DataPackets coming out of all the node's outputs.
+        """
         # Retrieve specialized output types
         specializationDict = dict()
         for output in dagNode.outputs():
             specializationDict[output.name] = self.nodeOutputType(dagNode, output)
-        # TODO: scene_graph_handle should not return an array - it should take a single output.
-        return dagNode.scene_graph_handle(specializationDict)[0]
+        return dagNode.scene_graph_handle(specializationDict)
 
 
     ###########################################################################
@@ -364,12 +510,17 @@ class DAG(object):
         return dagNode.input_requirements_fulfilled(foo)
     
     
-    def safeNodeName(self, nodeName):
+    def safeNodeName(self, nodeName, takenNames=None):
         """
         Given a node name suggestion, returns a safe version of it that will work in this DAG.
+        A set of the names already taken may be given to spare a search of the DAG.
         """
+        if takenNames is None:
+            isTaken = lambda name: self.node(name=name) is not None
+        else:
+            isTaken = lambda name: name in takenNames
         localName = nodeName
-        while self.node(name=localName):
+        while isTaken(localName):
             prefix = ""
             version = "0"
             if not localName[-1].isdigit():
@@ -380,6 +531,134 @@ class DAG(object):
         return localName
 
 
+    def cloneSubgraph(self, dagNodes, nameExtension):
+        """
+        Add a copy of the given nodes to the DAG, along with the connections
+        between them and any group made up entirely of them.  The clones are
+        named after their originals plus the given extension, made unique if
+        need be.  Inputs referring to a cloned node are pointed at its clone,
+        while connections to nodes outside the subgraph are dropped.  Returns
+        a dictionary mapping each given node to its clone.
+        """
+        sourceNodes = set(dagNodes)
+        takenNames = set(n.name for n in self.network)
+        clones = dict()
+        for dagNode in dagNodes:
+            clone = dagNode.duplicate(nameExtension)
+            clone.set_name(self.safeNodeName(clone.name, takenNames))
+            takenNames.add(clone.name)
+            self._addNode(clone)
+            clones[dagNode] = clone
+        
+        # Inputs and connections within the subgraph
+        uuidMap = dict((dagNode.uuid, clone.uuid) for (dagNode, clone) in clones.items())
+        for clone in clones.values():
+            clone.remapInputReferences(uuidMap)
+        for (endNode, startNode) in self.network.edges(sourceNodes):
+            if startNode in sourceNodes:
+                self.network.add_edge(clones[endNode], clones[startNode])
+        self._edgeRecords = None
+
+        # Groups
+        for (name, groupNodes) in self.nodeGroupDict.items():
+            if groupNodes and groupNodes.issubset(sourceNodes):
+                groupName = util.generateUniqueNameSimiarToExisting('group', self.nodeGroupDict.keys())
+                self.addNodeGroup(groupName, [clones[n] for n in groupNodes])
+        return clones
+
+
+    ###########################################################################
+    ## Variable usage
+    ###########################################################################
+    def _nodeModified(self, dagNode):
+        """
+        Called by member nodes whenever they are modified.
+        """
+        self._variableIndexStale.add(dagNode)
+
+
+    def _unindexNodeVariables(self, dagNode):
+        """
+        Remove a node's entries from the variable usage index.
+        """
+        for (key, users) in self._nodeVariables.pop(dagNode, dict()).items():
+            allUsers = self._variableUsers[key]
+            allUsers.difference_update(users)
+            if not allUsers:
+                del self._variableUsers[key]
+
+
+    def _indexNodeVariables(self, dagNode):
+        """
+        Add the variables used by a node's property values and ranges to the
+        variable usage index, reading them from the node's snapshot record.
+        """
+        nodeVariables = dict()
+        record = dagNode.snapshotRecord()
+        for kind in ("INPUTS", "OUTPUTS", "ATTRIBUTES"):
+            for propertyRecord in record[kind]:
+                strings = list()
+                if isinstance(propertyRecord["VALUE"], dict):
+                    strings.extend(propertyRecord["VALUE"].values())
+                else:
+                    strings.append(propertyRecord["VALUE"])
+                if propertyRecord["RANGE"]:
+                    strings.extend(propertyRecord["RANGE"])
+                user = (dagNode, kind, propertyRecord["NAME"])
+                for string in strings:
+                    if not isinstance(string, basestring) or '$' not in string:
+                        continue
+                    (singleDollarList, doubleDollarList) = variables.present(string)
+                    for key in [(1, v) for v in singleDollarList] + [(2, v) for v in doubleDollarList]:
+                        nodeVariables.setdefault(key, set()).add(user)
+        self._nodeVariables[dagNode] = nodeVariables
+        for (key, users) in nodeVariables.items():
+            self._variableUsers.setdefault(key, set()).update(users)
+
+
+    def _refreshVariableIndex(self):
+        """
+        Reindex the nodes modified since the variable usage index was last
+        queried.
+        """
+        while self._variableIndexStale:
+            dagNode = self._variableIndexStale.pop()
+            self._unindexNodeVariables(dagNode)
+            self._indexNodeVariables(dagNode)
+
+
+    def variablesUsed(self, dagNode):
+        """
+        Returns a tuple containing a list of all the single-dollar and a list
+        of all the double-dollar variables used by the given node's property
+        values and ranges.
+        """
+        self._refreshVariableIndex()
+        keys = self._nodeVariables.get(dagNode, dict()).keys()
+        return ([name for (dollarCount, name) in keys if dollarCount == 1],
+                [name for (dollarCount, name) in keys if dollarCount == 2])
+
+
+    def variableUsers(self, variableName, environment=False):
+        """
+        Return a list of (node, property kind, property name) tuples for every
+        property that refers to the given workflow variable, or environment 
+        variable if the environment flag is set.  The kind is the snapshot
+        key the property is stored under ("INPUTS", "OUTPUTS", "ATTRIBUTES").
+        """
+        self._refreshVariableIndex()
+        return list(self._variableUsers.get((2 if environment else 1, variableName), set()))
+
+
+    def nodesUsingVariable(self, variableName, environment=False):
+        """
+        Return a list of the nodes with a property that refers to the given
+        workflow variable, or environment variable if the environment flag is
+        set.
+        """
+        return list(set(user[0] for user in self.variableUsers(variableName, environment)))
+
+
     ###########################################################################
     ## Group machinations
     ###########################################################################
@@ -452,21 +731,18 @@ class DAG(object):
     ###########################################################################
     def snapshot(self, nodeMetaDict=None, connectionMetaDict=None, variableMetaList=None):
         """
-        Creates a 'snapshot' dictionary from the current DAG.
+        Creates a 'snapshot' dictionary from the current DAG.  Node and edge
+        records are shared with earlier snapshots for everything that has not
+        changed since, so snapshots must be treated as read-only.
         """
-        nodes = list()
-        for dagNode in self.nodes():
-            nodes.append({"NAME":copy.deepcopy(dagNode.name),
-                          "TYPE":type(dagNode).__name__,
-                          "UUID":str(dagNode.uuid),
-                          "INPUTS":[{"NAME":copy.deepcopy(x.name), "VALUE":copy.deepcopy(x.value), "RANGE":copy.deepcopy(x.seqRange)} for x in dagNode.inputs()],
-                          "OUTPUTS":[{"NAME":copy.deepcopy(x.name), "VALUE":copy.deepcopy(x.value), "RANGE":copy.deepcopy(x.seqRange)} for x in dagNode.outputs()],
-                          "ATTRIBUTES":[{"NAME":copy.deepcopy(x.name), "VALUE":copy.deepcopy(x.value), "RANGE":copy.deepcopy(x.seqRange)} for x in dagNode.attributes()] })
+        nodes = [dagNode.snapshotRecord() for dagNode in self.nodes()]
         
-        edges = list()
-        for connection in sorted(self.network.edges()):
-            edges.append({"FROM":str(connection[1].uuid),
-                          "TO":str(connection[0].uuid)})
+        if self._edgeRecords is None:
+            self._edgeRecords = list()
+            for connection in sorted((str(c[1].uuid), str(c[0].uuid)) for c in self.network.edges()):
+                self._edgeRecords.append({"FROM":connection[0],
+                                          "TO":connection[1]})
+        edges = list(self._edgeRecords)
         
         groups = list()
         for key in self.nodeGroupDict:
@@ -482,39 +758,65 @@ class DAG(object):
         return snapshotDict
     
     
+    def nodeFromSnapshotRecord(self, record):
+        """
+        Create a new node (not yet added to the DAG) from a single node record
+        of a snapshot, keeping the UUID it was saved with.  The record's
+        property values are applied when the node's properties are first used.
+        """
+        newNode = node.createNodeOfType(record["TYPE"])
+        newNode.uuid = uuid.UUID(record["UUID"])
+        newNode.applySnapshotRecord(record, deferProperties=True)
+        return newNode
+
+
     def restoreSnapshot(self, snapshotDict):
         """
-        Transfers the given JSON snapshot into the current dict.
+        Transfers the given JSON snapshot into the current dict.  The snapshot
+        is reconciled against the live DAG by UUID: nodes that are missing are
+        created, nodes whose record differs are updated in-place, and nodes
+        absent from the snapshot are removed.  Existing node objects survive.
+        Returns a list of the nodes that were created or updated.
         """
-        # Clear out the existing DAG
-        self.network.clear()
-        self.nodeGroupDict.clear()
+        targetNodes = dict((n["UUID"], n) for n in snapshotDict["NODES"])
+
+        # Remove nodes that are gone (or whose type has changed underneath them)
+        for dagNode in list(self.network):
+            record = targetNodes.get(str(dagNode.uuid))
+            if record is None or record["TYPE"] != type(dagNode).__name__:
+                self.network.remove_node(dagNode)
+                self._forgetNode(dagNode)
         
         # Loads of nodes
+        changedNodes = list()
         for n in snapshotDict["NODES"]:
-            nodeType = n["TYPE"]
-            newNode = util.classTypeNamedFromModule(nodeType, 'node')
-            newNode.name = n["NAME"]
-            newNode.uuid = uuid.UUID(n['UUID'])
-            for i in n["INPUTS"]:
-                newNode.setInputValue(i["NAME"], i["VALUE"])
-                newNode.setInputRange(i["NAME"], i["RANGE"])
-            for o in n["OUTPUTS"]:
-                for s in o["VALUE"]:
-                    newNode.setOutputValue(o["NAME"], s, o["VALUE"][s])
-                    if o["RANGE"]:
-                        newNode.setOutputRange(o["NAME"], (o["RANGE"][0], o["RANGE"][1]))
-            for a in n["ATTRIBUTES"]:
-                newNode.set_attribute_value(a["NAME"], a["VALUE"])
-                newNode.set_attribute_range(a["NAME"], a["RANGE"])
-            self.add_node(newNode)
+            dagNode = self._nodesByUUID.get(uuid.UUID(n["UUID"]))
+            if dagNode is None:
+                # Names were unique when the snapshot was taken, so skip add_node()'s check
+                dagNode = self.nodeFromSnapshotRecord(n)
+                self._addNode(dagNode)
+                changedNodes.append(dagNode)
+            elif dagNode.snapshotRecord() is not n and dagNode.snapshotRecord() != n:
+                dagNode.applySnapshotRecord(n)
+                changedNodes.append(dagNode)
             
         # Edge loads
-        for e in snapshotDict["EDGES"]:
-            fromNode = self.node(nUUID=uuid.UUID(e["FROM"]))
-            toNode = self.node(nUUID=uuid.UUID(e["TO"]))
-            self.connect_nodes(fromNode, toNode)
+        targetEdges = set((e["FROM"], e["TO"]) for e in snapshotDict["EDGES"])
+        for connection in list(self.network.edges()):
+            if (str(connection[1].uuid), str(connection[0].uuid)) not in targetEdges:
+                self.network.remove_edge(*connection)
+        for (fromString, toString) in targetEdges:
+            fromNode = self.node(nUUID=uuid.UUID(fromString))
+            toNode = self.node(nUUID=uuid.UUID(toString))
+            if not self.network.has_edge(toNode, fromNode):
+                self.network.add_edge(toNode, fromNode)
+        self._edgeRecords = None
+        if not networkx.is_directed_acyclic_graph(self.network):
+            raise RuntimeError('The directed graph is nolonger acyclic!')
         
         # Group loads
+        self.nodeGroupDict.clear()
         for g in snapshotDict["GROUPS"]:
             self.nodeGroupDict[g["NAME"]] = set([self.node(nUUID=uuid.UUID(ns)) for ns in g["NODES"]])
+
+        return changedNodes
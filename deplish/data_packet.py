@@ -22,14 +22,14 @@ import uuid
 
 import node
 import util
+import registry
 
 
 def filenameDictForDataPacketType(dataPacketType):
     """
     Return a dict of fileDescriptors for a given DataPacket type.
     """
-    foo = dataPacketType(None, None)
-    return foo.filenames
+    return registry.fileDescriptorDict(dataPacketType)
 
 
 def scenegraphLocationString(dataPacket):
@@ -74,6 +74,24 @@ def nodeAndOutputFromScenegraphLocationString(string, dag):
         return(None, None)
     
 
+def packetsDataPresent(dataPackets):
+    """
+    Return a dictionary stating whether all data is present for each of the
+    given DataPackets.  Directories shared by the packets are listed once.
+    """
+    listings = dict()
+    return dict((dp, dp.dataPresent(listings=listings)) for dp in dataPackets)
+
+
+def packetsMissingFiles(dataPackets):
+    """
+    Return a dictionary holding DataPacket.missingFiles() for each of the 
+    given DataPackets.  Directories shared by the packets are listed once.
+    """
+    listings = dict()
+    return dict((dp, dp.missingFiles(listings=listings)) for dp in dataPackets)
+
+
 # TODO: A function to get the type name without needing to create the class?
 
 
@@ -85,8 +103,12 @@ class DataPacket(object):
     The minimal amount of data needed to convey an object.
     The user may inherit from this class to define her own formats of data to
     pass around the DAG.  Adding members to the filenames dictionary is all
-    that is needed to make effective new DataPackets.
+    that is needed to make effective new DataPackets.  Scenegraphs create 
+    these in bulk, so the base class goes without a per-instance dict; a 
+    child class only gets one if it adds members without declaring __slots__.
     """
+    __slots__ = ("filenames", "sourceNode", "sourceOutputName", "sequenceRange")
+
     def __init__(self, sourceNode, sourceOutputName):
         self.filenames = dict()
         self.sourceNode = sourceNode
@@ -120,11 +142,21 @@ class DataPacket(object):
         # All sequence ranges are converted to integers here
         self.sequenceRange = None
         if rangeTuple:
-            lowValue = int(rangeTuple[0]) if rangeTuple[0] else None
-            highValue = int(rangeTuple[1]) if rangeTuple[1] else None
+            lowValue = int(rangeTuple[0]) if rangeTuple[0] not in (None, "") else None
+            highValue = int(rangeTuple[1]) if rangeTuple[1] not in (None, "") else None
             self.sequenceRange = (lowValue, highValue)
 
 
+    def frameSet(self):
+        """
+        Return a FrameSet of the frames in the sequence range, or None if the
+        packet has no complete sequence range.
+        """
+        if not self.sequenceRange or self.sequenceRange[0] is None or self.sequenceRange[1] is None:
+            return None
+        return util.FrameSet.fromRange(*self.sequenceRange)
+
+
     def fileDescriptorNamed(self, descriptorName):
         """
         Return a framespec object derived from the information in the given
@@ -135,34 +167,100 @@ class DataPacket(object):
         return util.framespec(self.filenames[descriptorName], self.sequenceRange)
     
 
-    def dataPresent(self, specificFileDescriptorName=None):
+    def discoverSequences(self, specificFileDescriptorName=None, listings=None):
+        """
+        Look on disk for the frames of each file descriptor containing frame
+        symbols.  Returns a dictionary of util.discoverSequence() tuples 
+        (FrameSet, padding, missing FrameSet) keyed by file descriptor name.
+        See util.filesPresent() for the listings dict.
+        """
+        if listings is None:
+            listings = dict()
+        sequences = dict()
+        for fdName in self._fileDescriptorNames(specificFileDescriptorName):
+            filename = self.filenames[fdName]
+            if filename and util.framespec.hasFrameSymbols(os.path.basename(filename)):
+                sequences[fdName] = util.discoverSequence(filename, listings)
+        return sequences
+
+
+    def discoverSequenceRange(self, listings=None):
+        """
+        Return the (start, end) tuple of the frames present on disk for all 
+        file descriptors with frame symbols, or None if there are none.
+        """
+        frameSet = None
+        for (frames, padding, missing) in self.discoverSequences(listings=listings).values():
+            frameSet = frames if frameSet is None else frameSet.intersection(frames)
+        if not frameSet:
+            return None
+        return (frameSet.start(), frameSet.end())
+
+
+    def _fileDescriptorNames(self, specificFileDescriptorName=None):
+        """
+        Return a list of the given descriptor name, or all of them.
+        """
+        if specificFileDescriptorName:
+            return [specificFileDescriptorName]
+        return list(self.filenames.keys())
+
+
+    def dataPresent(self, specificFileDescriptorName=None, listings=None):
         """
         Returns if all data is present for the current DataPacket.  Individual
         file descriptors in the data packet can be specified to retrieve more 
-        detailed information.
+        detailed information.  See util.filesPresent() for the listings dict.
         """
-        fdNameList = list()
-        if specificFileDescriptorName:
-            fdNameList.append(specificFileDescriptorName)
-        else:
-            fdNameList = self.filenames.keys()
-        for fileDescriptor in fdNameList:
-            if not self._filesExist(util.framespec(self.filenames[fileDescriptor], self.sequenceRange)):
-                return False
-        return True
+        missing = self.missingFiles(specificFileDescriptorName, listings)
+        return all(missingList == [] for missingList in missing.values())
 
-    
-    def _filesExist(self, framespecObject):
+
+    def _missingFrames(self, specificFileDescriptorName, listings):
         """
-        Check if all files exist in a given framespec object.
+        Return a dictionary of (frame list, missing frame list) tuples, keyed
+        by file descriptor name.  All the descriptors are checked in a single
+        batch, listing each directory only once.
         """
-        numFilesInList = len(framespecObject.frames())
-        if numFilesInList == 0:
-            return False
-        for file in framespecObject.frames():
-            if not os.path.exists(file):
-                return False
-        return True
+        # The frames are expanded from the same FrameSet missingFrames() pairs them with
+        fileRange = self.frameSet() or self.sequenceRange
+        framesByDescriptor = dict()
+        for fdName in self._fileDescriptorNames(specificFileDescriptorName):
+            framesByDescriptor[fdName] = util.framespec(self.filenames[fdName], fileRange).frames()
+        allFrames = list()
+        for frames in framesByDescriptor.values():
+            allFrames.extend(frames)
+        present = util.filesPresent(allFrames, listings)
+        return dict((fdName, (frames, [f for f in frames if f not in present])) for (fdName, frames) in framesByDescriptor.items())
+
+
+    def missingFiles(self, specificFileDescriptorName=None, listings=None):
+        """
+        Return a dictionary of the filenames missing from disk, keyed by file
+        descriptor name.  Descriptors that expand to no files at all report
+        None instead of a list.
+        """
+        missing = dict()
+        for (fdName, (frames, missingFrames)) in self._missingFrames(specificFileDescriptorName, listings).items():
+            missing[fdName] = missingFrames if frames else None
+        return missing
+
+
+    def missingFrames(self, specificFileDescriptorName=None, listings=None):
+        """
+        Return a dictionary of FrameSets holding the frame numbers missing 
+        from disk, keyed by file descriptor name.  An empty dictionary is 
+        returned if the packet has no complete sequence range; use 
+        missingFiles() then.
+        """
+        frameSet = self.frameSet()
+        if frameSet is None:
+            return dict()
+        missing = dict()
+        for (fdName, (frames, missingFrames)) in self._missingFrames(specificFileDescriptorName, listings).items():
+            missingSet = set(missingFrames)
+            missing[fdName] = util.FrameSet.fromFrames(n for (n, f) in zip(frameSet, frames) if f in missingSet)
+        return missing
 
 
 ######## FUNCTION TO IMPORT PLUGIN DATA PACKETS INTO THIS NAMESPACE  ##########
@@ -175,3 +273,4 @@ def loadChildDataPacketsFromPaths(pathList):
         dpClassDict = util.allClassesOfInheritedTypeFromDir(path, DataPacket)
         for dpc in dpClassDict:
             globals()[dpc] = dpClassDict[dpc]
+
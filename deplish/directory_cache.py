@@ -0,0 +1,319 @@
+#
+# Depends
+# Copyright (C) 2014 by Andrew Gardner & Jonas Unger.  All rights reserved.
+# BSD license (LICENSE.txt for details).
+#
+
+import os
+import sys
+import time
+import errno
+import struct
+import ctypes
+import ctypes.util
+import threading
+
+
+"""
+A cache of directory contents for answering "does this file exist" questions
+from memory.  On Linux, each cached directory is watched with inotify, and its
+listing is dropped the moment a file is created, deleted, or moved in or out
+of it.  Directories inotify can't watch reliably (network filesystems such as
+NFS, whose changes made by other machines never raise events) or at all (no
+inotify, or the watch limit is reached) are listed again once their listing
+is older than a time-to-live instead.
+
+Install a cache with util.setDirectoryCache() and util.directoryListing() and
+everything built on it (DataPacket.dataPresent(), for instance) will use it.
+"""
+
+
+###########################################################################
+###########################################################################
+# Filesystem types whose changes may come from other machines
+NETWORK_FILESYSTEMS = frozenset(["nfs", "nfs4", "cifs", "smbfs", "smb3", "afs", "9p",
+                                 "ceph", "glusterfs", "fuse.glusterfs", "fuse.sshfs",
+                                 "lustre", "gpfs", "panfs", "beegfs"])
+
+# inotify event and flag constants (see inotify(7))
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+# wd, mask, cookie, name length
+EVENT_FORMAT = "iIII"
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+
+
+def _loadInotify():
+    """
+    Return the C library if it provides inotify, otherwise None.
+    """
+    if not os.path.exists("/proc/self"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        libc.inotify_rm_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+def _unescapeMountPath(path):
+    """
+    Undo the octal escapes (\\040 for a space, and so on) of /proc/mounts.
+    """
+    if '\\' not in path:
+        return path
+    pieces = path.split('\\')
+    result = pieces[0]
+    for piece in pieces[1:]:
+        if len(piece) >= 3 and piece[:3].isdigit():
+            result += chr(int(piece[:3], 8)) + piece[3:]
+        else:
+            result += '\\' + piece
+    return result
+
+
+def readMountTable(mountsFilename="/proc/mounts"):
+    """
+    Return a list of (mount point, filesystem type) tuples, longest mount
+    point first, or an empty list if the mount table can't be read.
+    """
+    mounts = list()
+    try:
+        with open(mountsFilename, 'r') as fp:
+            for line in fp:
+                fields = line.split()
+                if len(fields) >= 3:
+                    mounts.append((_unescapeMountPath(fields[1]), fields[2]))
+    except IOError:
+        return list()
+    return sorted(mounts, key=lambda m: len(m[0]), reverse=True)
+
+
+###########################################################################
+## Directory cache
+###########################################################################
+class DirectoryCache(object):
+    """
+    Directory listings kept in memory, keyed by absolute directory path.  A
+    listing is a frozenset of the names in the directory.  All methods may
+    be called from any thread.
+    """
+
+    def __init__(self, ttlSeconds=5.0, maxWatches=4096):
+        """
+        """
+        self.ttlSeconds = ttlSeconds
+        self.maxWatches = maxWatches
+        self._lock = threading.Lock()
+
+        # Directory -> (listing, time listed)
+        self._listings = dict()
+
+        # Directory -> watch descriptor, and back
+        self._watches = dict()
+        self._watchedDirectories = dict()
+
+        # Counts of the changes seen in each watched directory, and of the
+        # event queue overflows, so a listing read while its directory 
+        # changes isn't cached
+        self._changes = dict()
+        self._overflows = 0
+
+        # When expired listings of unwatched directories were last dropped
+        self._lastEviction = time.time()
+
+        # Filesystem types of the mounts, to decide what may be watched
+        self._mounts = readMountTable()
+
+        self._libc = _loadInotify()
+        self._inotifyFd = None
+        if self._libc:
+            fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self._inotifyFd = fd
+
+
+    def close(self):
+        """
+        Stop watching all directories and forget every listing.
+        """
+        with self._lock:
+            if self._inotifyFd is not None:
+                os.close(self._inotifyFd)
+                self._inotifyFd = None
+            self._watches.clear()
+            self._watchedDirectories.clear()
+            self._changes.clear()
+            self._listings.clear()
+
+
+    def usesInotify(self):
+        """
+        Returns whether directories are being watched with inotify.
+        """
+        return self._inotifyFd is not None
+
+
+    def filesystemType(self, directory):
+        """
+        Return the type of the filesystem holding the given directory, or
+        None if it isn't known.
+        """
+        directory = os.path.realpath(directory)
+        for (mountPoint, fsType) in self._mounts:
+            if directory == mountPoint or directory.startswith(mountPoint.rstrip('/') + '/'):
+                return fsType
+        return None
+
+
+    def _watchable(self, directory):
+        """
+        Returns whether changes to a directory can be relied on to raise
+        inotify events.
+        """
+        if self._inotifyFd is None or len(self._watches) >= self.maxWatches:
+            return False
+        return self.filesystemType(directory) not in NETWORK_FILESYSTEMS
+
+
+    def _watch(self, directory):
+        """
+        Start watching a directory.  Returns whether it is being watched.
+        """
+        if directory in self._watches:
+            return True
+        path = directory.encode(sys.getfilesystemencoding() or 'utf-8') if isinstance(directory, unicode) else directory
+        wd = self._libc.inotify_add_watch(self._inotifyFd, path, WATCH_MASK)
+        if wd < 0:
+            return False
+        self._watches[directory] = wd
+        self._watchedDirectories[wd] = directory
+        return True
+
+
+    def _unwatch(self, directory):
+        """
+        Stop watching a directory, if it is being watched.
+        """
+        self._changes.pop(directory, None)
+        wd = self._watches.pop(directory, None)
+        if wd is not None:
+            self._watchedDirectories.pop(wd, None)
+            self._libc.inotify_rm_watch(self._inotifyFd, wd)
+
+
+    def _processEvents(self):
+        """
+        Read all pending inotify events and drop the listings of the
+        directories they concern.
+        """
+        if self._inotifyFd is None:
+            return
+        while True:
+            try:
+                data = os.read(self._inotifyFd, 65536)
+            except OSError, err:
+                if err.errno in (errno.EAGAIN, errno.EINTR):
+                    return
+                raise
+            if not data:
+                return
+            offset = 0
+            while offset + EVENT_SIZE <= len(data):
+                (wd, mask, cookie, nameLength) = struct.unpack_from(EVENT_FORMAT, data, offset)
+                offset += EVENT_SIZE + nameLength
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost, so nothing cached can be trusted
+                    self._listings.clear()
+                    self._overflows += 1
+                    continue
+                directory = self._watchedDirectories.get(wd)
+                if directory is None:
+                    continue
+                self._listings.pop(directory, None)
+                self._changes[directory] = self._changes.get(directory, 0) + 1
+                if mask & IN_IGNORED:
+                    self._watches.pop(directory, None)
+                    self._watchedDirectories.pop(wd, None)
+                    self._changes.pop(directory, None)
+                elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    self._unwatch(directory)
+
+
+    def _evictExpired(self, now):
+        """
+        Drop the expired listings of unwatched directories, at most once 
+        every ttlSeconds.  Watched listings are bounded by maxWatches.
+        """
+        if now - self._lastEviction < self.ttlSeconds:
+            return
+        self._lastEviction = now
+        for (directory, (names, listed)) in self._listings.items():
+            if directory not in self._watches and now - listed >= self.ttlSeconds:
+                del self._listings[directory]
+
+
+    def listing(self, directory):
+        """
+        Return a frozenset of the names in a directory, or an empty set if it
+        can't be listed.  Watched directories are listed only after they
+        change; others once their listing is older than ttlSeconds.  Failed
+        listings (of a directory that doesn't exist yet, say) aren't cached.
+        """
+        directory = os.path.abspath(directory or os.curdir)
+        with self._lock:
+            self._processEvents()
+            now = time.time()
+            self._evictExpired(now)
+            cached = self._listings.get(directory)
+            if cached is not None:
+                if directory in self._watches or now - cached[1] < self.ttlSeconds:
+                    return cached[0]
+
+            # Watch before listing, so no change slips in between
+            if directory not in self._watches and self._watchable(directory):
+                self._watch(directory)
+            changes = (self._changes.get(directory, 0), self._overflows)
+
+        # Listing can be slow (on NFS, say), so other queries aren't held up
+        try:
+            names = frozenset(os.listdir(directory))
+        except OSError:
+            names = None
+
+        with self._lock:
+            if names is None:
+                self._unwatch(directory)
+                self._listings.pop(directory, None)
+                return frozenset()
+            self._processEvents()
+            if changes == (self._changes.get(directory, 0), self._overflows):
+                self._listings[directory] = (names, now)
+            return names
+
+
+    def invalidate(self, directory=None):
+        """
+        Drop the listing of a directory, or all listings, so they are read
+        again on the next query.
+        """
+        with self._lock:
+            if directory is None:
+                self._listings.clear()
+            else:
+                self._listings.pop(os.path.abspath(directory or os.curdir), None)
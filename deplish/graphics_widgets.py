@@ -120,8 +120,7 @@ class DrawNode(QtGui.QGraphicsItem):
         # For handling movement undo/redos of groups of objects
         # This is a little strange to be handled by the node itself 
         # and maybe can move elsewhere?
-        self.clickSnap = None
-        self.clickPosition = None
+        self.clickPositions = None
 
         if type(self.dagNode) == node.DagNodeDot:
             self.width = 15
@@ -273,8 +272,10 @@ class DrawNode(QtGui.QGraphicsItem):
         QtGui.QGraphicsItem.mousePressEvent(self, event)
         
         # Let the QT parent class handle the selection process before querying what's selected
-        self.clickSnap = self.scene().dag.snapshot(nodeMetaDict=self.scene().nodeMetaDict(), connectionMetaDict=self.scene().connectionMetaDict())
-        self.clickPosition = self.pos()
+        self.clickPositions = dict()
+        for drawNode in [self] + self.scene().selectedItems():
+            if type(drawNode) is DrawNode:
+                self.clickPositions[drawNode] = drawNode.pos()
         
 
     def mouseReleaseEvent(self, event):
@@ -282,9 +283,16 @@ class DrawNode(QtGui.QGraphicsItem):
         Help manage mouse movement undo/redos.
         """
         # Don't register undos for selections without moves
-        if self.pos() != self.clickPosition:
-            currentSnap = self.scene().dag.snapshot(nodeMetaDict=self.scene().nodeMetaDict(), connectionMetaDict=self.scene().connectionMetaDict())
-            self.scene().undoStack().push(undo_commands.SceneOnlyUndoCommand(self.clickSnap, currentSnap, self.scene()))
+        deltas = list()
+        if self.clickPositions:
+            for drawNode, clickPosition in self.clickPositions.items():
+                if drawNode.pos() != clickPosition:
+                    deltas.append(undo_commands.MoveDelta(drawNode.dagNode.uuid, 
+                                                          (clickPosition.x(), clickPosition.y()), 
+                                                          (drawNode.pos().x(), drawNode.pos().y())))
+        if deltas:
+            self.scene().undoStack().push(undo_commands.DeltaUndoCommand(deltas, self.scene().dag, self.scene()))
+        self.clickPositions = None
         QtGui.QGraphicsItem.mouseReleaseEvent(self, event)
 
 
@@ -478,7 +486,7 @@ class DrawEdge(QtGui.QGraphicsItem):
                 self.setDestDrawNode(None)
 
                 currentSnap = self.scene().dag.snapshot(nodeMetaDict=self.scene().nodeMetaDict(), connectionMetaDict=self.scene().connectionMetaDict())
-                self.scene().undoStack().push(undo_commands.DagAndSceneUndoCommand(preSnap, currentSnap, self.scene().dag, self.scene()))
+                self.scene().undoStack().push(undo_commands.DeltaUndoCommand.fromSnapshots(preSnap, currentSnap, self.scene().dag, self.scene()))
             self.adjust()
             # TODO: Hoover-color nodes as potential targets
         QtGui.QGraphicsItem.mouseMoveEvent(self, event)
@@ -512,7 +520,7 @@ class DrawEdge(QtGui.QGraphicsItem):
                     self.adjust()
 
                     currentSnap = self.scene().dag.snapshot(nodeMetaDict=self.scene().nodeMetaDict(), connectionMetaDict=self.scene().connectionMetaDict())
-                    self.scene().undoStack().push(undo_commands.DagAndSceneUndoCommand(preSnap, currentSnap, self.scene().dag, self.scene()))
+                    self.scene().undoStack().push(undo_commands.DeltaUndoCommand.fromSnapshots(preSnap, currentSnap, self.scene().dag, self.scene()))
                     return QtGui.QGraphicsItem.mouseReleaseEvent(self, event)
 
             # No hits?  Delete yourself (You have no chance to win!)
@@ -590,6 +598,9 @@ class SceneWidget(QtGui.QGraphicsScene):
         self.highlightNodes = list()
         self.highlightIntensities = list()
 
+        # Draw nodes keyed by their dag node's UUID, to avoid scanning every item
+        self.drawNodesByUUID = dict()
+
 
     def undoStack(self):
         """
@@ -615,6 +626,12 @@ class SceneWidget(QtGui.QGraphicsScene):
         Returns the given dag node's draw node (or None if it doesn't exist in
         the scene).
         """
+        if dagNode is None:
+            return None
+        drawNode = self.drawNodesByUUID.get(dagNode.uuid)
+        if drawNode is not None and drawNode.scene() is self:
+            return drawNode
+        self.drawNodesByUUID.pop(dagNode.uuid, None)
         for item in self.items():
             if type(item).__name__ != 'DrawNode':
                 continue
@@ -639,10 +656,10 @@ class SceneWidget(QtGui.QGraphicsScene):
         Returns a drawEdge that links a given draw node to another given draw
         node.
         """
-        for item in self.items():
-            if type(item).__name__ != 'DrawEdge':
-                continue
-            if item.source == fromDrawNode and item.dest == toDrawNode:
+        if not fromDrawNode:
+            return None
+        for item in fromDrawNode.outgoingDrawEdges():
+            if item.dest == toDrawNode:
                 return item
         return None
 
@@ -652,6 +669,7 @@ class SceneWidget(QtGui.QGraphicsScene):
         Sets the current dependency graph and refreshes the scene.
         """
         self.clear()
+        self.drawNodesByUUID.clear()
         self.dag = dag
     
     
@@ -662,9 +680,26 @@ class SceneWidget(QtGui.QGraphicsScene):
         newNode = DrawNode(dagNode)
         self.addItem(newNode)
         newNode.setPos(position)
+        self.drawNodesByUUID[dagNode.uuid] = newNode
         return newNode
     
 
+    def removeExistingDagNode(self, dagNode):
+        """
+        Removes the draw node for a given dag node, along with its draw edges.
+        """
+        drawNode = self.drawNode(dagNode)
+        if not drawNode:
+            raise RuntimeError("Attempting to remove node %s which is not registered to QGraphicsScene." % dagNode.name)
+        for edge in drawNode.drawEdges():
+            edge.sourceDrawNode().removeDrawEdge(edge)
+            if edge.destDrawNode():
+                edge.destDrawNode().removeDrawEdge(edge)
+            self.removeItem(edge)
+        self.removeItem(drawNode)
+        self.drawNodesByUUID.pop(dagNode.uuid, None)
+    
+
     def addExistingConnection(self, fromDagNode, toDagNode):
         """
         Adds a new draw edge for given from and to dag nodes.
@@ -680,6 +715,21 @@ class SceneWidget(QtGui.QGraphicsScene):
         return newDrawEdge
 
 
+    def removeExistingConnection(self, fromDagNode, toDagNode):
+        """
+        Removes the draw edge between given from and to dag nodes.
+        """
+        fromDrawNode = self.drawNode(fromDagNode)
+        toDrawNode = self.drawNode(toDagNode)
+        for edge in fromDrawNode.outgoingDrawEdges():
+            if edge.destDrawNode() is toDrawNode:
+                fromDrawNode.removeDrawEdge(edge)
+                toDrawNode.removeDrawEdge(edge)
+                self.removeItem(edge)
+                return
+        raise RuntimeError("Attempting to remove connection %s->%s which is not registered to QGraphicsScene." % (fromDagNode.name, toDagNode.name))
+
+
     def addExistingGroupBox(self, name, groupDagNodeList):
         """
         Add a group box from a given list of dag nodes & names it with a string.
@@ -789,35 +839,58 @@ class SceneWidget(QtGui.QGraphicsScene):
     def restoreSnapshot(self, snapshotDict):
         """
         Given a dictionary that contains dag information and meta information 
-        for the dag, construct all draw objects and register them with the 
-        current scene.
+        for the dag, reconcile the draw objects registered with the current
+        scene against it.  Draw nodes and edges that still correspond to the
+        dag are kept (along with their selection state); only missing ones are
+        created and stale ones removed.
         """
-        # Clear out the drawnodes and connections, then add 'em all back in.
-        selectedItems = self.selectedItems()
         self.blockSignals(True)
+
+        # Drop draw nodes whose dag node is gone and re-point the rest
+        liveDrawNodes = dict()
         for dn in self.drawNodes():
-            self.removeItem(dn)
+            dagNode = self.dag.node(nUUID=dn.dagNode.uuid)
+            if dagNode is None:
+                self.removeExistingDagNode(dn.dagNode)
+                continue
+            dn.dagNode = dagNode
+            dn.update()
+            liveDrawNodes[dagNode.uuid] = dn
+        for dagNode in self.dag.nodes():
+            if dagNode.uuid not in liveDrawNodes:
+                liveDrawNodes[dagNode.uuid] = self.addExistingDagNode(dagNode, QtCore.QPointF(0,0))
+
+        # Drop draw edges that are no longer connections and add the new ones
+        targetConnections = set((c[1].uuid, c[0].uuid) for c in self.dag.connections())
+        liveConnections = set()
         for de in self.drawEdges():
+            if de.sourceDrawNode() and de.destDrawNode():
+                key = (de.sourceDrawNode().dagNode.uuid, de.destDrawNode().dagNode.uuid)
+                if key in targetConnections:
+                    liveConnections.add(key)
+                    continue
+                de.destDrawNode().removeDrawEdge(de)
+            if de.sourceDrawNode():
+                de.sourceDrawNode().removeDrawEdge(de)
             self.removeItem(de)
-        for dagNode in self.dag.nodes():
-            newNode = self.addExistingDagNode(dagNode, QtCore.QPointF(0,0))
-            if selectedItems and dagNode in [x.dagNode for x in selectedItems]:
-                newNode.setSelected(True)
         for connection in self.dag.connections():
-            newDrawEdge = self.addExistingConnection(connection[1], connection[0])
+            if (connection[1].uuid, connection[0].uuid) not in liveConnections:
+                self.addExistingConnection(connection[1], connection[0])
         self.blockSignals(False)
         
         # DrawNodes get their locations set from this meta entry
         expectedNodeMeta = snapshotDict["NODE_META"]
         if expectedNodeMeta:
             for dagNode in self.dag.nodes():
-                drawNode = self.drawNode(dagNode)
+                drawNode = liveDrawNodes[dagNode.uuid]
                 nodeMeta = expectedNodeMeta[str(dagNode.uuid)]
+                location = drawNode.pos()
                 if 'locationX' in nodeMeta:
-                    locationX = float(nodeMeta['locationX'])
+                    location.setX(float(nodeMeta['locationX']))
                 if 'locationY' in nodeMeta:
-                    locationY = float(nodeMeta['locationY'])
-                drawNode.setPos(QtCore.QPointF(locationX, locationY))
+                    location.setY(float(nodeMeta['locationY']))
+                if location != drawNode.pos():
+                    drawNode.setPos(location)
                 
         # DrawEdges    get their insertion points set here
         expectedConnectionMeta = snapshotDict["CONNECTION_META"]
@@ -826,11 +899,11 @@ class SceneWidget(QtGui.QGraphicsScene):
                 connectionIdString = "%s|%s" % (str(connection[1].uuid), str(connection[0].uuid))
                 connectionMeta = expectedConnectionMeta[connectionIdString]
                 if 'horizontalConnectionOffset' in connectionMeta:
-                    # TODO: This code is a little verbose...
-                    drawEdge = self.drawEdge(self.drawNode(self.dag.node(nUUID=connection[1].uuid)), 
-                                             self.drawNode(self.dag.node(nUUID=connection[0].uuid)))
-                    drawEdge.horizontalConnectionOffset = float(connectionMeta['horizontalConnectionOffset'])
-                    drawEdge.adjust()
+                    drawEdge = self.drawEdge(liveDrawNodes[connection[1].uuid], liveDrawNodes[connection[0].uuid])
+                    horizontalConnectionOffset = float(connectionMeta['horizontalConnectionOffset'])
+                    if drawEdge.horizontalConnectionOffset != horizontalConnectionOffset:
+                        drawEdge.horizontalConnectionOffset = horizontalConnectionOffset
+                        drawEdge.adjust()
         
 
 ###############################################################################
@@ -15,7 +15,6 @@ does not display it.
 
 import os
 import sys
-import json
 import tempfile
 import itertools
 
@@ -25,6 +24,9 @@ import dag
 import node
 import util
 import variables
+import workflow_file
+import version_store
+import directory_cache
 import data_packet
 import file_dialog
 import undo_commands
@@ -34,6 +36,49 @@ import graphics_widgets
 import scenegraph_widget
 
 
+# How often an unsaved workflow is written to its autosave file
+AUTOSAVE_INTERVAL_SECONDS = 120
+
+# The default memory budget of the undo history, and how many of the most
+# recent undo commands are left uncompressed
+DEFAULT_UNDO_BUDGET_MB = 256
+UNCOMPRESSED_UNDO_COMMANDS = 20
+
+
+class WorkflowSaveThread(QtCore.QThread):
+    """
+    A worker thread that encodes and writes a previously captured snapshot
+    to disk, keeping the user interface responsive while large workflows are
+    saved.  The writeFunction is called with the filename and the snapshot,
+    and may be workflow_file.write, a journaled write (which includes any
+    compaction of the journal), or a version store commit.  The 
+    saveFinished signal carries the filename and an error string (empty on
+    success) and is delivered on the GUI thread.
+    """
+
+    saveFinished = QtCore.Signal(str, str)
+
+    def __init__(self, filename, fullSnap, writeFunction, finishedFunction, finishedArgs=(), parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.filename = filename
+        self.fullSnap = fullSnap
+        self.writeFunction = writeFunction
+        self.finishedFunction = finishedFunction
+        self.finishedArgs = finishedArgs
+
+
+    def run(self):
+        """
+        Write the snapshot and report back.
+        """
+        error = ""
+        try:
+            self.writeFunction(self.filename, self.fullSnap)
+        except Exception, err:
+            error = str(err)
+        self.saveFinished.emit(self.filename, error)
+
+
 class MainWindow(QtGui.QMainWindow):
     """Construct main UI
 
@@ -102,10 +147,16 @@ class MainWindow(QtGui.QMainWindow):
         fileMenu.addAction(QtGui.QAction("&Save DAG", self, shortcut="Ctrl+S", triggered=lambda: self.save(self.workingFilename)))
         fileMenu.addAction(QtGui.QAction("Save DAG &Version Up", self, shortcut="Ctrl+Space", triggered=self.saveVersionUp))
         fileMenu.addAction(QtGui.QAction("Save DAG &As...", self, shortcut="Ctrl+Shift+S", triggered=self.saveAs))
+        fileMenu.addAction(QtGui.QAction("Open Versio&n...", self, triggered=self.openVersionDialog))
+        self.journaledSaveAction = QtGui.QAction("&Journaled Saves", self, checkable=True)
+        fileMenu.addAction(self.journaledSaveAction)
+        self.versionStoreAction = QtGui.QAction("Store &Versions Up", self, checkable=True)
+        fileMenu.addAction(self.versionStoreAction)
         fileMenu.addAction(QtGui.QAction("&Quit...", self, shortcut="Ctrl+Q", triggered=self.close))
         editMenu = self.menuBar().addMenu("&Edit")
         editMenu.addAction(undoAction)
         editMenu.addAction(redoAction)
+        editMenu.addAction(QtGui.QAction("Undo History &Budget...", self, triggered=self.undoBudgetDialog))
         editMenu.addSeparator()
         createMenu = editMenu.addMenu("&Create Node")
         editMenu.addAction(QtGui.QAction("&Delete Node(s)", self, shortcut="Delete", triggered=self.deleteSelectedNodes))
@@ -117,6 +168,7 @@ class MainWindow(QtGui.QMainWindow):
         executeMenu = self.menuBar().addMenu("E&xecute")
         executeMenu.addAction(QtGui.QAction("&Execute Graph", self, shortcut= "Ctrl+E", triggered=lambda: self.dag.execute_graph()))
         executeMenu.addAction(QtGui.QAction("Execute Up To &Selected Node", self, shortcut= "Ctrl+Shift+E", triggered=lambda: self.executeSelected(executeImmediately=True)))
+        executeMenu.addAction(QtGui.QAction("Execute &Missing Frames Up To Selected Node", self, shortcut= "Ctrl+Alt+E", triggered=lambda: self.executeSelected(executeImmediately=True, onlyMissing=True)))
         executeMenu.addSeparator()
         executeMenu.addAction(QtGui.QAction("&Reload plugins", self, shortcut= "Ctrl+0", triggered=self.reloadPlugins))
         windowMenu = self.menuBar().addMenu("&Window")
@@ -137,6 +189,25 @@ class MainWindow(QtGui.QMainWindow):
         for action in self.createCreateMenuActions():
             createMenu.addAction(action)
 
+        # Saves run on a worker thread, and unsaved changes are periodically 
+        # written to an autosave file next to the working file
+        self.saveThread = None
+        self.savedSnapshot = None
+        self.savedSnapshotFilename = None
+        self.versionStore = None
+        self.historyManagementPending = False
+        self.rebuildingHistory = False
+        self.historyGeneration = 0
+        self.autosaveGeneration = 0
+        self.autosaveTimer = QtCore.QTimer(self)
+        self.autosaveTimer.setInterval(AUTOSAVE_INTERVAL_SECONDS * 1000)
+        self.autosaveTimer.timeout.connect(self.autosave)
+        self.autosaveTimer.start()
+
+        # Data presence queries are answered from a cache of directory listings
+        self.directoryCache = directory_cache.DirectoryCache()
+        util.setDirectoryCache(self.directoryCache)
+
         # Load the starting filename or create a new DAG
         self.workingFilename = startFile
         self.dag = dag.DAG()
@@ -169,7 +240,11 @@ class MainWindow(QtGui.QMainWindow):
         self.variableWidget.addVariable.connect(variables.add)
         self.variableWidget.setVariable.connect(variables.setx)
         self.variableWidget.removeVariable.connect(variables.remove)
+        self.variableWidget.addVariable.connect(self.variableChanged)
+        self.variableWidget.setVariable.connect(self.variableChanged)
+        self.variableWidget.removeVariable.connect(self.variableChanged)
         self.undoStack.cleanChanged.connect(self.setWindowTitleClean)
+        self.undoStack.indexChanged.connect(self.historyChanged)
 
     def closeEvent(self, event):
         """
@@ -181,7 +256,10 @@ class MainWindow(QtGui.QMainWindow):
                     self.save(self.workingFilename)
                 else:
                     self.saveAs()
+        self.waitForSave()
         self.saveSettings()
+        util.setDirectoryCache(None)
+        self.directoryCache.close()
         QtGui.QMainWindow.closeEvent(self, event)
 
     def updateScenegraph(self, dagNodes):
@@ -247,6 +325,9 @@ class MainWindow(QtGui.QMainWindow):
         """
         self.settings.setValue("mainWindowGeometry", self.saveGeometry())
         self.settings.setValue("mainWindowState", self.saveState())
+        self.settings.setValue("journaledSaves", self.journaledSaveAction.isChecked())
+        self.settings.setValue("versionStore", self.versionStoreAction.isChecked())
+        self.settings.setValue("undoBudgetMB", self.undoBudgetMB)
         self.settings.sync()
         
         
@@ -257,6 +338,9 @@ class MainWindow(QtGui.QMainWindow):
         """
         self.restoreGeometry(self.settings.value('mainWindowGeometry'))
         self.restoreState(self.settings.value('mainWindowState'))
+        self.journaledSaveAction.setChecked(self.settings.value('journaledSaves') in (True, 'true'))
+        self.versionStoreAction.setChecked(self.settings.value('versionStore') in (True, 'true'))
+        self.undoBudgetMB = int(self.settings.value('undoBudgetMB') or DEFAULT_UNDO_BUDGET_MB)
         
 
     ###########################################################################
@@ -276,7 +360,7 @@ class MainWindow(QtGui.QMainWindow):
         self.graphicsScene.addExistingDagNode(newDagNode, nodeLocation)
 
         currentSnap = self.dag.snapshot(nodeMetaDict=self.graphicsScene.nodeMetaDict(), connectionMetaDict=self.graphicsScene.connectionMetaDict())
-        self.undoStack.push(undo_commands.DagAndSceneUndoCommand(preSnap, currentSnap, self.dag, self.graphicsScene))
+        self.undoStack.push(undo_commands.DeltaUndoCommand.fromSnapshots(preSnap, currentSnap, self.dag, self.graphicsScene))
 
 
     def delete_nodes(self, dagNodesToDelete):
@@ -304,7 +388,7 @@ class MainWindow(QtGui.QMainWindow):
             self.dag.remove_node(delNode)
 
         currentSnap = self.dag.snapshot(nodeMetaDict=self.graphicsScene.nodeMetaDict(), connectionMetaDict=self.graphicsScene.connectionMetaDict())
-        self.undoStack.push(undo_commands.DagAndSceneUndoCommand(preSnap, currentSnap, self.dag, self.graphicsScene))
+        self.undoStack.push(undo_commands.DeltaUndoCommand.fromSnapshots(preSnap, currentSnap, self.dag, self.graphicsScene))
         
         # Updates the drawNodes for each of the affected dagNodes
         self.graphicsScene.refreshDrawNodes(nodesAffected)
@@ -351,7 +435,7 @@ class MainWindow(QtGui.QMainWindow):
                 dagNode.setInputValue(input.name, "")
 
         currentSnap = self.dag.snapshot(nodeMetaDict=self.graphicsScene.nodeMetaDict(), connectionMetaDict=self.graphicsScene.connectionMetaDict())
-        self.undoStack.push(undo_commands.DagAndSceneUndoCommand(preSnap, currentSnap, self.dag, self.graphicsScene))
+        self.undoStack.push(undo_commands.DeltaUndoCommand.fromSnapshots(preSnap, currentSnap, self.dag, self.graphicsScene))
 
         # A few refreshes
         self.propWidget.refresh()
@@ -361,27 +445,42 @@ class MainWindow(QtGui.QMainWindow):
 
     def duplicateNodes(self, dagNodesToDupe):
         """
-        Create identical copies of the given dag nodes, but drop their 
-        incoming and outgoing connections.
+        Create identical copies of the given dag nodes, along with the 
+        connections and groups among them, but drop their connections to the
+        rest of the graph.  The undo command is built from the clones directly,
+        so no snapshots of the whole graph are needed.
         """
-        preSnap = self.dag.snapshot(nodeMetaDict=self.graphicsScene.nodeMetaDict(), connectionMetaDict=self.graphicsScene.connectionMetaDict())
+        clones = self.dag.cloneSubgraph(dagNodesToDupe, "_Dupe")
         
+        deltas = list()
         for dagNode in dagNodesToDupe:
-            dupedNode = dagNode.duplicate("_Dupe")
+            dupedNode = clones[dagNode]
             newLocation = self.graphicsScene.drawNode(dagNode).pos() + QtCore.QPointF(20, 20)
-            self.dag.add_node(dupedNode)
             self.graphicsScene.addExistingDagNode(dupedNode, newLocation)
+            deltas.append(undo_commands.NodeDelta(dupedNode.snapshotRecord(), (newLocation.x(), newLocation.y())))
         
-        currentSnap = self.dag.snapshot(nodeMetaDict=self.graphicsScene.nodeMetaDict(), connectionMetaDict=self.graphicsScene.connectionMetaDict())
-        self.undoStack.push(undo_commands.DagAndSceneUndoCommand(preSnap, currentSnap, self.dag, self.graphicsScene))
+        for dagNode in dagNodesToDupe:
+            for outputDagNode in self.dag.nodeConnectionsOut(dagNode):
+                if outputDagNode not in clones:
+                    continue
+                originalDrawEdge = self.graphicsScene.drawEdge(self.graphicsScene.drawNode(dagNode), self.graphicsScene.drawNode(outputDagNode))
+                newDrawEdge = self.graphicsScene.addExistingConnection(clones[dagNode], clones[outputDagNode])
+                if originalDrawEdge:
+                    newDrawEdge.horizontalConnectionOffset = originalDrawEdge.horizontalConnectionOffset
+                newDrawEdge.adjust()
+                deltas.append(undo_commands.EdgeDelta(str(clones[dagNode].uuid), str(clones[outputDagNode].uuid), newDrawEdge.horizontalConnectionOffset))
 
+        cloneSet = set(clones.values())
+        for (groupName, groupNodes) in self.dag.nodeGroupDict.items():
+            if groupNodes and groupNodes.issubset(cloneSet):
+                self.graphicsScene.addExistingGroupBox(groupName, list(groupNodes))
+                deltas.append(undo_commands.GroupDelta(groupName, None, [str(n.uuid) for n in groupNodes]))
 
-        currentSnap = self.dag.snapshot(nodeMetaDict=self.graphicsScene.nodeMetaDict(), connectionMetaDict=self.graphicsScene.connectionMetaDict())
-        self.undoStack.push(undo_commands.DagAndSceneUndoCommand(preSnap, currentSnap, self.dag, self.graphicsScene))
+        self.undoStack.push(undo_commands.DeltaUndoCommand(deltas, self.dag, self.graphicsScene))
 
         # Updates the drawNodes for each of the affected dagNodes
         self.propWidget.refresh()
-        self.graphicsScene.refreshDrawNodes([dupedNode])
+        self.graphicsScene.refreshDrawNodes(clones.values())
 
 
     def nodesDisconnected(self, fromDagNode, toDagNode):
@@ -453,7 +552,7 @@ class MainWindow(QtGui.QMainWindow):
         # Undos aren't registered when the value doesn't actually change
         if somethingChanged:
             currentSnap = self.dag.snapshot(nodeMetaDict=self.graphicsScene.nodeMetaDict(), connectionMetaDict=self.graphicsScene.connectionMetaDict())
-            self.undoStack.push(undo_commands.DagAndSceneUndoCommand(preSnap, currentSnap, self.dag, self.graphicsScene, self.propWidget))
+            self.undoStack.push(undo_commands.DeltaUndoCommand.fromSnapshots(preSnap, currentSnap, self.dag, self.graphicsScene, self.propWidget))
 
         # Updates the drawNodes for each of the affected dagNodes
         self.graphicsScene.refreshDrawNodes(nodesAffected)
@@ -495,7 +594,7 @@ class MainWindow(QtGui.QMainWindow):
         # Undos aren't registered when the value doesn't actually change, 
         if registerUndo:
             currentSnap = self.dag.snapshot(nodeMetaDict=self.graphicsScene.nodeMetaDict(), connectionMetaDict=self.graphicsScene.connectionMetaDict())
-            self.undoStack.push(undo_commands.DagAndSceneUndoCommand(preSnap, currentSnap, self.dag, self.graphicsScene, self.propWidget))
+            self.undoStack.push(undo_commands.DeltaUndoCommand.fromSnapshots(preSnap, currentSnap, self.dag, self.graphicsScene, self.propWidget))
 
         # Updates the drawNodes for each of the affected dagNodes
         self.graphicsScene.refreshDrawNodes(nodesAffected)
@@ -628,6 +727,7 @@ class MainWindow(QtGui.QMainWindow):
                 (incomingNode, incomingOutput) = self.dag.nodeInputComesFromNode(affectedNode, input)
                 if input.seqRange != incomingOutput.getSeqRange():
                     input.seqRange = incomingOutput.getSeqRange()
+                    affectedNode.modified()
                     nodesAffected.append(affectedNode)
                     
         # Data that used to exist may no longer exist.  Therefore all directly affected nodes should refresh.
@@ -636,42 +736,26 @@ class MainWindow(QtGui.QMainWindow):
         return nodesAffected
 
 
+    def variableChanged(self, variableName, value=None):
+        """
+        When a workflow variable is added, set, or removed, refresh the nodes
+        whose properties refer to it.
+        """
+        affectedDagNodes = self.dag.nodesUsingVariable(variableName)
+        if not affectedDagNodes:
+            return
+        self.graphicsScene.refreshDrawNodes(affectedDagNodes)
+        if set(affectedDagNodes) & set(self.selectedDagNodes()):
+            self.propWidget.refresh()
+            self.updateScenegraph(self.selectedDagNodes())
+
+
     def dagNodeVariablesUsed(self, dagNode):
         """
         Returns a tuple containing a list of all the single-dollar and a list 
-        of all the double-dollar variables used in the current DAG.
-        """
-        singleDollarList = list()
-        doubleDollarList = list()
-        for input in dagNode.inputs():
-            vps = variables.present(dagNode.inputValue(input.name, variableSubstitution=False))
-            vss = (list(), list())
-            vss2 = (list(), list())
-            if dagNode.inputRange(input.name, variableSubstitution=False):
-                vss = variables.present(dagNode.inputRange(input.name, variableSubstitution=False)[0])
-                vss2 = variables.present(dagNode.inputRange(input.name, variableSubstitution=False)[1])
-            singleDollarList += vps[0] + vss[0] + vss2[0]
-            doubleDollarList += vps[1] + vss[1] + vss2[1]
-        for attribute in dagNode.attributes():
-            vps = variables.present(dagNode.attribute_value(attribute.name, variableSubstitution=False))
-            vss = (list(), list())
-            vss2 = (list(), list())
-            if dagNode.attribute_range(attribute.name, variableSubstitution=False):
-                vss = variables.present(dagNode.attribute_range(attribute.name, variableSubstitution=False)[0])
-                vss2 = variables.present(dagNode.attribute_range(attribute.name, variableSubstitution=False)[1])
-            singleDollarList += vps[0] + vss[0] + vss2[0]
-            doubleDollarList += vps[1] + vss[1] + vss2[1]
-        for output in dagNode.outputs():
-            for subName in output.subOutputNames():
-                vps = variables.present(dagNode.outputValue(output.name, subName, variableSubstitution=False))
-                vss = (list(), list())
-                vss2 = (list(), list())
-                if dagNode.outputRange(output.name, variableSubstitution=False):
-                    vss = variables.present(dagNode.outputRange(output.name, variableSubstitution=False)[0])
-                    vss2 = variables.present(dagNode.outputRange(output.name, variableSubstitution=False)[1])
-                singleDollarList += vps[0] + vss[0] + vss2[0]
-                doubleDollarList += vps[1] + vss[1] + vss2[1]
-        return (list(set(singleDollarList)), list(set(doubleDollarList)))
+        of all the double-dollar variables used by the given dag node.
+        """
+        return self.dag.variablesUsed(dagNode)
         
 
     def dagNodesSanityCheck(self, dagNodes):
@@ -714,10 +798,9 @@ class MainWindow(QtGui.QMainWindow):
             for input in dagNode.inputs():
                 if not input.seqRange:
                     continue
-                inputRange = (int(input.seqRange[0]), int(input.seqRange[1]))
-                incomingDataPacket = self.dag.nodeInputDataPacket(dagNode, input)
-                incomingRange = incomingDataPacket.sequenceRange
-                if inputRange[0] < incomingRange[0] or inputRange[1] > incomingRange[1]:
+                inputFrames = util.FrameSet.fromRange(*input.seqRange)
+                incomingFrames = self.dag.nodeInputDataPacket(dagNode, input).frameSet() or util.FrameSet()
+                if not inputFrames.issubset(incomingFrames):
                     (outputNode, output) = self.dag.nodeInputComesFromNode(dagNode, input)
                     raise RuntimeError("Input range of node '%s' input '%s' extends beyond the bounds of output from node '%s' output '%s'" % 
                                        (dagNode.name, input.name, outputNode.name, output.name))
@@ -761,13 +844,14 @@ class MainWindow(QtGui.QMainWindow):
         # Insure all input and output ranges are identical in each dag group
         # NOTE: This check can be removed with some careful thought and changes in the execution engine.
         for groupName in self.dag.nodeGroupDict:
-            seqRange = None
+            groupFrames = None
             for dagNode in self.dag.nodeGroupDict[groupName]:
                 for output in dagNode.outputs():
-                    if not seqRange and output.getSeqRange():
-                        seqRange = (int(output.getSeqRange()[0]), int(output.getSeqRange()[1]))
+                    outputFrames = util.FrameSet.fromRange(*output.getSeqRange()) if output.getSeqRange() else None
+                    if groupFrames is None:
+                        groupFrames = outputFrames
                     else:
-                        if seqRange != (int(output.getSeqRange()[0]), int(output.getSeqRange()[1])):
+                        if groupFrames != outputFrames:
                             raise RuntimeError("Sequence ranges in group '%s' do not match.  Detection occurred on node '%s'." % (groupName, dagNode.name))
         
         # Insure no node is in two groups at once
@@ -779,19 +863,32 @@ class MainWindow(QtGui.QMainWindow):
     ###########################################################################
     ## Menu operations
     ###########################################################################
-    def open(self, filename):
+    def open(self, filename, fromVersionStore=False):
         """
-        Loads a snapshot, in the form of a json, file off disk and applies the
-        values it pulls to the currently active dependency graph.  Cleans up
-        the UI accordingly.
+        Loads a snapshot file (json or binary, see workflow_file) off disk and
+        applies the values it pulls to the currently active dependency graph.
+        A filename that only exists as a version in the version store next to
+        it is materialized from the store, as is any filename if 
+        fromVersionStore is set.  Cleans up the UI accordingly.
         """
-        if not os.path.exists(filename):
+        if not filename:
             return False
+        if not os.path.exists(filename) or fromVersionStore:
+            fromVersionStore = self.versionStoreFor(filename).hasVersion(os.path.basename(filename))
+            if not fromVersionStore and not os.path.exists(filename):
+                return False
+        self.waitForSave()
         
         # Load the snapshot off disk
-        with open(filename, 'rb') as fp:
-            snapshot = json.loads(fp.read())
+        if fromVersionStore:
+            snapshot = self.versionStoreFor(filename).materialize(os.path.basename(filename))
+        else:
+            snapshot = workflow_file.read(filename)
             
+        # The group boxes of the current workflow are rebuilt below
+        for key in self.dag.nodeGroupDict:
+            self.graphicsScene.removeExistingGroupBox(key)
+
         # Apply the data to the in-flight Dag
         self.dag.restoreSnapshot(snapshot["DAG"])
 
@@ -805,13 +902,19 @@ class MainWindow(QtGui.QMainWindow):
         # Variable substitutions
         self.clearVariableDictionary()
         for v in snapshot["DAG"]["VARIABLE_SUBSTITIONS"]:
-            variables.variableSubstitutions[v["NAME"]] = (v["VALUE"], False)
+            if v["NAME"] not in variables.names():
+                variables.add(v["NAME"])
+            variables.setx(v["NAME"], v["VALUE"])
 
         # The current session gets a variable representing the location of the current workflow
         if 'WORKFLOW_DIR' not in variables.names():
             variables.add('WORKFLOW_DIR')
         variables.setx('WORKFLOW_DIR', os.path.dirname(filename), readOnly=True)
 
+        # What is on disk, for journaled saves
+        self.savedSnapshot = snapshot
+        self.savedSnapshotFilename = filename
+
         # Additional meta-data loading
         if "RELOAD_PLUGINS_FILENAME_TEMP" in snapshot:
             filename = snapshot["RELOAD_PLUGINS_FILENAME_TEMP"]
@@ -821,7 +924,7 @@ class MainWindow(QtGui.QMainWindow):
         self.undoStack.setClean()
         self.workingFilename = filename
         self.setWindowTitle("Depends (%s)" % self.workingFilename)
-        self.variableWidget.rebuild(variables.variableSubstitutions)
+        self.variableWidget.rebuild(variables.substitutions())
         return True
 
         
@@ -837,20 +940,19 @@ class MainWindow(QtGui.QMainWindow):
                     self.save(self.workingFilename)
                 else:
                     self.saveAs()
-        filename, throwaway = QtGui.QFileDialog.getOpenFileName(self, caption='Open Workflow', filter="Workflow files (*.json)")
+        filename, throwaway = QtGui.QFileDialog.getOpenFileName(self, caption='Open Workflow', filter=workflow_file.FILE_DIALOG_FILTER)
         if not filename:
             return
         self.open(filename)
         
     
-    def save(self, filename, additionalFileDictionary=None):
+    def captureSnapshot(self, additionalFileDictionary=None):
         """
-        Functionality for writing snapshots of the software's running state
-        to a json file.  Modifies the UI accordingly.
+        Capture the software's running state as a full snapshot dictionary.
+        This is cheap, since unchanged node records are shared with earlier
+        snapshots, and it must happen on the GUI thread.  The snapshot can 
+        then be written out on a worker thread.
         """
-        if not filename:
-            return
-
         # Create a nested meta dict for saving node locations
         nodeMetaDict = self.graphicsScene.nodeMetaDict()
 
@@ -868,16 +970,183 @@ class MainWindow(QtGui.QMainWindow):
         fullSnap = {"DAG":snapshot}
         if additionalFileDictionary:
             fullSnap = dict({"DAG":snapshot}.items() + additionalFileDictionary.items())
+        return fullSnap
 
-        # Serialize to disk
-        fp = open(filename, 'wb')
-        fp.write(json.dumps(fullSnap, sort_keys=True, indent=4))
-        fp.close()
-        
-        # UI tidies
-        self.undoStack.setClean()
+
+    def save(self, filename, additionalFileDictionary=None):
+        """
+        Functionality for writing snapshots of the software's running state
+        to a json file, or a binary one if the filename ends in the binary 
+        workflow extension.  The snapshot is captured immediately, but it is
+        encoded and written on a worker thread; the UI is tidied once the 
+        write finishes (see saveFinished).  With journaled saves enabled, only
+        the changes since the last save to the same file are written.
+        """
+        if not filename:
+            return
+
+        # The journal base is whatever the last save left on disk, so any
+        # save still in flight has to land (and update it) first
+        self.waitForSave()
+        fullSnap = self.captureSnapshot(additionalFileDictionary)
+        writeFunction = workflow_file.write
+        if self.journaledSaveAction.isChecked() and not additionalFileDictionary:
+            journalBase = self.savedSnapshot if filename == self.savedSnapshotFilename else None
+            writeFunction = lambda f, snap: workflow_file.writeJournaled(f, snap, journalBase)
+        self.startSaveThread(filename, fullSnap, writeFunction, self.saveFinished, (self.historyGeneration, fullSnap, self.workingFilename))
         self.workingFilename = filename
-        self.setWindowTitle("Depends (%s)" % self.workingFilename)
+
+
+    def startSaveThread(self, filename, fullSnap, writeFunction, finishedFunction, finishedArgs=()):
+        """
+        Write a snapshot on a worker thread, calling the given function with 
+        the filename, an error string, and the extra arguments when done.  
+        Only one save runs at a time, so any save in progress is finished 
+        first.
+        """
+        self.waitForSave()
+        self.saveThread = WorkflowSaveThread(filename, fullSnap, writeFunction, finishedFunction, finishedArgs)
+        self.saveThread.saveFinished.connect(self.saveThreadFinished)
+        self.saveThread.start()
+
+
+    def saveThreadFinished(self, filename, error):
+        """
+        Hand the result of a background save to the function that asked for
+        it.  Runs on the GUI thread.
+        """
+        saveThread = self.sender()
+        saveThread.finishedFunction(filename, error, *saveThread.finishedArgs)
+
+
+    def waitForSave(self):
+        """
+        Block until the save in progress (if any) is on the disk, and deliver
+        its result.  The thread object is only released here, after it has
+        finished.
+        """
+        if self.saveThread:
+            self.saveThread.wait()
+            QtGui.qApp.processEvents()
+            self.saveThread = None
+
+
+    def saveFinished(self, filename, error, historyGeneration, fullSnap, previousWorkingFilename):
+        """
+        Tidy the UI after a save has been written.  The workflow is only 
+        marked clean if nothing has been done to it since the save started.
+        The history generation is compared rather than the undo index, since
+        an edit merged into the top undo command leaves the index unchanged.
+        A failed save hands the working filename back to the file that was 
+        being worked on before, so later saves don't go to the failed one.
+        """
+        if error:
+            # What is on disk is unknown, so the next journaled save starts over
+            self.savedSnapshot = None
+            if filename == self.workingFilename:
+                self.workingFilename = previousWorkingFilename
+                titleSuffix = "" if self.undoStack.isClean() else "*"
+                self.setWindowTitle("Depends (%s)%s" % (self.workingFilename, titleSuffix))
+            QtGui.QMessageBox.warning(self, "Save failed", "Could not save %s:\n%s" % (filename, error))
+            return
+        self.savedSnapshot = fullSnap
+        self.savedSnapshotFilename = filename
+        if filename != self.workingFilename:
+            return
+        if self.historyGeneration == historyGeneration:
+            self.undoStack.setClean()
+            self.autosaveGeneration = self.historyGeneration
+            self.removeAutosave()
+        titleSuffix = "" if self.undoStack.isClean() else "*"
+        self.setWindowTitle("Depends (%s)%s" % (self.workingFilename, titleSuffix))
+
+
+    def historyChanged(self, index):
+        """
+        Count changes to the undo history so autosave can tell whether 
+        anything happened since it last ran, and schedule the history to be
+        brought within its memory budget.  Rebuilding the history moves the
+        index about without changing anything, so it isn't counted.
+        """
+        if self.rebuildingHistory:
+            return
+        self.historyGeneration += 1
+        if not self.historyManagementPending:
+            self.historyManagementPending = True
+            QtCore.QTimer.singleShot(0, self.manageUndoHistory)
+
+
+    def manageUndoHistory(self):
+        """
+        Compress older undo commands, drop the oldest ones if the history is
+        over its memory budget, and report the memory the history uses.  Runs
+        outside of the undo stack's signals, since it may rebuild the stack.
+        """
+        self.historyManagementPending = False
+        undo_commands.compressHistory(self.undoStack, UNCOMPRESSED_UNDO_COMMANDS)
+        self.rebuildingHistory = True
+        try:
+            droppedCount = undo_commands.trimHistory(self.undoStack, self.undoBudgetMB * 1024 * 1024)
+        finally:
+            self.rebuildingHistory = False
+        message = "Undo history: %.1f MB of %d MB in %d steps" % (undo_commands.historySize(self.undoStack) / (1024.0 * 1024.0), self.undoBudgetMB, self.undoStack.count())
+        if droppedCount:
+            message += " (%d oldest steps dropped)" % droppedCount
+        self.statusBar().showMessage(message, 5000)
+
+
+    def undoBudgetDialog(self):
+        """
+        Ask for the memory budget of the undo history, in megabytes.
+        """
+        budget, ok = QtGui.QInputDialog.getInt(self, "Undo History Budget", "Memory budget (MB):", self.undoBudgetMB, 1, 65536)
+        if not ok:
+            return
+        self.undoBudgetMB = budget
+        self.manageUndoHistory()
+
+
+    def autosaveFilename(self):
+        """
+        The file unsaved changes are periodically written to.  It sits next
+        to the working file, or in the temp directory for untitled workflows.
+        """
+        if self.workingFilename:
+            (path, baseName) = os.path.split(self.workingFilename)
+            return os.path.join(path, ".%s.autosave%s" % (baseName, workflow_file.BINARY_EXTENSION))
+        return os.path.join(tempfile.gettempdir(), "depends_autosave_%d%s" % (os.getpid(), workflow_file.BINARY_EXTENSION))
+
+
+    def autosave(self):
+        """
+        Write the current workflow to its autosave file in the background.
+        Nothing is done if the workflow is saved, nothing has changed since 
+        the last autosave, or a save is still in progress.
+        """
+        if self.undoStack.isClean() or self.historyGeneration == self.autosaveGeneration:
+            return
+        if self.saveThread and self.saveThread.isRunning():
+            return
+        self.autosaveGeneration = self.historyGeneration
+        fullSnap = self.captureSnapshot()
+        self.startSaveThread(self.autosaveFilename(), fullSnap, workflow_file.write, self.autosaveFinished)
+
+
+    def autosaveFinished(self, filename, error):
+        """
+        Autosaves fail quietly, since the user didn't ask for them.
+        """
+        if error:
+            print "Autosave to %s failed: %s" % (filename, error)
+
+
+    def removeAutosave(self):
+        """
+        Remove the autosave file once the workflow itself has been saved.
+        """
+        autosaveFilename = self.autosaveFilename()
+        if os.path.exists(autosaveFilename):
+            os.remove(autosaveFilename)
         
         
     def saveAs(self):
@@ -885,7 +1154,7 @@ class MainWindow(QtGui.QMainWindow):
         Save the DAG to a filename pulled out of a file dialog.
         """
         currentDir = os.path.dirname(self.workingFilename)
-        filename, throwaway = QtGui.QFileDialog.getSaveFileName(self, caption='Save Workflow As', filter="Workflow files (*.json)", dir=currentDir)
+        filename, throwaway = QtGui.QFileDialog.getSaveFileName(self, caption='Save Workflow As', filter=workflow_file.FILE_DIALOG_FILTER, dir=currentDir)
         if not filename:
             return
         self.save(filename)
@@ -893,10 +1162,58 @@ class MainWindow(QtGui.QMainWindow):
 
     def saveVersionUp(self):
         """
-        Save the next version of the current file.
+        Save the next version of the current file.  If the version store is
+        enabled, the version is committed to the store next to the current
+        file rather than written out as a complete copy.
         """
         nextVersionFilename = util.nextFilenameVersion(self.workingFilename)
-        self.save(nextVersionFilename)
+        if self.versionStoreAction.isChecked():
+            self.commitVersion(nextVersionFilename)
+        else:
+            self.save(nextVersionFilename)
+
+
+    def versionStoreFor(self, filename):
+        """
+        Return the version store that versions of the given file live in.
+        The store is kept between calls since it remembers the hashes of the
+        node records it has seen.
+        """
+        store = version_store.storeForFilename(filename)
+        if not self.versionStore or self.versionStore.rootDirectory != store.rootDirectory:
+            self.versionStore = store
+        return self.versionStore
+
+
+    def commitVersion(self, filename):
+        """
+        Commit the current workflow to the version store under the given 
+        file's name, in the background.  The workflow can be opened again 
+        using that filename, even though no such file is written.
+        """
+        fullSnap = self.captureSnapshot()
+        store = self.versionStoreFor(filename)
+        writeFunction = lambda f, snap: store.commit(os.path.basename(f), snap)
+        self.startSaveThread(filename, fullSnap, writeFunction, self.saveFinished, (self.historyGeneration, fullSnap, self.workingFilename))
+        self.workingFilename = filename
+
+
+    def openVersionDialog(self):
+        """
+        Pick a version from the version store next to the current file and 
+        open it.
+        """
+        if not self.workingFilename:
+            return
+        store = self.versionStoreFor(self.workingFilename)
+        versionNames = store.versions()
+        if not versionNames:
+            QtGui.QMessageBox.information(self, "Notice", "No versions have been stored next to %s." % self.workingFilename)
+            return
+        versionName, ok = QtGui.QInputDialog.getItem(self, "Open Version", "Version:", list(reversed(versionNames)), 0, False)
+        if not ok:
+            return
+        self.open(os.path.join(os.path.dirname(self.workingFilename), versionName), fromVersionStore=True)
         
 
     def yesNoDialog(self, text):
@@ -918,26 +1235,32 @@ class MainWindow(QtGui.QMainWindow):
         self.saveSettings()
         args = QtGui.qApp.arguments()
         if not self.undoStack.isClean():
-            (osJunk, filename) = tempfile.mkstemp(prefix="dependsreload_", suffix=".json")
+            (osJunk, filename) = tempfile.mkstemp(prefix="dependsreload_", suffix=workflow_file.BINARY_EXTENSION)
     
             metaDict = {"RELOAD_PLUGINS_FILENAME_TEMP":self.workingFilename}
             self.save(filename, metaDict)
+            self.waitForSave()
     
             filenameIndexMinusOne = args.index('-workflow')
             args[filenameIndexMinusOne+1] = filename
         util.restartProgram(args)
         
     
-    def executeSelected(self, executeImmediately=False):
+    def executeSelected(self, executeImmediately=False, onlyMissing=False):
         """
-        Execute the selected node using self.dag.execute_up_to_node().
+        Execute the selected node using self.dag.execute_up_to_node(), or 
+        only what is missing from disk using 
+        self.dag.execute_missing_up_to_node().
         """
         selectedDagNodes = self.selectedDagNodes()
         if len(selectedDagNodes) > 1 or not selectedDagNodes:
             # TODO: Status bar warning/message
             return
 
-        self.dag.execute_up_to_node(selectedDagNodes[0])
+        if onlyMissing:
+            self.dag.execute_missing_up_to_node(selectedDagNodes[0])
+        else:
+            self.dag.execute_up_to_node(selectedDagNodes[0])
 
 
     def deleteSelectedNodes(self):
@@ -1016,7 +1339,7 @@ class MainWindow(QtGui.QMainWindow):
         """
         actionList = list()
         for tipe in node.dagNodeTypes():
-            menuAction = QtGui.QAction(tipe().typeStr(), self, triggered=self.createNodeFromMenuStub)
+            menuAction = QtGui.QAction(tipe.typeStr(), self, triggered=self.createNodeFromMenuStub)
             menuAction.setData((tipe, None))
             actionList.append(menuAction)
         return actionList
@@ -0,0 +1,277 @@
+#
+# Depends
+# Copyright (C) 2014 by Andrew Gardner & Jonas Unger.  All rights reserved.
+# BSD license (LICENSE.txt for details).
+#
+
+import os
+import sys
+import json
+import Queue
+import hashlib
+import threading
+
+import util
+
+
+"""
+Checksum manifests of the files DataPackets refer to, for caching and
+integrity checks.  A manifest is a dictionary keyed by filename, holding a
+(size, mtime, hash) tuple for each file, or None for files missing from disk.
+
+Files are hashed in a pool of threads with large reads; hashlib and file reads
+both release the interpreter lock, so the threads really do run side by side.
+Hashes are remembered in a hidden sidecar file in each directory, keyed by
+name, size, and modification time, so files that haven't changed are never
+read again:
+
+    <directory>/.depends_checksums    - JSON {name: [size, mtime, hash]}
+"""
+
+
+###########################################################################
+###########################################################################
+SIDECAR_FILENAME = ".depends_checksums"
+
+HASH_ALGORITHM = "sha1"
+
+# Bytes read from a file at a time while hashing
+READ_SIZE = 8 * 1024 * 1024
+
+DEFAULT_THREAD_COUNT = 4
+
+
+def hashFile(filename, readSize=READ_SIZE):
+    """
+    Return the hex digest of a file's contents.
+    """
+    digest = hashlib.new(HASH_ALGORITHM)
+    with open(filename, 'rb') as fp:
+        while True:
+            data = fp.read(readSize)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def fileStat(filename):
+    """
+    Return a (size, mtime) tuple for a file, or None if it doesn't exist.
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime)
+
+
+def hashFiles(filenames, threadCount=DEFAULT_THREAD_COUNT):
+    """
+    Hash the given files in a pool of threads.  Returns a dictionary of hex
+    digests keyed by filename, holding None for files that can't be read.
+    Any other error in a worker stops the pool and is raised again here.
+    """
+    digests = dict()
+    errors = list()
+    queue = Queue.Queue()
+    for filename in filenames:
+        queue.put(filename)
+
+    def worker():
+        while not errors:
+            try:
+                filename = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                digests[filename] = hashFile(filename)
+            except (IOError, OSError):
+                digests[filename] = None
+            except:
+                errors.append(sys.exc_info())
+                return
+
+    threads = [threading.Thread(target=worker) for i in range(max(1, min(threadCount, queue.qsize())))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        (errorType, errorValue, errorTraceback) = errors[0]
+        raise errorType, errorValue, errorTraceback
+    return digests
+
+
+###########################################################################
+## Sidecar cache
+###########################################################################
+class ChecksumCache(object):
+    """
+    The hashes stored in the sidecar files of any number of directories.
+    Sidecars are read the first time a directory is asked about, and only
+    the changed ones are written by save().  All methods may be called from
+    any thread.
+    """
+
+    def __init__(self):
+        """
+        """
+        self._lock = threading.Lock()
+
+        # Directory -> {name: (size, mtime, hash)}
+        self._sidecars = dict()
+        self._dirtyDirectories = set()
+
+
+    def _sidecar(self, directory):
+        """
+        Return the sidecar dictionary of a directory, reading it if needed.
+        Unreadable or malformed sidecars are treated as empty.
+        """
+        sidecar = self._sidecars.get(directory)
+        if sidecar is None:
+            sidecar = dict()
+            try:
+                with open(os.path.join(directory, SIDECAR_FILENAME), 'r') as fp:
+                    for (name, entry) in json.loads(fp.read()).items():
+                        sidecar[name] = tuple(entry)
+            except (IOError, OSError, ValueError, TypeError, AttributeError):
+                sidecar = dict()
+            self._sidecars[directory] = sidecar
+        return sidecar
+
+
+    def lookup(self, filename, stat):
+        """
+        Return the stored hash of a file if its (size, mtime) stat matches the
+        one it was hashed with, otherwise None.
+        """
+        (directory, name) = os.path.split(os.path.abspath(filename))
+        with self._lock:
+            entry = self._sidecar(directory).get(name)
+        if entry is None or (entry[0], entry[1]) != tuple(stat):
+            return None
+        return entry[2]
+
+
+    def store(self, filename, stat, digest):
+        """
+        Remember the hash of a file with the (size, mtime) stat it was hashed
+        with.
+        """
+        (directory, name) = os.path.split(os.path.abspath(filename))
+        with self._lock:
+            self._sidecar(directory)[name] = (stat[0], stat[1], digest)
+            self._dirtyDirectories.add(directory)
+
+
+    def save(self):
+        """
+        Write the sidecars of the directories with new hashes.  Directories
+        that can't be written to are skipped, as the cache is only a speedup.
+        """
+        with self._lock:
+            for directory in self._dirtyDirectories:
+                data = json.dumps(self._sidecars[directory], sort_keys=True)
+                try:
+                    util.writeFileAtomically(os.path.join(directory, SIDECAR_FILENAME), data)
+                except (IOError, OSError):
+                    pass
+            self._dirtyDirectories.clear()
+
+
+###########################################################################
+## Manifests
+###########################################################################
+def generateManifest(filenames, threadCount=DEFAULT_THREAD_COUNT, cache=None):
+    """
+    Return a manifest of the given files.  Hashes found in the sidecars
+    (or the given ChecksumCache) for files of the same size and mtime are
+    used as they are; the rest of the files are hashed in parallel and their
+    hashes saved to the sidecars.
+    """
+    if cache is None:
+        cache = ChecksumCache()
+    manifest = dict()
+    stats = dict()
+    for filename in filenames:
+        stat = fileStat(filename)
+        if stat is None:
+            manifest[filename] = None
+            continue
+        digest = cache.lookup(filename, stat)
+        if digest is None:
+            stats[filename] = stat
+        else:
+            manifest[filename] = (stat[0], stat[1], digest)
+
+    for (filename, digest) in hashFiles(stats.keys(), threadCount).items():
+        if digest is None:
+            manifest[filename] = None
+            continue
+        # A file changed while it was being hashed is reported, but not cached
+        stat = stats[filename]
+        if fileStat(filename) == stat:
+            cache.store(filename, stat, digest)
+        manifest[filename] = (stat[0], stat[1], digest)
+    cache.save()
+    return manifest
+
+
+def dataPacketManifest(dataPacket, threadCount=DEFAULT_THREAD_COUNT, cache=None):
+    """
+    Return a manifest of every file in every file descriptor of a DataPacket.
+    """
+    filenames = list()
+    for fdName in dataPacket.filenames:
+        if dataPacket.filenames[fdName]:
+            filenames.extend(dataPacket.fileDescriptorNamed(fdName).frames())
+    return generateManifest(filenames, threadCount, cache)
+
+
+def verifyManifest(manifest, fast=False, threadCount=DEFAULT_THREAD_COUNT):
+    """
+    Return a sorted list of the files in a manifest that no longer match it.
+    The fast mode only compares the size and mtime of each file; otherwise
+    every file is hashed again, ignoring the sidecars.
+    """
+    mismatched = list()
+    toHash = list()
+    for (filename, entry) in manifest.items():
+        stat = fileStat(filename)
+        if entry is None or stat is None:
+            if entry is not None or stat is not None:
+                mismatched.append(filename)
+        elif fast:
+            if tuple(stat) != (entry[0], entry[1]):
+                mismatched.append(filename)
+        elif stat[0] != entry[0]:
+            mismatched.append(filename)
+        else:
+            toHash.append(filename)
+
+    for (filename, digest) in hashFiles(toHash, threadCount).items():
+        if digest != manifest[filename][2]:
+            mismatched.append(filename)
+    return sorted(mismatched)
+
+
+def writeManifest(filename, manifest):
+    """
+    Write a manifest to disk as JSON.  The write is atomic, so an 
+    interrupted one never leaves a truncated manifest behind.
+    """
+    util.writeFileAtomically(filename, json.dumps({"ALGORITHM":HASH_ALGORITHM, "FILES":manifest}, sort_keys=True, indent=4))
+
+
+def readManifest(filename):
+    """
+    Read a manifest written by writeManifest().
+    """
+    with open(filename, 'r') as fp:
+        manifestDict = json.loads(fp.read())
+    if manifestDict.get("ALGORITHM") != HASH_ALGORITHM:
+        raise RuntimeError("Manifest %s was not hashed with %s." % (filename, HASH_ALGORITHM))
+    return dict((f, tuple(entry) if entry is not None else None) for (f, entry) in manifestDict["FILES"].items())
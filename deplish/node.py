@@ -9,6 +9,7 @@ import copy
 import uuid
 
 import util
+import registry
 import variables
 import data_packet
 
@@ -33,7 +34,15 @@ def dagNodeTypes():
     """
     Return a list of node types presently loaded.
     """
-    return DagNode.__subclasses__()
+    return registry.nodeTypes()
+
+
+def createNodeOfType(typeString, name=""):
+    """
+    Create a default-constructed node of a given type (string).  Raises a
+    RuntimeError if no plugin has registered the type.
+    """
+    return registry.nodeTypeNamed(typeString)(name=name)
 
 
 def cleanNodeName(name):
@@ -46,29 +55,104 @@ def cleanNodeName(name):
 
 ###############################################################################
 ###############################################################################
-class DagNodeAttribute(object):
+class PropertySchema(object):
     """
-    An attribute property of a DagNode.  These contain a name, default value,
-    a doc string, a potential custom file dialog specifier, and a flag stating
-    if it's a file type or not.  The data is stored as a string, so whatever
-    the user needs can be placed in here.
+    The constant description of a node property: its name, default value, 
+    documentation, and type information.  A single schema is shared by the 
+    property of that name in every node of a class.
     """
-    
-    def __init__(self, name, defaultValue, isFileType=False, docString=None, customFileDialogName=None):
+
+    __slots__ = ("name", "defaultValue", "docString", "customFileDialogName",
+                 "input", "output", "isFileType", "dataPacketType", "required")
+
+    def __init__(self, name, defaultValue, docString=None):
         """
         """
         self.name = name
-        self.value = defaultValue
-        self.seqRange = None
+        self.defaultValue = defaultValue
         self.docString = docString
-        self.customFileDialogName = customFileDialogName
-
-        # TODO: Implement usage of attribute as input and/or output (connect in graph)
+        self.customFileDialogName = None
         self.input = False
         self.output = False
+        self.isFileType = False
+        self.dataPacketType = None
+        self.required = False
 
-        # Constants, not written to disk
-        self.isFileType = isFileType
+
+def _schemaField(fieldName):
+    """
+    Return a read-only property forwarding to the given field of a property's
+    shared schema.
+    """
+    return property(lambda self: getattr(self.schema, fieldName))
+
+
+def _copyValue(value):
+    """
+    Return a copy of a property value that can be modified without touching
+    the original.  Strings and numbers are shared as-is.
+    """
+    if value is None or isinstance(value, (basestring, int, long, float, bool)):
+        return value
+    if type(value) is tuple and all(_copyValue(v) is v for v in value):
+        return value
+    if type(value) is dict:
+        return dict((k, _copyValue(v)) for (k, v) in value.items())
+    return copy.deepcopy(value)
+
+
+class DagNodeProperty(object):
+    """
+    The base of the node property classes.  Each property holds only its 
+    value and sequence range; everything else lives in a schema shared by 
+    all the nodes of a class.
+    """
+
+    # Nodes carry many of these, so they go without a per-instance dict
+    __slots__ = ("schema", "value", "seqRange")
+
+    name = _schemaField("name")
+    docString = _schemaField("docString")
+
+    def instantiate(self):
+        """
+        Return a new property sharing this one's schema, set to the default
+        value.
+        """
+        newProperty = object.__new__(type(self))
+        newProperty.schema = self.schema
+        newProperty.value = _copyValue(self.schema.defaultValue)
+        newProperty.seqRange = None
+        return newProperty
+
+
+    def clone(self):
+        """
+        Return a copy of this property sharing its schema.  Strings, numbers,
+        and tuples of them are shared with the original, since they can only
+        be replaced, never changed in-place; only containers are copied.
+        """
+        newProperty = object.__new__(type(self))
+        newProperty.schema = self.schema
+        newProperty.value = _copyValue(self.value)
+        newProperty.seqRange = _copyValue(self.seqRange)
+        return newProperty
+
+
+    def __copy__(self):
+        newProperty = object.__new__(type(self))
+        newProperty.schema = self.schema
+        newProperty.value = self.value
+        newProperty.seqRange = self.seqRange
+        return newProperty
+
+
+    def __deepcopy__(self, memo):
+        newProperty = object.__new__(type(self))
+        newProperty.schema = self.schema
+        newProperty.value = copy.deepcopy(self.value, memo)
+        newProperty.seqRange = copy.deepcopy(self.seqRange, memo)
+        return newProperty
 
 
     # TODO: Should my dictionary keys be more interesting?
@@ -78,6 +162,38 @@ class DagNodeAttribute(object):
         return (self.name) == (other.name)
 
 
+class DagNodeAttribute(DagNodeProperty):
+    """
+    An attribute property of a DagNode.  These contain a name, default value,
+    a doc string, a potential custom file dialog specifier, and a flag stating
+    if it's a file type or not.  The data is stored as a string, so whatever
+    the user needs can be placed in here.
+    """
+
+    __slots__ = ()
+
+    customFileDialogName = _schemaField("customFileDialogName")
+    input = _schemaField("input")
+    output = _schemaField("output")
+    isFileType = _schemaField("isFileType")
+    
+    def __init__(self, name, defaultValue, isFileType=False, docString=None, customFileDialogName=None):
+        """
+        """
+        self.schema = PropertySchema(name, defaultValue, docString)
+        self.schema.customFileDialogName = customFileDialogName
+
+        # TODO: Implement usage of attribute as input and/or output (connect in graph)
+        self.schema.input = False
+        self.schema.output = False
+
+        # Constants, not written to disk
+        self.schema.isFileType = isFileType
+
+        self.value = defaultValue
+        self.seqRange = None
+
+
 ###############################################################################
 ## Base class
 ###############################################################################
@@ -93,20 +209,37 @@ class DagNode(object):
     themselves.
     """
 
+    # Nodes whose output frames each depend only on the same input frames
+    # (embarrassingly parallel nodes) set this, and their execute() function
+    # then takes a frames argument holding the FrameSet to process.
+    framesIndependent = False
+
     def __init__(self, name="", nUUID=None):
         """
         """
+        # A cached, read-only dictionary describing this node for DAG snapshots
+        self._snapshotRecord = None
+
+        # Called with the node whenever it is modified (set by the owning DAG)
+        self.changeCallback = None
+
+        # A snapshot record whose property values have not been applied yet
+        self._pendingRecord = None
+
         self.set_name(name)
-        self._properties = dict()
+        self._propertyDict = dict()
+
+        # The property keys in the order they were defined, and the ordered 
+        # (attributes, inputs, outputs) tuples built from them on demand
+        self._propertyKeys = list()
+        self._propertyTables = None
         self.uuid = nUUID if nUUID else uuid.uuid4()
         
-        # Give the inputs, outputs, and attributes a place to live in the storage dict
-        for input in self._defineInputs():
-            self._properties[self._inputNameInPropertyDict(input.name)] = input
-        for output in self._defineOutputs():
-            self._properties[self._outputNameInPropertyDict(output.name)] = output
-        for attribute in self._defineAttributes():
-            self._properties[attribute.name] = attribute
+        # Give the inputs, outputs, and attributes a place to live in the storage dict.
+        # The properties are defined once per class, and each node gets fresh
+        # values sharing the class' schemas.
+        for (key, prototype) in registry.cachedPropertyPrototypes(type(self), self._propertyPrototypes):
+            self._setProperty(key, prototype.instantiate())
             
 
     def __str__(self):
@@ -149,6 +282,65 @@ class DagNode(object):
         return hash(self.uuid)
 
 
+    @property
+    def _properties(self):
+        """
+        The storage dict of inputs, outputs, and attributes.  If the node was
+        created from a snapshot record with deferred properties, the record's
+        values are applied the first time the dict is touched.
+        """
+        if self._pendingRecord is not None:
+            record = self._pendingRecord
+            self._pendingRecord = None
+            for kind in ("INPUTS", "OUTPUTS", "ATTRIBUTES"):
+                for propertyRecord in record[kind]:
+                    self.applyPropertyRecord(kind, propertyRecord)
+        return self._propertyDict
+
+
+    def _propertyPrototypes(self):
+        """
+        Return a list of (storage dict key, property) pairs for every input,
+        output, and attribute the node's class defines.  Only called for the
+        first node of each class; the rest instantiate the cached prototypes.
+        """
+        prototypes = list()
+        for input in self._defineInputs():
+            prototypes.append((self._inputNameInPropertyDict(input.name), input))
+        for output in self._defineOutputs():
+            prototypes.append((self._outputNameInPropertyDict(output.name), output))
+        for attribute in self._defineAttributes():
+            prototypes.append((attribute.name, attribute))
+        return prototypes
+
+
+    def _setProperty(self, key, propertyObject):
+        """
+        Store a property object in the storage dict under the given key.  All
+        additions to the dict must come through here, so the property tables
+        stay current.
+        """
+        if key not in self._propertyDict:
+            self._propertyKeys.append(key)
+        self._propertyDict[key] = propertyObject
+        self._propertyTables = None
+
+
+    def _tables(self):
+        """
+        Return the (attributes, inputs, outputs) tuples, in definition order,
+        building them the first time they are needed after a change.  The 
+        input and output flags of the attributes are taken to be constant.
+        """
+        properties = self._properties
+        if self._propertyTables is None:
+            attributes = tuple(properties[key] for key in self._propertyKeys if type(properties[key]) is DagNodeAttribute)
+            self._propertyTables = (attributes, 
+                                    tuple(attr for attr in attributes if attr.input),
+                                    tuple(attr for attr in attributes if attr.output))
+        return self._propertyTables
+
+
     def _inputNameInPropertyDict(self, inputName):
         """
         The property dict stores inputs with an interesting key.  Compute it.
@@ -170,9 +362,9 @@ class DagNode(object):
     ###########################################################################
     def inputs(self):
         """
-            Return a list of all attributes that behave as outputs
+            Return a tuple of all attributes that behave as inputs
         """
-        return [attr for attr in self.attributes() if attr.input]
+        return self._tables()[1]
 
     def in_connections(self, connections=True):
         """
@@ -197,9 +389,9 @@ class DagNode(object):
     ###########################################################################
     def outputs(self):
         """
-            Return a list of all attributes that behave as outputs
+            Return a tuple of all attributes that behave as outputs
         """
-        return [attr for attr in self.attributes() if attr.output]
+        return self._tables()[2]
 
     def out_connections(self, connections=True):
         """
@@ -228,13 +420,10 @@ class DagNode(object):
     ###########################################################################
     def attributes(self):
         """
-        Return a list of all attribute objects.
+        Return a tuple of all attribute objects, in the order they were 
+        defined.  The tuple is shared until the node's properties change.
         """
-        attributeList = list()
-        for x in self._properties:
-            if type(self._properties[x]) is DagNodeAttribute:
-                attributeList.append(self._properties[x])
-        return attributeList
+        return self._tables()[0]
 
 
     def set_attribute_value(self, attrName, value):
@@ -242,6 +431,7 @@ class DagNode(object):
         Set an attribute named the given name to the given string.
         """
         self.attribute_named(attrName).value = value
+        self.modified()
 
 
     def set_attribute_range(self, attrName, newRange):
@@ -250,6 +440,7 @@ class DagNode(object):
         tuple (string, string).
         """
         self.attribute_named(attrName).seqRange = newRange
+        self.modified()
 
 
     def attribute_named(self, attrName):
@@ -261,25 +452,27 @@ class DagNode(object):
         return self._properties[attrName]
 
 
-    def attribute_value(self, attrName, variableSubstitution=True):
+    def attribute_value(self, attrName, variableSubstitution=True, context=None):
         """
         Return a value string for the given attribute name.  Workflow variables
-        are substituted by default.
+        are substituted by default, from the given variables.VariableContext 
+        or the session's default context.
         """
         value = self.attribute_named(attrName).value
         if variableSubstitution:
-            value = variables.substitute(value)
+            value = variables.substitute(value, context)
         return value
 
 
-    def attribute_range(self, attrName, variableSubstitution=True):
+    def attribute_range(self, attrName, variableSubstitution=True, context=None):
         """
         Return a range tuple (string, string) for the given attribute name.  
-        Workflow variables are substituted by default.
+        Workflow variables are substituted by default, from the given 
+        variables.VariableContext or the session's default context.
         """
         seqRange = self.attribute_named(attrName).seqRange
         if variableSubstitution:
-            seqRange = (variables.substitute(seqRange[0]), variables.substitute(seqRange[1]))
+            seqRange = (variables.substitute(seqRange[0], context), variables.substitute(seqRange[1], context))
         return seqRange
 
 
@@ -291,12 +484,14 @@ class DagNode(object):
     ###########################################################################
     ## General
     ###########################################################################
-    def typeStr(self):
+    @classmethod
+    def typeStr(cls):
         """
-        Returns a human readable type string with CamelCaps->spaces.
+        Returns a human readable type string with CamelCaps->spaces.  Callable
+        on the class itself, so no node needs to be created to name its type.
         """
         # TODO: MAKE EXPLICIT!
-        return re.sub(r'(?!^)([A-Z]+)', r' \1', type(self).__name__[len('DagNode'):])
+        return re.sub(r'(?!^)([A-Z]+)', r' \1', cls.__name__[len('DagNode'):])
     
     
     def set_name(self, name):
@@ -306,22 +501,126 @@ class DagNode(object):
         """
         processedName = cleanNodeName(name)
         self.name = processedName
+        self.modified()
+
+
+    def modified(self):
+        """
+        Discard the cached snapshot record and tell the owning DAG, if any.
+        The node's own setters call this, but code that changes a property 
+        object directly must call it as well.
+        """
+        self._snapshotRecord = None
+        if self.changeCallback is not None:
+            self.changeCallback(self)
+
+
+    def snapshotRecord(self):
+        """
+        Return a dictionary describing this node's name, type, UUID, and the
+        values and ranges of its properties, as stored in a DAG snapshot.  The
+        record is built once and then shared by every snapshot taken until the
+        node is modified, so it must be treated as read-only.
+        """
+        if self._snapshotRecord is None:
+            self._snapshotRecord = {"NAME":self.name,
+                                    "TYPE":type(self).__name__,
+                                    "UUID":str(self.uuid),
+                                    "INPUTS":[{"NAME":x.name, "VALUE":copy.deepcopy(x.value), "RANGE":copy.deepcopy(x.seqRange)} for x in self.inputs()],
+                                    "OUTPUTS":[{"NAME":x.name, "VALUE":copy.deepcopy(x.value), "RANGE":copy.deepcopy(x.seqRange)} for x in self.outputs()],
+                                    "ATTRIBUTES":[{"NAME":x.name, "VALUE":copy.deepcopy(x.value), "RANGE":copy.deepcopy(x.seqRange)} for x in self.attributes()]}
+        return self._snapshotRecord
+
+
+    def applySnapshotRecord(self, record, deferProperties=False):
+        """
+        Set this node's name and property values from a snapshot record (see
+        snapshotRecord()).  The type and UUID in the record are not applied.
+        If deferProperties is set, the property values are only applied once
+        the node's properties are first accessed, and until then the record 
+        itself serves as the node's snapshot record.  This lets a lazily 
+        decoded record (see workflow_file) stay encoded until it is needed.
+        """
+        self.set_name(record["NAME"])
+        if deferProperties:
+            self._pendingRecord = record
+            self.modified()
+            self._snapshotRecord = record
+            return
+        self._pendingRecord = None
+        for kind in ("INPUTS", "OUTPUTS", "ATTRIBUTES"):
+            for propertyRecord in record[kind]:
+                self.applyPropertyRecord(kind, propertyRecord)
+
+
+    def applyPropertyRecord(self, kind, propertyRecord):
+        """
+        Set the value and range of a single property from its snapshot record.
+        The kind is the snapshot key the property is stored under ("INPUTS",
+        "OUTPUTS", or "ATTRIBUTES").
+        """
+        name = propertyRecord["NAME"]
+        if kind == "INPUTS":
+            self.setInputValue(name, propertyRecord["VALUE"])
+            self.setInputRange(name, propertyRecord["RANGE"])
+        elif kind == "OUTPUTS":
+            for subName in propertyRecord["VALUE"]:
+                self.setOutputValue(name, subName, propertyRecord["VALUE"][subName])
+            seqRange = propertyRecord["RANGE"]
+            self.setOutputRange(name, (seqRange[0], seqRange[1]) if seqRange else None)
+        elif kind == "ATTRIBUTES":
+            self.set_attribute_value(name, propertyRecord["VALUE"])
+            self.set_attribute_range(name, propertyRecord["RANGE"])
+        else:
+            raise RuntimeError("Unknown property kind %s in node %s." % (kind, self.name))
+        self.modified()
 
 
     def duplicate(self, nameExtension):
         """
         Return a duplicate of this node, but insure the parameters that need to be
-        different to co-exist in a DAG are different (name, uuid, etc)
+        different to co-exist in a DAG are different (name, uuid, etc).  The 
+        duplicate's properties share their schemas and unchanged values with 
+        this node's (see DagNodeProperty.clone()).  Input references are kept 
+        as-is; see DAG.cloneSubgraph() for remapping them.
         """
         dupe = type(self)(name=self.name+nameExtension)
-        for attribute in self.attributes():
-            dupe._properties[attribute.name] = copy.deepcopy(attribute)
-        for output in self.outputs():
-            fullOutputName = self._outputNameInPropertyDict(output.name)
-            dupe._properties[fullOutputName] = copy.deepcopy(output)
+        properties = self._properties
+        for key in self._propertyKeys:
+            dupe._setProperty(key, properties[key].clone())
+        dupe.modified()
         return dupe
 
 
+    def remapInputReferences(self, uuidMap):
+        """
+        Point every input referring to another node's output (a scenegraph
+        location string, ::UUID:OUTPUT) at the node whose UUID the given 
+        dictionary maps the old one to.  References to nodes missing from the
+        dictionary are cleared along with their ranges.  Attributes, and 
+        input values that aren't node references, are left alone.
+        """
+        for propertyObject in self._properties.values():
+            if not isinstance(propertyObject, DagNodeInput):
+                continue
+            value = propertyObject.value
+            if not isinstance(value, basestring) or not value.startswith("::"):
+                continue
+            pieces = value.split(":", 3)
+            if len(pieces) != 4 or not pieces[3]:
+                continue
+            try:
+                sourceUUID = uuid.UUID(pieces[2])
+            except ValueError:
+                continue
+            if sourceUUID in uuidMap:
+                propertyObject.value = "::%s:%s" % (str(uuidMap[sourceUUID]), pieces[3])
+            else:
+                propertyObject.value = ""
+                propertyObject.seqRange = None
+        self.modified()
+
+
     def input_requirements_fulfilled(self, dataPackets):
         """
         Determine if all the data necessary to run is present.
@@ -440,24 +739,30 @@ def loadChildNodesFromPaths(pathList):
         nodeClassDict = util.allClassesOfInheritedTypeFromDir(path, DagNode)
         for nc in nodeClassDict:
             globals()[nc] = nodeClassDict[nc]
+            registry.registerNodeType(nc, nodeClassDict[nc])
 
-class DagNodeInput(object):
+class DagNodeInput(DagNodeProperty):
     """
     An input property of a DagNode.  Contains the datapacket type is accepts,
     a flag denoting if it's required or not, a name, and documentation.
     """
 
+    __slots__ = ()
+
+    dataPacketType = _schemaField("dataPacketType")
+    required = _schemaField("required")
+
     def __init__(self, name, dataPacketType, required, docString=None):
         """
         """
-        self.name = name
+        self.schema = PropertySchema(name, "", docString)
+
+        # Constants, not written to disk
+        self.schema.dataPacketType = dataPacketType
+        self.schema.required = required
+
         self.value = ""
         self.seqRange = None
-        self.docString = docString
-        
-        # Constants, not written to disk
-        self.dataPacketType = dataPacketType
-        self.required = required
     
     
     def allPossibleInputTypes(self):
@@ -466,19 +771,10 @@ class DagNodeInput(object):
         This is interesting because inputs can accept DataPakcets of a type
         that is inherited from its base type.
         """
-        inputTypeList = set([self.dataPacketType])
-        inputTypeList |= set(util.allClassChildren(self.dataPacketType))
-        return inputTypeList
+        return registry.classAndDescendants(self.dataPacketType)
         
 
-    # TODO: Should my dictionary keys be more interesting?
-    def __hash__(self):
-        return hash(self.name)
-    def __eq__(self, other):
-        return (self.name) == (other.name)
-
-
-class DagNodeOutput(object):
+class DagNodeOutput(DagNodeProperty):
     """
     An output property of a DagNode.  Contains its data packet type, a doc
     string, a name, and potentially a string containing a custom file dialog
@@ -486,37 +782,34 @@ class DagNodeOutput(object):
     must contain the exact number of files as the rest of the sub-outputs, thus
     a single sequence range is present for an entire output.
     """
+
+    __slots__ = ()
+
+    customFileDialogName = _schemaField("customFileDialogName")
+    dataPacketType = _schemaField("dataPacketType")
     
     def __init__(self, name, dataPacketType, docString=None, customFileDialogName=None):
         """
         """
-        self.name = name
-        self.value = dict()
-        self.seqRange = None
-        self.docString = docString
-        self.customFileDialogName = customFileDialogName
+        # Note: We add the largest possible set of attributes this node can have from 
+        #       its datapacket and all the datapacket's children types
+        defaultValue = dict((fdName, "") for fdName in registry.allFileDescriptorNames(dataPacketType))
+
+        self.schema = PropertySchema(name, defaultValue, docString)
+        self.schema.customFileDialogName = customFileDialogName
 
         # Constants, not written to disk
-        self.dataPacketType = dataPacketType
+        self.schema.dataPacketType = dataPacketType
 
-        # Note: We add the largest possible set of attributes this node can have from 
-        #       its datapacket and all the datapacket's children types
-        allPossibleFileDescriptorNames = set()
-        for tipe in self.allPossibleOutputTypes():
-            for fdName in data_packet.filenameDictForDataPacketType(tipe):
-                allPossibleFileDescriptorNames.add(fdName)
-        for fdName in allPossibleFileDescriptorNames:
-            self.value[fdName] = ""
-            self.seqRange = None
+        self.value = dict(defaultValue)
+        self.seqRange = None
 
 
     def allPossibleOutputTypes(self):
         """
         Returns a list of all type data packet types this node can output.
         """
-        outputTypeList = set([self.dataPacketType])
-        outputTypeList |= set(util.allClassChildren(self.dataPacketType))
-        return outputTypeList
+        return registry.classAndDescendants(self.dataPacketType)
 
 
     def subOutputNames(self):
@@ -540,10 +833,3 @@ class DagNodeOutput(object):
         if self.seqRange[0] == "" or self.seqRange[1] == "":
             return None
         return self.seqRange
-        
-
-    # TODO: Should my dictionary keys be more interesting?
-    def __hash__(self):
-        return hash(self.name)
-    def __eq__(self, other):
-        return (self.name) == (other.name)
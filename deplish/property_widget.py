@@ -4,9 +4,13 @@
 # BSD license (LICENSE.txt for details).
 #
 
+import os
+
 from PySide import QtCore, QtGui
 
 import node
+import util
+import variables
 import data_packet
 import file_dialog
 
@@ -38,6 +42,11 @@ class GeneralEdit(QtGui.QWidget):
         QtGui.QWidget.__init__(self, parent)
 
         self.customFileDialogName = customFileDialogName
+        self.isFileType = isFileType
+
+        # Set when the user types in the value field, so only their edits
+        # (and not values set from the node) look for sequences on disk
+        self.valueEdited = False
 
         # The upper layout holds the label, the value, and the "expand" button
         upperLayout = QtGui.QHBoxLayout()
@@ -101,6 +110,8 @@ class GeneralEdit(QtGui.QWidget):
         self.lineEdit.editingFinished.connect(lambda: self.valueChanged.emit(self.label.text(), self.lineEdit.text(), node.DagNodeAttribute))
         self.rangeStart.editingFinished.connect(lambda: self.rangeChanged.emit(self.label.text(), (self.rangeStart.text(), self.rangeEnd.text()), node.DagNodeAttribute))
         self.rangeEnd.editingFinished.connect(lambda: self.rangeChanged.emit(self.label.text(), (self.rangeStart.text(), self.rangeEnd.text()), node.DagNodeAttribute))
+        self.lineEdit.textEdited.connect(self.valueEditedByUser)
+        self.lineEdit.editingFinished.connect(self.valueEditingFinished)
         self.expandButton.pressed.connect(self.expandButtonPressed)
         self.fileDialogButton.pressed.connect(self.fileDialogButtonPressed)
 
@@ -123,6 +134,40 @@ class GeneralEdit(QtGui.QWidget):
         self.rangeEnd.setText(seqRange[1] if seqRange[1] else "")
         
     
+    def valueEditedByUser(self, text):
+        """
+        Note that the user has typed in the value field.
+        """
+        self.valueEdited = True
+
+
+    def valueEditingFinished(self):
+        """
+        Look for a sequence on disk once the user is done editing the value.
+        """
+        if self.valueEdited:
+            self.valueEdited = False
+            self.fillRangeFromDisk()
+
+
+    def fillRangeFromDisk(self):
+        """
+        If the range fields are empty and the value is a filename containing 
+        frame symbols, fill the range in with the frames found on disk and 
+        emit its signal.
+        """
+        if not self.isFileType or self.rangeStart.text() or self.rangeEnd.text():
+            return
+        filename = variables.substitute(self.lineEdit.text())
+        if not util.framespec.hasFrameSymbols(os.path.basename(filename)):
+            return
+        (frames, padding, missing) = util.discoverSequence(filename)
+        if not frames:
+            return
+        self.setRange((str(frames.start()), str(frames.end())))
+        self.rangeChanged.emit(self.label.text(), (self.rangeStart.text(), self.rangeEnd.text()), node.DagNodeAttribute)
+
+
     def expandButtonPressed(self):
         """
         Show any additional information hidden by default.
@@ -148,6 +193,7 @@ class GeneralEdit(QtGui.QWidget):
         if not selectedFile:
             return
         self.setValue(selectedFile)
+        self.fillRangeFromDisk()
 
 
 ###############################################################################
@@ -510,6 +556,7 @@ class AttrEdit(GeneralEdit):
         if not selectedFile[0]:
             return
         self.setValue(selectedFile[0])
+        self.fillRangeFromDisk()
 
 
 ###############################################################################
@@ -0,0 +1,142 @@
+#
+# Depends
+# Copyright (C) 2014 by Andrew Gardner & Jonas Unger.  All rights reserved.
+# BSD license (LICENSE.txt for details).
+#
+
+
+"""
+A holder for cached class hierarchy information, the dictionary of loaded
+node types, and functions to query them.  Walking a class' __subclasses__()
+tree or constructing a throwaway DataPacket to discover its file descriptors
+is comparatively expensive, and both are needed every time a node property is
+created.  The results are therefore computed once per class and kept here
+until plugins are (re)loaded, at which point invalidate() must be called since
+reloading a module creates new classes.
+"""
+
+
+###########################################################################
+###########################################################################
+# Cached descendant sets, keyed by class
+_descendantCache = dict()
+
+# Cached file descriptor dictionaries, keyed by DataPacket class
+_fileDescriptorCache = dict()
+
+# Cached union of file descriptor names for a DataPacket class and all its children
+_allFileDescriptorNamesCache = dict()
+
+# Property prototypes (schema shared by every instance), keyed by DagNode class
+_propertyPrototypeCache = dict()
+
+# DagNode classes keyed by their type name, filled in by plugin loading
+_nodeTypesByName = dict()
+
+
+###########################################################################
+## Class hierarchy
+###########################################################################
+def classDescendants(inputClass):
+    """
+    Return a frozenset of all a class' children and its childrens' children.
+    The base class itself is not included.
+    """
+    if inputClass in _descendantCache:
+        return _descendantCache[inputClass]
+    subclasses = set()
+    work = [inputClass]
+    while work:
+        parent = work.pop()
+        for child in parent.__subclasses__():
+            if child not in subclasses:
+                subclasses.add(child)
+                work.append(child)
+    _descendantCache[inputClass] = frozenset(subclasses)
+    return _descendantCache[inputClass]
+
+
+def classAndDescendants(inputClass):
+    """
+    Return a frozenset containing the given class and all of its descendants.
+    """
+    return classDescendants(inputClass) | frozenset([inputClass])
+
+
+###########################################################################
+## DataPacket file descriptors
+###########################################################################
+def fileDescriptorDict(dataPacketType):
+    """
+    Return a copy of the default fileDescriptor dict for a given DataPacket
+    type.  The DataPacket is only constructed the first time a type is queried.
+    """
+    if dataPacketType not in _fileDescriptorCache:
+        _fileDescriptorCache[dataPacketType] = dict(dataPacketType(None, None).filenames)
+    return dict(_fileDescriptorCache[dataPacketType])
+
+
+def allFileDescriptorNames(dataPacketType):
+    """
+    Return a frozenset of every file descriptor name the given DataPacket type
+    or any of its descendants can contain.
+    """
+    if dataPacketType not in _allFileDescriptorNamesCache:
+        names = set()
+        for tipe in classAndDescendants(dataPacketType):
+            names.update(fileDescriptorDict(tipe).keys())
+        _allFileDescriptorNamesCache[dataPacketType] = frozenset(names)
+    return _allFileDescriptorNamesCache[dataPacketType]
+
+
+###########################################################################
+## Node types
+###########################################################################
+def registerNodeType(typeName, nodeClass):
+    """
+    Register a DagNode class under the given type name.  Registering a name
+    a second time (reloading a plugin, for instance) replaces the old class.
+    """
+    _nodeTypesByName[typeName] = nodeClass
+
+
+def nodeTypeNamed(typeName):
+    """
+    Return the DagNode class registered under the given type name.
+    """
+    if typeName not in _nodeTypesByName:
+        raise RuntimeError("Node type '%s' is not loaded in this session." % typeName)
+    return _nodeTypesByName[typeName]
+
+
+def nodeTypes():
+    """
+    Return a list of all registered DagNode classes, sorted by type name.
+    """
+    return [_nodeTypesByName[key] for key in sorted(_nodeTypesByName)]
+
+
+def cachedPropertyPrototypes(nodeClass, buildFunction):
+    """
+    Return the list of (key, prototype) property pairs of a DagNode class,
+    calling the given function to build them the first time the class is
+    asked for.
+    """
+    if nodeClass not in _propertyPrototypeCache:
+        _propertyPrototypeCache[nodeClass] = buildFunction()
+    return _propertyPrototypeCache[nodeClass]
+
+
+###########################################################################
+## Invalidation
+###########################################################################
+def invalidate():
+    """
+    Forget everything that has been cached.  Called whenever plugins are
+    loaded, since new classes may have joined any hierarchy.  Registered node
+    types are not cached information and are left alone.
+    """
+    _descendantCache.clear()
+    _fileDescriptorCache.clear()
+    _allFileDescriptorNamesCache.clear()
+    _propertyPrototypeCache.clear()
@@ -86,6 +86,9 @@ class SceneGraphWidget(QtGui.QWidget):
         rowCount = len([dp for dp in sceneGraph if dp.sourceNode != selectedDagNode])
         self.tableWidget.setRowCount(rowCount)
 
+        # Check the presence of every packet's data in one batch
+        dataPresent = data_packet.packetsDataPresent([dp for dp in sceneGraph if dp.sourceNode != selectedDagNode])
+
         index = 0
         for dataPacket in sceneGraph:
             if dataPacket.sourceNode == selectedDagNode:
@@ -128,7 +131,7 @@ class SceneGraphWidget(QtGui.QWidget):
             textWidget = DraggableTextWidget(dataPacket)
             
             textWidget.setTextFormat(QtCore.Qt.RichText)
-            colorString = "00aa00" if dataPacket.dataPresent() else "aa0000"
+            colorString = "00aa00" if dataPresent[dataPacket] else "aa0000"
             if disabled:
                 colorString = "868686"
             textWidget.setText("<html><font color=\"#%s\">&nbsp;%s</font> - %s</html>" % (colorString, dataPacket.typeStr(), data_packet.shorthandScenegraphLocationString(dataPacket)))
@@ -4,108 +4,631 @@
 # BSD license (LICENSE.txt for details).
 #
 
-from PySide import QtGui
+import time
+import uuid
+import zlib
+import cPickle
+
+import util
+
+from PySide import QtCore, QtGui
 
 
 """
 A collection of QUndoCommand objects that are managed by the QT undo manager.
+Rather than storing entire snapshots, the commands hold small delta objects.
+Each delta records one fine-grained change (a property, a node, an edge, a 
+group, or a node move) and knows how to apply and revert itself, so undoing 
+an edit only touches what the edit touched.
 """
 
 
 ###############################################################################
+## Deltas
 ###############################################################################
-class SceneOnlyUndoCommand(QtGui.QUndoCommand):
+class PropertyDelta(object):
     """
-    An undo command that only tracks the state of the user interface 
-    QGraphicsScene.  No internal dependency graph info is tracked here.
+    A change to the value and range of a single input, output, or attribute
+    of a node, or to the node's name (kind "NAME", with the names as values).
     """
-    
-    def __init__(self, oldSnap, newSnap, scene, parent=None):
+
+    def __init__(self, nodeUUID, kind, oldRecord, newRecord):
         """
         """
-        QtGui.QUndoCommand.__init__(self, parent)
-        self.scene = scene
-        self.oldSnap = oldSnap
-        self.newSnap = newSnap
-        self.first = True
-        
-    
-    def id(self):
+        self.nodeUUID = nodeUUID
+        self.kind = kind
+        self.oldRecord = oldRecord
+        self.newRecord = newRecord
+
+
+    def _set(self, dag, record):
         """
-        Required for commands that are capable of merging themselves.
+        Push the given property record into the in-flight dag node.
         """
-        return (0xbeef + 0x0000)
+        dagNode = dag.node(nUUID=self.nodeUUID)
+        if self.kind == "NAME":
+            dagNode.set_name(record)
+        else:
+            dagNode.applyPropertyRecord(self.kind, record)
+        return [dagNode]
 
 
-    def undo(self):
+    def apply(self, dag, scene):
+        return self._set(dag, self.newRecord)
+
+
+    def revert(self, dag, scene):
+        return self._set(dag, self.oldRecord)
+
+
+    def mergeKey(self):
         """
-        Restore the old state of the user interface.
+        Property deltas touching the same property of the same node merge.
         """
-        self.scene.restoreSnapshot(self.oldSnap)
-        
-        
-    def redo(self):
+        if self.kind == "NAME":
+            return ("PROPERTY", self.nodeUUID, self.kind)
+        return ("PROPERTY", self.nodeUUID, self.kind, self.newRecord["NAME"])
+
+
+    def mergedWith(self, later):
         """
-        Restore the new state of the user interface.
-        The 'first' flag is used to stifle a double-apply when the command is
-        first executed.
+        Return a delta spanning this change followed by a later one.
         """
-        if not self.first:
-            self.scene.restoreSnapshot(self.newSnap)
-        self.first = False
+        return PropertyDelta(self.nodeUUID, self.kind, self.oldRecord, later.newRecord)
+
+
+class NodeDelta(object):
+    """
+    The addition (or removal, if the removing flag is set) of a node, stored
+    as its snapshot record and its location in the scene.
+    """
+
+    def __init__(self, record, position, removing=False):
+        """
+        """
+        self.record = record
+        self.position = position if position else (0.0, 0.0)
+        self.removing = removing
+
+
+    def _add(self, dag, scene):
+        dagNode = dag.nodeFromSnapshotRecord(self.record)
+        dag.add_node(dagNode)
+        scene.addExistingDagNode(dagNode, QtCore.QPointF(*self.position))
+        return [dagNode]
+
+
+    def _remove(self, dag, scene):
+        dagNode = dag.node(nUUID=uuid.UUID(self.record["UUID"]))
+        scene.removeExistingDagNode(dagNode)
+        dag.remove_node(dagNode)
+        return list()
+
+
+    def apply(self, dag, scene):
+        if self.removing:
+            return self._remove(dag, scene)
+        return self._add(dag, scene)
+
+
+    def revert(self, dag, scene):
+        if self.removing:
+            return self._add(dag, scene)
+        return self._remove(dag, scene)
+
+
+class EdgeDelta(object):
+    """
+    The addition (or removal, if the removing flag is set) of a connection
+    between two nodes given by their UUID strings.
+    """
+
+    def __init__(self, fromUUID, toUUID, horizontalConnectionOffset=0.0, removing=False):
+        """
+        """
+        self.fromUUID = fromUUID
+        self.toUUID = toUUID
+        self.horizontalConnectionOffset = horizontalConnectionOffset
+        self.removing = removing
+
+
+    def _nodes(self, dag):
+        return (dag.node(nUUID=uuid.UUID(self.fromUUID)), dag.node(nUUID=uuid.UUID(self.toUUID)))
+
+
+    def _add(self, dag, scene):
+        (fromNode, toNode) = self._nodes(dag)
+        dag.connect_nodes(fromNode, toNode)
+        drawEdge = scene.addExistingConnection(fromNode, toNode)
+        drawEdge.horizontalConnectionOffset = self.horizontalConnectionOffset
+        drawEdge.adjust()
+        return [fromNode, toNode]
+
+
+    def _remove(self, dag, scene):
+        (fromNode, toNode) = self._nodes(dag)
+        scene.removeExistingConnection(fromNode, toNode)
+        dag.disconnect_nodes(fromNode, toNode)
+        return [fromNode, toNode]
+
+
+    def apply(self, dag, scene):
+        if self.removing:
+            return self._remove(dag, scene)
+        return self._add(dag, scene)
+
+
+    def revert(self, dag, scene):
+        if self.removing:
+            return self._add(dag, scene)
+        return self._remove(dag, scene)
+
+
+class GroupDelta(object):
+    """
+    A change to the membership of a node group, given as lists of node UUID
+    strings.  A membership of None means the group does not exist.
+    """
+
+    def __init__(self, name, oldUUIDs, newUUIDs):
+        """
+        """
+        self.name = name
+        self.oldUUIDs = oldUUIDs
+        self.newUUIDs = newUUIDs
+
+
+    def _set(self, dag, scene, uuids):
+        if self.name in dag.nodeGroupDict:
+            dag.removeNodeGroup(nameToRemove=self.name)
+            scene.removeExistingGroupBox(self.name)
+        if uuids is None:
+            return list()
+        dagNodes = [dag.node(nUUID=uuid.UUID(u)) for u in uuids]
+        dag.addNodeGroup(self.name, dagNodes)
+        scene.addExistingGroupBox(self.name, dagNodes)
+        return dagNodes
+
+
+    def apply(self, dag, scene):
+        return self._set(dag, scene, self.newUUIDs)
+
+
+    def revert(self, dag, scene):
+        return self._set(dag, scene, self.oldUUIDs)
+
+
+class MoveDelta(object):
+    """
+    A node moving from one location in the scene to another.
+    """
+
+    def __init__(self, nodeUUID, oldPosition, newPosition):
+        """
+        """
+        self.nodeUUID = nodeUUID
+        self.oldPosition = oldPosition
+        self.newPosition = newPosition
+
+
+    def _set(self, dag, scene, position):
+        dagNode = dag.node(nUUID=self.nodeUUID)
+        scene.drawNode(dagNode).setPos(QtCore.QPointF(*position))
+        return list()
+
+
+    def apply(self, dag, scene):
+        return self._set(dag, scene, self.newPosition)
+
+
+    def revert(self, dag, scene):
+        return self._set(dag, scene, self.oldPosition)
+
+
+    def mergeKey(self):
+        """
+        Moves of the same node merge.
+        """
+        return ("MOVE", self.nodeUUID)
+
+
+    def mergedWith(self, later):
+        """
+        Return a delta spanning this move followed by a later one.
+        """
+        return MoveDelta(self.nodeUUID, self.oldPosition, later.newPosition)
+
+
+def _metaPosition(nodeMetaDict, uuidString):
+    """
+    Recover an (x, y) location tuple from a snapshot's node meta dictionary.
+    """
+    if not nodeMetaDict or uuidString not in nodeMetaDict:
+        return None
+    nodeMeta = nodeMetaDict[uuidString]
+    return (float(nodeMeta.get('locationX', 0.0)), float(nodeMeta.get('locationY', 0.0)))
+
+
+def _metaConnectionOffset(connectionMetaDict, fromUUID, toUUID):
+    """
+    Recover a draw edge's horizontal offset from a snapshot's connection meta
+    dictionary.
+    """
+    connectionString = "%s|%s" % (fromUUID, toUUID)
+    if not connectionMetaDict or connectionString not in connectionMetaDict:
+        return 0.0
+    return float(connectionMetaDict[connectionString].get('horizontalConnectionOffset', 0.0))
+
+
+def snapshotDeltas(oldSnap, newSnap):
+    """
+    Return the list of deltas that turn the state described by one snapshot
+    into the state described by another, in the order they must be applied.
+    The deltas are built from util.dagSnapshotChanges(), so the cost is 
+    dominated by what actually changed.
+    """
+    changes = util.dagSnapshotChanges(oldSnap, newSnap)
+
+    # Connections that disappear or change their offset
+    keptEdges = set()
+    if changes["CONNECTION_META"]:
+        keptEdges = set((e["FROM"], e["TO"]) for e in oldSnap["EDGES"]) - set(changes["EDGES_REMOVED"])
+    movedEdges = list()
+    for connectionString in changes["CONNECTION_META"]:
+        key = tuple(connectionString.split("|"))
+        if key in keptEdges:
+            if _metaConnectionOffset(oldSnap["CONNECTION_META"], *key) != _metaConnectionOffset(newSnap["CONNECTION_META"], *key):
+                movedEdges.append(key)
+    edgeRemovals = list()
+    edgeAdditions = list()
+    for key in changes["EDGES_REMOVED"] + movedEdges:
+        edgeRemovals.append(EdgeDelta(key[0], key[1], _metaConnectionOffset(oldSnap["CONNECTION_META"], *key), removing=True))
+    for key in changes["EDGES_ADDED"] + movedEdges:
+        edgeAdditions.append(EdgeDelta(key[0], key[1], _metaConnectionOffset(newSnap["CONNECTION_META"], *key)))
+
+    # Groups are dissolved before any node goes away and formed after nodes arrive
+    groupRemovals = list()
+    groupAdditions = list()
+    for name, members in changes["GROUPS_REMOVED"].items():
+        groupRemovals.append(GroupDelta(name, members, None))
+    for name, members in changes["GROUPS_ADDED"].items():
+        groupAdditions.append(GroupDelta(name, None, members))
+    for name, (oldMembers, newMembers) in changes["GROUPS_MODIFIED"].items():
+        groupRemovals.append(GroupDelta(name, oldMembers, None))
+        groupAdditions.append(GroupDelta(name, None, newMembers))
+
+    # Nodes that come and go
+    nodeRemovals = list()
+    nodeAdditions = list()
+    for record in changes["NODES_REMOVED"]:
+        nodeRemovals.append(NodeDelta(record, _metaPosition(oldSnap["NODE_META"], record["UUID"]), removing=True))
+    for record in changes["NODES_ADDED"]:
+        nodeAdditions.append(NodeDelta(record, _metaPosition(newSnap["NODE_META"], record["UUID"])))
+    addedNodes = set(record["UUID"] for record in changes["NODES_ADDED"])
+
+    # Properties of nodes that stay
+    propertyChanges = list()
+    if changes["NODES_MODIFIED"]:
+        oldNodes = dict((n["UUID"], n) for n in oldSnap["NODES"])
+        newNodes = dict((n["UUID"], n) for n in newSnap["NODES"])
+    for uuidString, nodeChange in changes["NODES_MODIFIED"].items():
+        nodeUUID = uuid.UUID(uuidString)
+        if "NAME" in nodeChange:
+            propertyChanges.append(PropertyDelta(nodeUUID, "NAME", *nodeChange["NAME"]))
+        for kind in ("INPUTS", "OUTPUTS", "ATTRIBUTES"):
+            if kind not in nodeChange:
+                continue
+            oldProperties = dict((p["NAME"], p) for p in oldNodes[uuidString][kind])
+            newProperties = dict((p["NAME"], p) for p in newNodes[uuidString][kind])
+            for name in nodeChange[kind]:
+                if name in oldProperties and name in newProperties:
+                    propertyChanges.append(PropertyDelta(nodeUUID, kind, oldProperties[name], newProperties[name]))
+
+    # Locations of nodes that stay
+    moves = list()
+    for uuidString in changes["NODE_META"]:
+        if uuidString in addedNodes:
+            continue
+        oldPosition = _metaPosition(oldSnap["NODE_META"], uuidString)
+        newPosition = _metaPosition(newSnap["NODE_META"], uuidString)
+        if oldPosition and newPosition and oldPosition != newPosition:
+            moves.append(MoveDelta(uuid.UUID(uuidString), oldPosition, newPosition))
+
+    return edgeRemovals + groupRemovals + nodeRemovals + nodeAdditions + propertyChanges + moves + edgeAdditions + groupAdditions
 
 
 ###############################################################################
 ###############################################################################
-class DagAndSceneUndoCommand(QtGui.QUndoCommand):
+class DeltaUndoCommand(QtGui.QUndoCommand):
     """
-    An undo command that tracks the state of the user interface as well as the
-    state of the given dependency graph.
+    An undo command that stores only the deltas an edit made to the user
+    interface and dependency graph, applying and reverting just those.
+    Consecutive commands that move the same nodes, or edit properties of the
+    same nodes, merge into one if they arrive within MERGE_INTERVAL_SECONDS
+    of eachother.  Commands deep in the history can be compressed, and are
+    decompressed the next time they are needed.
     """
 
-    def __init__(self, oldSnap, newSnap, dag, scene, propertyWidget=None, parent=None):
+    # Commands arriving further apart than this do not merge
+    MERGE_INTERVAL_SECONDS = 10.0
+
+    def __init__(self, deltas, dag, scene, propertyWidget=None, parent=None):
         """
         """
         QtGui.QUndoCommand.__init__(self, parent)
+        self.deltas = deltas
         self.dag = dag
         self.scene = scene
         self.propertyWidget = propertyWidget
-        self.oldSnap = oldSnap
-        self.newSnap = newSnap
         self.first = True
-        
-    
+
+        # Set while the history is being rebuilt, so nothing gets applied
+        self.suppressed = False
+
+        # The pickled and compressed deltas, if compress() has been called
+        self.compressedDeltas = None
+        self.sizeCache = None
+        self.lastChangeTime = time.time()
+
+
+    @classmethod
+    def fromSnapshots(cls, oldSnap, newSnap, dag, scene, propertyWidget=None, parent=None):
+        """
+        Create a command from the snapshots taken before and after an edit.
+        Only the deltas between the two are kept.
+        """
+        return cls(snapshotDeltas(oldSnap, newSnap), dag, scene, propertyWidget, parent)
+
+
     def id(self):
         """
         Required for commands that are capable of merging themselves.
         """
-        return (0xbeef + 0x0002)
+        return (0xbeef + 0x0004)
 
 
-    def undo(self):
+    def clone(self):
+        """
+        Return a new, not yet applied command holding the same deltas.  Used
+        when the undo stack is rebuilt, since the stack owns its commands.
+        """
+        twin = DeltaUndoCommand(self.deltas, self.dag, self.scene, self.propertyWidget)
+        twin.compressedDeltas = self.compressedDeltas
+        twin.sizeCache = self.sizeCache
+        twin.lastChangeTime = self.lastChangeTime
+        twin.setText(self.text())
+        return twin
+
+
+    ###########################################################################
+    ## Memory
+    ###########################################################################
+    def _loadDeltas(self):
+        """
+        Return the list of deltas, decompressing them if need be.
+        """
+        if self.deltas is None:
+            self.deltas = cPickle.loads(zlib.decompress(self.compressedDeltas))
+            self.compressedDeltas = None
+            self.sizeCache = None
+        return self.deltas
+
+
+    def compress(self):
+        """
+        Replace the deltas with a compressed copy of themselves.
+        """
+        if self.deltas is None:
+            return
+        self.compressedDeltas = zlib.compress(cPickle.dumps(self.deltas, cPickle.HIGHEST_PROTOCOL))
+        self.deltas = None
+        self.sizeCache = None
+
+
+    def isCompressed(self):
+        """
+        Returns whether the deltas are currently compressed.
+        """
+        return self.deltas is None
+
+
+    def sizeEstimate(self):
+        """
+        Return an estimate of the bytes this command holds on to.  The size 
+        of the deltas is taken to be the size of their pickled form.  Node 
+        records shared with other commands or snapshots are counted in full.
+        """
+        if self.sizeCache is None:
+            if self.deltas is None:
+                self.sizeCache = len(self.compressedDeltas)
+            else:
+                self.sizeCache = len(cPickle.dumps(self.deltas, cPickle.HIGHEST_PROTOCOL))
+        return self.sizeCache
+
+
+    ###########################################################################
+    ## Merging
+    ###########################################################################
+    @staticmethod
+    def _mergeKeys(deltas):
+        """
+        Return a dict of merge key to delta for a list of deltas that can all
+        be merged, or None if any of them can't.
+        """
+        keys = dict()
+        for delta in deltas:
+            key = delta.mergeKey() if hasattr(delta, "mergeKey") else None
+            if key is None or key in keys:
+                return None
+            keys[key] = delta
+        return keys
+
+
+    def mergeWith(self, other):
+        """
+        Absorb a command that immediately follows this one if both only move
+        the same set of nodes, or both only edit properties of the same set of
+        nodes.  Called by the undo stack when the command is pushed.  The
+        command the stack was marked clean at never absorbs anything, or the
+        stack would still claim to be clean after the edit.
+        """
+        if not isinstance(other, DeltaUndoCommand) or self.suppressed or other.suppressed:
+            return False
+        undoStack = self.scene.undoStack()
+        if undoStack.index() == undoStack.cleanIndex():
+            return False
+        if other.lastChangeTime - self.lastChangeTime > self.MERGE_INTERVAL_SECONDS:
+            return False
+        if self.deltas is None:
+            return False
+        mine = self._mergeKeys(self.deltas)
+        theirs = self._mergeKeys(other._loadDeltas())
+        if not mine or not theirs:
+            return False
+        if set(k[0] for k in mine) != set(k[0] for k in theirs) or len(set(k[0] for k in mine)) != 1:
+            return False
+        if set(k[1] for k in mine) != set(k[1] for k in theirs):
+            return False
+        if mine.keys()[0][0] == "MOVE" and set(mine) != set(theirs):
+            return False
+
+        mergedDeltas = list()
+        for delta in self.deltas:
+            key = delta.mergeKey()
+            mergedDeltas.append(delta.mergedWith(theirs[key]) if key in theirs else delta)
+        mergedDeltas += [theirs[key] for key in theirs if key not in mine]
+        self.deltas = mergedDeltas
+        self.sizeCache = None
+        self.lastChangeTime = other.lastChangeTime
+        return True
+
+
+    ###########################################################################
+    ## Apply
+    ###########################################################################
+    def _refresh(self, affectedDagNodes):
         """
-        Restore the old state of the user interface and dependency graph.
-        Rebuild the property widget if it was provided as well.
+        Redraw the nodes the deltas touched and rebuild the property widget if
+        it was provided.
         """
-        self.dag.restoreSnapshot(self.oldSnap)
-        self.scene.restoreSnapshot(self.oldSnap)
+        self.scene.refreshDrawNodes([n for n in set(affectedDagNodes) if n in self.dag.network])
         if self.propertyWidget:
             selectedDrawNodes = self.scene.selectedItems()
             selectedDagNodes = [sdn.dagNode for sdn in selectedDrawNodes]
             self.propertyWidget.rebuild(self.dag, selectedDagNodes)
-        
-        
+
+
+    def undo(self):
+        """
+        Revert each delta, last one first.
+        """
+        if self.suppressed:
+            return
+        affectedDagNodes = list()
+        for delta in reversed(self._loadDeltas()):
+            affectedDagNodes += delta.revert(self.dag, self.scene)
+        self._refresh(affectedDagNodes)
+
+
     def redo(self):
         """
-        Restore the new state of the user interface and dependency graph.
-        Rebuild the property widget if it was provided as well.  The 'first' 
-        flag is used to stifle a double-apply when the command is first executed.
-        """
-        if not self.first:
-            self.dag.restoreSnapshot(self.newSnap)
-            self.scene.restoreSnapshot(self.newSnap)
-            if self.propertyWidget:
-                selectedDrawNodes = self.scene.selectedItems()
-                selectedDagNodes = [sdn.dagNode for sdn in selectedDrawNodes]
-                self.propertyWidget.rebuild(self.dag, selectedDagNodes)
+        Apply each delta in order.  The 'first' flag is used to stifle a 
+        double-apply when the command is first executed.
+        """
+        if not self.first and not self.suppressed:
+            affectedDagNodes = list()
+            for delta in self._loadDeltas():
+                affectedDagNodes += delta.apply(self.dag, self.scene)
+            self._refresh(affectedDagNodes)
         self.first = False
+
+
+###############################################################################
+## History management
+###############################################################################
+class _PlaceholderUndoCommand(QtGui.QUndoCommand):
+    """
+    A command that does nothing, used to manipulate the clean state of an
+    undo stack while it is rebuilt.
+    """
+
+    def undo(self):
+        pass
+
+
+    def redo(self):
+        pass
+
+
+def historyCommands(undoStack):
+    """
+    Return a list of every command on the given undo stack, oldest first.
+    """
+    return [undoStack.command(i) for i in range(undoStack.count())]
+
+
+def historySize(undoStack):
+    """
+    Return the estimated number of bytes held by an undo stack's commands.
+    """
+    return sum(c.sizeEstimate() for c in historyCommands(undoStack) if isinstance(c, DeltaUndoCommand))
+
+
+def compressHistory(undoStack, keepRecent):
+    """
+    Compress every command but the given number of most recent ones.
+    """
+    commands = historyCommands(undoStack)
+    for command in commands[:max(0, len(commands)-keepRecent)]:
+        if isinstance(command, DeltaUndoCommand) and not command.isCompressed():
+            command.compress()
+
+
+def trimHistory(undoStack, budget):
+    """
+    Drop the oldest commands from an undo stack until its estimated size is
+    at most three quarters of the given budget (in bytes), if it exceeds the
+    budget.  A QUndoStack can not drop commands from its bottom, so the 
+    stack is rebuilt from clones of the commands that are kept, with their
+    application suppressed.  Only applied commands are dropped, and at least
+    one is always kept.  Returns the number of commands dropped.
+    """
+    commands = historyCommands(undoStack)
+    if not all(isinstance(c, DeltaUndoCommand) for c in commands):
+        return 0
+    sizes = [c.sizeEstimate() for c in commands]
+    total = sum(sizes)
+    if total <= budget:
+        return 0
+    index = undoStack.index()
+    dropCount = 0
+    while total > budget * 0.75 and dropCount < index-1:
+        total -= sizes[dropCount]
+        dropCount += 1
+    if not dropCount:
+        return 0
+
+    clones = [c.clone() for c in commands[dropCount:]]
+    for clone in clones:
+        clone.suppressed = True
+    cleanIndex = undoStack.cleanIndex() - dropCount if undoStack.cleanIndex() >= dropCount else -1
+    undoStack.clear()
+
+    # If the clean state was dropped, make it unreachable.  Pushing onto a 
+    # stack whose clean index lies above its index discards the clean state.
+    if cleanIndex < 0:
+        undoStack.push(_PlaceholderUndoCommand())
+        undoStack.setClean()
+        undoStack.undo()
+
+    for (i, clone) in enumerate(clones):
+        if i == cleanIndex:
+            undoStack.setClean()
+        undoStack.push(clone)
+    if cleanIndex == len(clones):
+        undoStack.setClean()
+    undoStack.setIndex(index - dropCount)
+
+    for clone in clones:
+        clone.suppressed = False
+    return dropCount
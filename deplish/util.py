@@ -7,11 +7,17 @@
 import os
 import re
 import imp
+import bisect
 import sys
 import glob
+import stat
 import inspect
+import tempfile
+import itertools
+import threading
 
 import node
+import registry
 
 
 """
@@ -26,18 +32,10 @@ sequence manipulation are all present as well.
 ###############################################################################
 def allClassChildren(inputClass):
     """
-    Returns a list of all a class' children and its childrens' children, using
-    a while loop as its recursion method.
+    Returns a list of all a class' children and its childrens' children.  The
+    hierarchy walk is cached by the registry module.
     """
-    subclasses = set()
-    work = [inputClass]
-    while work:
-        parent = work.pop()
-        for child in parent.__subclasses__():
-            if child not in subclasses:
-                subclasses.add(child)
-                work.append(child)
-    return list(subclasses)
+    return list(registry.classDescendants(inputClass))
 
 
 def classTypeNamedFromModule(typeString, moduleName):
@@ -68,10 +66,13 @@ def allClassesOfInheritedTypeFromDir(fromDir, classType):
             print '    "%s"' % (str(err))
             print "Skipping..."
             continue
+        # The freshly loaded module may have added classes to the hierarchy
+        registry.invalidate()
+        classChildren = registry.classDescendants(classType)
         for x in inspect.getmembers(foo):
             name = x[0]
             data = x[1]
-            if type(data) is type and data in allClassChildren(classType):
+            if type(data) is type and data in classChildren:
                 returnDict[name] = data
     return returnDict
 
@@ -100,28 +101,130 @@ def namedFunctionFromPluginFile(filename, functionName):
     return None
 
 
+def _propertyChanges(oldProperties, newProperties):
+    """
+    Compare two lists of property records (as found under a node record's
+    INPUTS, OUTPUTS, or ATTRIBUTES key) and return a dictionary of property
+    name to the parts of the property that differ.  Each part ("VALUE" or
+    "RANGE") maps to an (old, new) tuple.  A property only present on one
+    side reports None for the other.
+    """
+    oldByName = dict((p["NAME"], p) for p in oldProperties)
+    newByName = dict((p["NAME"], p) for p in newProperties)
+    changes = dict()
+    for name in set(oldByName) | set(newByName):
+        oldProperty = oldByName.get(name)
+        newProperty = newByName.get(name)
+        if oldProperty == newProperty:
+            continue
+        propertyChange = dict()
+        for part in ("VALUE", "RANGE"):
+            oldPart = oldProperty[part] if oldProperty is not None else None
+            newPart = newProperty[part] if newProperty is not None else None
+            if oldPart != newPart or oldProperty is None or newProperty is None:
+                propertyChange[part] = (oldPart, newPart)
+        changes[name] = propertyChange
+    return changes
+
+
+def _dictChanges(oldDict, newDict):
+    """
+    Return a dictionary of every key whose value differs between two
+    dictionaries (either of which may be None), mapped to an (old, new) tuple.
+    A key only present on one side reports None for the other.
+    """
+    oldDict = oldDict or dict()
+    newDict = newDict or dict()
+    changes = dict()
+    for key in set(oldDict) | set(newDict):
+        if oldDict.get(key) != newDict.get(key):
+            changes[key] = (oldDict.get(key), newDict.get(key))
+    return changes
+
+
+def dagSnapshotChanges(snapshotLeft, snapshotRight):
+    """
+    Detect every difference between two DAG snapshots.  Both sides are indexed
+    by node UUID, edge endpoints, and group name, so the cost is linear in the
+    size of the snapshots, and node records shared between them are skipped
+    without being compared.  Returns a dictionary with the following keys:
+        NODES_ADDED / NODES_REMOVED - lists of node records.  A node whose
+            type changed is reported as removed and added.
+        NODES_MODIFIED - a dictionary of UUID string to the changes of that
+            node: "NAME" maps to an (old, new) tuple, and "INPUTS", "OUTPUTS",
+            and "ATTRIBUTES" map to property changes (see _propertyChanges).
+            Only the keys that changed are present.
+        EDGES_ADDED / EDGES_REMOVED - lists of (FROM, TO) UUID string tuples.
+        GROUPS_ADDED / GROUPS_REMOVED - dictionaries of group name to a sorted
+            list of member UUID strings.
+        GROUPS_MODIFIED - a dictionary of group name to an (old, new) tuple of
+            sorted member UUID string lists.
+        NODE_META / CONNECTION_META / VARIABLE_SUBSTITIONS - dictionaries of
+            key (UUID string, "FROM|TO" string, or variable name) to an
+            (old, new) tuple.
+    """
+    leftNodes = dict((n["UUID"], n) for n in snapshotLeft["NODES"])
+    rightNodes = dict((n["UUID"], n) for n in snapshotRight["NODES"])
+    changes = {"NODES_ADDED":list(),
+               "NODES_REMOVED":list(),
+               "NODES_MODIFIED":dict()}
+    for record in snapshotLeft["NODES"]:
+        otherRecord = rightNodes.get(record["UUID"])
+        if otherRecord is None or otherRecord["TYPE"] != record["TYPE"]:
+            changes["NODES_REMOVED"].append(record)
+    for record in snapshotRight["NODES"]:
+        otherRecord = leftNodes.get(record["UUID"])
+        if otherRecord is None or otherRecord["TYPE"] != record["TYPE"]:
+            changes["NODES_ADDED"].append(record)
+            continue
+        if otherRecord is record or otherRecord == record:
+            continue
+        nodeChange = dict()
+        if otherRecord["NAME"] != record["NAME"]:
+            nodeChange["NAME"] = (otherRecord["NAME"], record["NAME"])
+        for kind in ("INPUTS", "OUTPUTS", "ATTRIBUTES"):
+            propertyChanges = _propertyChanges(otherRecord[kind], record[kind])
+            if propertyChanges:
+                nodeChange[kind] = propertyChanges
+        changes["NODES_MODIFIED"][record["UUID"]] = nodeChange
+
+    leftEdges = set((e["FROM"], e["TO"]) for e in snapshotLeft["EDGES"])
+    rightEdges = set((e["FROM"], e["TO"]) for e in snapshotRight["EDGES"])
+    changes["EDGES_ADDED"] = sorted(rightEdges - leftEdges)
+    changes["EDGES_REMOVED"] = sorted(leftEdges - rightEdges)
+
+    leftGroups = dict((g["NAME"], sorted(g["NODES"])) for g in snapshotLeft["GROUPS"])
+    rightGroups = dict((g["NAME"], sorted(g["NODES"])) for g in snapshotRight["GROUPS"])
+    changes["GROUPS_ADDED"] = dict((k, rightGroups[k]) for k in rightGroups if k not in leftGroups)
+    changes["GROUPS_REMOVED"] = dict((k, leftGroups[k]) for k in leftGroups if k not in rightGroups)
+    changes["GROUPS_MODIFIED"] = dict((k, (leftGroups[k], rightGroups[k])) for k in leftGroups 
+                                      if k in rightGroups and leftGroups[k] != rightGroups[k])
+
+    changes["NODE_META"] = _dictChanges(snapshotLeft.get("NODE_META"), snapshotRight.get("NODE_META"))
+    changes["CONNECTION_META"] = _dictChanges(snapshotLeft.get("CONNECTION_META"), snapshotRight.get("CONNECTION_META"))
+    leftVariables = dict((v["NAME"], v["VALUE"]) for v in snapshotLeft.get("VARIABLE_SUBSTITIONS") or list())
+    rightVariables = dict((v["NAME"], v["VALUE"]) for v in snapshotRight.get("VARIABLE_SUBSTITIONS") or list())
+    changes["VARIABLE_SUBSTITIONS"] = _dictChanges(leftVariables, rightVariables)
+    return changes
+
+
 def dagSnapshotDiff(snapshotLeft, snapshotRight):
     """
     A function that detects differences in the "important" parts of a
     DAG snapshot.  Returns a tuple containing a list of modified nodes
-    and a list of modified edges).
-    """
-    modifiedNodes = list()
-    if snapshotLeft['NODES'] != snapshotRight['NODES']:
-        for node in snapshotRight['NODES']:
-            if node not in snapshotLeft['NODES']:
-                modifiedNodes.append(node['NAME'])
-        for node in snapshotLeft['NODES']:
-            if node not in snapshotRight['NODES']:
-                modifiedNodes.append(node['NAME'])
-    modifiedEdges = list()
-    if snapshotLeft['EDGES'] != snapshotRight['EDGES']:
-        for edge in snapshotRight['EDGES']:
-            if edge not in snapshotLeft['EDGES']:
-                modifiedEdges.append((edge['FROM'], edge['TO']))
-        for edge in snapshotLeft['EDGES']:
-            if edge not in snapshotRight['EDGES']:
-                modifiedEdges.append((edge['FROM'], edge['TO']))
+    and a list of modified edges).  See dagSnapshotChanges() for a more
+    detailed report.
+    """
+    changes = dagSnapshotChanges(snapshotLeft, snapshotRight)
+    modifiedNodes = [n["NAME"] for n in changes["NODES_ADDED"]]
+    modifiedNodes += [n["NAME"] for n in changes["NODES_REMOVED"]]
+    rightNames = dict((n["UUID"], n["NAME"]) for n in snapshotRight["NODES"])
+    for uuidString, nodeChange in changes["NODES_MODIFIED"].items():
+        if "NAME" in nodeChange:
+            modifiedNodes += list(nodeChange["NAME"])
+        else:
+            modifiedNodes.append(rightNames[uuidString])
+    modifiedEdges = changes["EDGES_ADDED"] + changes["EDGES_REMOVED"]
     return (modifiedNodes, modifiedEdges)
 
 
@@ -204,12 +307,616 @@ def generateUniqueNameSimiarToExisting(prefix, existingNames):
             return "%s%02d" % (prefix, nameIndices[i]+1)
     
 
+###############################################################################
+## File presence
+###############################################################################
+# The cache answering directory listing queries, if one is installed
+_directoryCache = None
+
+
+def setDirectoryCache(directoryCache):
+    """
+    Install an object with a listing(directory) method (such as a 
+    directory_cache.DirectoryCache) to answer directoryListing() queries, or
+    remove it by passing None.
+    """
+    global _directoryCache
+    _directoryCache = directoryCache
+
+
+def directoryListing(directory, listings=None):
+    """
+    Return a frozenset of the names in a directory, or an empty set if it 
+    can't be listed.  If a dictionary is given, listings are kept in it by
+    directory, so a batch of checks lists each directory only once.  The
+    installed directory cache is consulted before the disk.
+    """
+    if listings is not None and directory in listings:
+        return listings[directory]
+    if _directoryCache is not None:
+        names = _directoryCache.listing(directory)
+    else:
+        try:
+            names = frozenset(os.listdir(directory or os.curdir))
+        except OSError:
+            names = frozenset()
+    if listings is not None:
+        listings[directory] = names
+    return names
+
+
+def filesPresent(paths, listings=None):
+    """
+    Return the set of the given paths that exist on disk.  Rather than one
+    stat per path, the paths are grouped by directory and each directory is
+    listed once, which matters a great deal on network filesystems.  See 
+    directoryListing() for the optional listings dictionary.  Since only
+    names are compared, a broken symlink counts as present, where 
+    os.path.exists() would say it doesn't exist.
+    """
+    if listings is None:
+        listings = dict()
+    present = set()
+    for path in paths:
+        (directory, name) = os.path.split(path)
+        if name in directoryListing(directory, listings):
+            present.add(path)
+        elif not name and path and os.path.exists(path):
+            present.add(path)
+    return present
+
+
+def missingFiles(paths, listings=None):
+    """
+    Return a list of the given paths that do not exist on disk, in order.
+    See filesPresent().
+    """
+    present = filesPresent(paths, listings)
+    return [path for path in paths if path not in present]
+
+
+###############################################################################
+## File writing
+###############################################################################
+# The process umask, read once by processUmask()
+_umask = None
+_umaskLock = threading.Lock()
+
+
+def processUmask():
+    """
+    Return the process umask.  Linux reports it in /proc/self/status; 
+    elsewhere it can only be read by setting it, which briefly changes it 
+    for every thread of the process, so it is read a single time.
+    """
+    global _umask
+    with _umaskLock:
+        if _umask is None:
+            try:
+                with open("/proc/self/status", 'r') as fp:
+                    for line in fp:
+                        if line.startswith("Umask:"):
+                            _umask = int(line.split()[1], 8)
+                            break
+            except (IOError, ValueError, IndexError):
+                pass
+            if _umask is None:
+                _umask = os.umask(0)
+                os.umask(_umask)
+        return _umask
+
+
+def newFileMode(filename):
+    """
+    Temporary files are only readable by their owner.  Return the permission
+    bits the given file has, or would get if it were created normally.
+    """
+    if os.path.exists(filename):
+        return stat.S_IMODE(os.stat(filename).st_mode)
+    return 0666 & ~processUmask()
+
+
+def syncDirectory(dirname):
+    """
+    Flush a directory entry change (the rename of a freshly written file) to
+    the disk.  Not every platform can open a directory, in which case this
+    does nothing.
+    """
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def replaceFile(sourceFilename, destinationFilename):
+    """
+    Move a file over another one.  Windows refuses to rename over an
+    existing file, so the destination is removed first there.
+    """
+    if os.name == 'nt' and os.path.exists(destinationFilename):
+        os.remove(destinationFilename)
+    os.rename(sourceFilename, destinationFilename)
+
+
+def writeFileAtomically(filename, data):
+    """
+    Write a file next to its destination, flush it to the disk, and rename 
+    it into place, so a crash, a power loss, or an interrupted write never 
+    leaves a truncated file behind.  The data is either a string or a 
+    function that writes to the open (binary) file object it is given.
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    (fd, tempFilename) = tempfile.mkstemp(prefix=".%s." % os.path.basename(filename), dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            if callable(data):
+                data(fp)
+            else:
+                fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.chmod(tempFilename, newFileMode(filename))
+        replaceFile(tempFilename, filename)
+        syncDirectory(dirname)
+    except:
+        if os.path.exists(tempFilename):
+            os.remove(tempFilename)
+        raise
+
+
+###############################################################################
+## Frame sequences
+###############################################################################
+# Runs of unescaped frame symbols
+_frameSymbols = re.compile(r'((?<!\\)\#+)')
+
+# Compiled frame templates keyed by filename string, emptied when it grows
+# past _MAX_FRAME_TEMPLATES entries
+_frameTemplateCache = dict()
+_MAX_FRAME_TEMPLATES = 10000
+
+
+def compileFrameTemplate(fileString):
+    """
+    Return a str.format() template equivalent to a filename containing frame
+    symbols, where each run of #s is a zero padded field for the frame number
+    and escaped #s are plain # characters.  Templates are cached.
+    """
+    template = _frameTemplateCache.get(fileString)
+    if template is None:
+        pieces = list()
+        literalStart = 0
+        for match in _frameSymbols.finditer(fileString):
+            literal = fileString[literalStart:match.start()]
+            pieces.append(literal.replace('\#', '#').replace('{', '{{').replace('}', '}}'))
+            pieces.append("{0:0%dd}" % len(match.group(0)))
+            literalStart = match.end()
+        literal = fileString[literalStart:]
+        pieces.append(literal.replace('\#', '#').replace('{', '{{').replace('}', '}}'))
+        template = "".join(pieces)
+        if len(_frameTemplateCache) >= _MAX_FRAME_TEMPLATES:
+            _frameTemplateCache.clear()
+        _frameTemplateCache[fileString] = template
+    return template
+
+
+class FrameSet(object):
+    """
+    An immutable, sorted set of integer frame numbers, stored as a tuple of
+    (start, end, step) runs with inclusive ends.  Unlike a (start, end) 
+    range, a FrameSet can have holes, steps, and any number of intervals.
+    The string form is a comma separated list of runs, such as 
+    "1-100x2,150-200,300".
+
+    Runs are kept in a canonical form, so equal sets always have equal runs.
+    Stepped runs are only expanded frame by frame when they overlap another
+    run, or to take part in an intersection or difference, which work 
+    interval by interval.
+    """
+
+    __slots__ = ("_runs", "_offsets")
+
+    _runPattern = re.compile(r'^\s*(-?\d+)(?:\s*-\s*(-?\d+)(?:\s*[x:]\s*(\d+))?)?\s*$')
+
+    def __init__(self, runs=()):
+        """
+        Build a FrameSet from an iterable of (start, end, step) runs.  The 
+        runs may overlap and come in any order.
+        """
+        runs = [(int(r[0]), int(r[1]), int(r[2])) for r in runs]
+        for (start, end, step) in runs:
+            if step < 1 or end < start:
+                raise RuntimeError("Invalid frame run %d-%dx%d." % (start, end, step))
+        self._runs = FrameSet._canonicalRuns(FrameSet._disjointPieces(runs))
+
+        # The number of frames before each run, for indexing
+        offsets = list()
+        total = 0
+        for (start, end, step) in self._runs:
+            offsets.append(total)
+            total += (end - start) // step + 1
+        offsets.append(total)
+        self._offsets = tuple(offsets)
+
+
+    @staticmethod
+    def _runIntervals(runs):
+        """
+        Generate (start, end) intervals covering the given runs.  Stepped 
+        runs are expanded into one interval per frame.
+        """
+        for (start, end, step) in runs:
+            if step == 1:
+                yield (start, end)
+            else:
+                for frame in xrange(start, end+1, step):
+                    yield (frame, frame)
+
+
+    @staticmethod
+    def _mergeIntervals(intervals):
+        """
+        Return a sorted list of (start, end) intervals covering the given
+        ones, with overlapping and adjacent intervals merged.
+        """
+        merged = list()
+        for (start, end) in sorted(intervals):
+            if merged and start <= merged[-1][1] + 1:
+                if end > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], end)
+            else:
+                merged.append((start, end))
+        return merged
+
+
+    @staticmethod
+    def _disjointPieces(runs):
+        """
+        Return a sorted list of (start, end, step) runs holding the frames of
+        the given ones, none of which overlap.  Step 1 runs are merged, and
+        stepped runs are kept as they are unless their span overlaps another
+        run, in which case they are expanded frame by frame.
+        """
+        intervals = list()
+        stepped = list()
+        for (start, end, step) in runs:
+            end = start + (end - start) // step * step
+            if step == 1 or start == end:
+                intervals.append((start, end))
+            else:
+                stepped.append((start, end, step))
+
+        # Sweep the spans in order; a span starting before the furthest end
+        # seen so far overlaps the span reaching that far
+        spans = sorted([(start, end, i) for (i, (start, end, step)) in enumerate(stepped)] +
+                       [(start, end, None) for (start, end) in intervals])
+        overlapping = set()
+        (reach, reachOwner) = (None, None)
+        for (start, end, owner) in spans:
+            if reach is not None and start <= reach:
+                overlapping.update((owner, reachOwner))
+            if reach is None or end > reach:
+                (reach, reachOwner) = (end, owner)
+
+        pieces = list()
+        for (i, (start, end, step)) in enumerate(stepped):
+            if i in overlapping:
+                intervals.extend((frame, frame) for frame in xrange(start, end+1, step))
+            else:
+                pieces.append((start, end, step))
+        pieces.extend((start, end, 1) for (start, end) in FrameSet._mergeIntervals(intervals))
+        pieces.sort()
+        return pieces
+
+
+    @staticmethod
+    def _canonicalRuns(pieces):
+        """
+        Return the canonical tuple of runs for a sorted list of disjoint runs.
+        Walking the frames in order, consecutive frames form step 1 runs and
+        three or more frames spaced evenly further apart form stepped runs.
+        The walk skips over whole pieces whose step matches the run being 
+        followed, so large stepped runs are never expanded.
+        """
+        count = len(pieces)
+
+        def nextFrame(k, frame):
+            # The (piece index, frame) following a frame, or None at the end
+            if frame < pieces[k][1]:
+                return (k, frame + pieces[k][2])
+            if k + 1 < count:
+                return (k + 1, pieces[k+1][0])
+            return None
+
+        runs = list()
+        position = (0, pieces[0][0]) if pieces else None
+        while position is not None:
+            (k, frame) = position
+            following = nextFrame(k, frame)
+            if following is None:
+                runs.append((frame, frame, 1))
+                break
+            step = following[1] - frame
+            (lastK, last) = position
+            frames = 1
+            while True:
+                (start, end, pieceStep) = pieces[lastK]
+                if pieceStep == step and last < end:
+                    frames += (end - last) // step
+                    last = end
+                candidate = nextFrame(lastK, last)
+                if candidate is None or candidate[1] - last != step:
+                    break
+                (lastK, last) = candidate
+                frames += 1
+            if step != 1 and frames < 3:
+                runs.append((frame, frame, 1))
+                position = following
+            else:
+                runs.append((frame, last, step))
+                position = nextFrame(lastK, last)
+        return tuple(runs)
+
+
+    ###########################################################################
+    ## Construction
+    ###########################################################################
+    @classmethod
+    def fromString(cls, frameString):
+        """
+        Parse a string such as "1-100x2,150-200,300".  Raises a RuntimeError
+        if the string is malformed.
+        """
+        runs = list()
+        for item in frameString.split(','):
+            if not item.strip():
+                continue
+            match = cls._runPattern.match(item)
+            if not match:
+                raise RuntimeError("Malformed frame range '%s' in '%s'." % (item.strip(), frameString))
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) is not None else start
+            step = int(match.group(3)) if match.group(3) is not None else 1
+            runs.append((min(start, end), max(start, end), step))
+        return cls(runs)
+
+
+    @classmethod
+    def fromRange(cls, start, end, step=1):
+        """
+        Return the frames from start to end (inclusive), given as strings or
+        ints.  An incomplete range gives an empty set.
+        """
+        if start is None or end is None or start == "" or end == "":
+            return cls()
+        (start, end) = (int(start), int(end))
+        if end < start:
+            return cls()
+        return cls([(start, end, step)])
+
+
+    @classmethod
+    def fromFrames(cls, frames):
+        """
+        Return the set of the given frame numbers.
+        """
+        # Sorting plain ints and gathering consecutive frames is much faster
+        # than building a run per frame
+        intervals = list()
+        for frame in sorted(set(map(int, frames))):
+            if intervals and frame == intervals[-1][1] + 1:
+                intervals[-1][1] = frame
+            else:
+                intervals.append([frame, frame])
+        return cls((start, end, 1) for (start, end) in intervals)
+
+
+    ###########################################################################
+    ## Queries
+    ###########################################################################
+    def runs(self):
+        """
+        Return the canonical tuple of (start, end, step) runs.
+        """
+        return self._runs
+
+
+    def start(self):
+        """
+        Return the first frame, or None if the set is empty.
+        """
+        return self._runs[0][0] if self._runs else None
+
+
+    def end(self):
+        """
+        Return the last frame, or None if the set is empty.
+        """
+        return self._runs[-1][1] if self._runs else None
+
+
+    def isContiguous(self):
+        """
+        Returns whether the set is a single range without holes.
+        """
+        return len(self._runs) == 1 and (self._runs[0][2] == 1 or self._runs[0][0] == self._runs[0][1])
+
+
+    def __len__(self):
+        return self._offsets[-1]
+
+
+    def __nonzero__(self):
+        return bool(self._runs)
+
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(xrange(start, end+1, step) for (start, end, step) in self._runs)
+
+
+    def __contains__(self, frame):
+        index = bisect.bisect_right(self._runs, (frame, float('inf'), 0)) - 1
+        if index < 0:
+            return False
+        (start, end, step) = self._runs[index]
+        return frame <= end and (frame - start) % step == 0
+
+
+    def __getitem__(self, index):
+        """
+        Return the index'th frame of the set.
+        """
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("Frame index %d is out of range for frame set %s." % (index, str(self)))
+        runIndex = bisect.bisect_right(self._offsets, index) - 1
+        (start, end, step) = self._runs[runIndex]
+        return start + (index - self._offsets[runIndex]) * step
+
+
+    def __eq__(self, other):
+        if not isinstance(other, FrameSet):
+            return NotImplemented
+        return self._runs == other._runs
+
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+
+    def __hash__(self):
+        return hash(self._runs)
+
+
+    def __str__(self):
+        """
+        Format the set as a string fromString() can parse.
+        """
+        items = list()
+        for (start, end, step) in self._runs:
+            if start == end:
+                items.append("%d" % start)
+            elif step == 1:
+                items.append("%d-%d" % (start, end))
+            else:
+                items.append("%d-%dx%d" % (start, end, step))
+        return ",".join(items)
+
+
+    def __repr__(self):
+        return "FrameSet('%s')" % str(self)
+
+
+    ###########################################################################
+    ## Set operations
+    ###########################################################################
+    def _intervals(self):
+        """
+        Return the set as a list of (start, end) intervals.
+        """
+        return FrameSet._mergeIntervals(FrameSet._runIntervals(self._runs))
+
+
+    def union(self, other):
+        """
+        Return the frames in either set.
+        """
+        return FrameSet(self._runs + other._runs)
+
+
+    def intersection(self, other):
+        """
+        Return the frames in both sets.
+        """
+        (left, right) = (self._intervals(), other._intervals())
+        runs = list()
+        (i, j) = (0, 0)
+        while i < len(left) and j < len(right):
+            start = max(left[i][0], right[j][0])
+            end = min(left[i][1], right[j][1])
+            if start <= end:
+                runs.append((start, end, 1))
+            if left[i][1] < right[j][1]:
+                i += 1
+            else:
+                j += 1
+        return FrameSet(runs)
+
+
+    def difference(self, other):
+        """
+        Return the frames in this set that are not in the other.
+        """
+        (left, right) = (self._intervals(), other._intervals())
+        runs = list()
+        j = 0
+        for (start, end) in left:
+            while j < len(right) and right[j][1] < start:
+                j += 1
+            k = j
+            while start <= end and k < len(right) and right[k][0] <= end:
+                if right[k][0] > start:
+                    runs.append((start, right[k][0] - 1, 1))
+                start = max(start, right[k][1] + 1)
+                k += 1
+            if start <= end:
+                runs.append((start, end, 1))
+        return FrameSet(runs)
+
+
+    def issubset(self, other):
+        """
+        Returns whether every frame of this set is in the other.
+        """
+        return not self.difference(other)
+
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+
+    def chunks(self, chunkSize):
+        """
+        Generate FrameSets of up to chunkSize frames each, covering this set
+        in order.
+        """
+        if chunkSize < 1:
+            raise RuntimeError("Chunk size must be at least one frame.")
+        for index in xrange(0, len(self), chunkSize):
+            runs = list()
+            remaining = min(chunkSize, len(self) - index)
+            runIndex = bisect.bisect_right(self._offsets, index) - 1
+            position = index
+            while remaining:
+                (start, end, step) = self._runs[runIndex]
+                first = start + (position - self._offsets[runIndex]) * step
+                available = (end - first) // step + 1
+                taken = min(available, remaining)
+                runs.append((first, first + (taken - 1) * step, step))
+                remaining -= taken
+                position += taken
+                runIndex += 1
+            yield FrameSet(runs)
+
+
 class framespec(object):
     """
     This class defines a sequence of files on disk as a filename containing 
-    one or more "#" characters, a start frame integer, and an end frame integer.
-    It is valid to set a start frame or end frame to "None".  Escaping #s allows
-    them to pass through as # characters.
+    one or more "#" characters, a start frame integer, and an end frame integer,
+    or a FrameSet for sequences with holes or steps.  It is valid to set a 
+    start frame or end frame to "None".  Escaping #s allows them to pass 
+    through as # characters.
     This is done in the "Nuke" style, meaning the following substitutions will
     occur:
         FILENAME        FRAME NUM     RESULT
@@ -221,33 +928,113 @@ class framespec(object):
     
     def __init__(self, fileString, fileRange):
         """
+        The range may be a (start, end) tuple or a FrameSet.
         """
         self.filename = fileString
         self.startFrame = None
         self.endFrame = None
+        self.frameSet = None
         
-        if fileRange:
+        if isinstance(fileRange, FrameSet):
+            self.setFrameSet(fileRange)
+        elif fileRange:
             self.setFramerange(*fileRange)
 
 
     def setFramerange(self, startFrame, endFrame):
         """
-        Set the start and end frames given two strings or ints.
+        Set the start and end frames given two strings or ints.  Frame 0 is
+        a frame like any other; only None and empty strings mean no frame.
         """
-        self.startFrame = int(startFrame) if startFrame else None
-        self.endFrame = int(endFrame) if endFrame else None
+        self.startFrame = int(startFrame) if startFrame not in (None, "") else None
+        self.endFrame = int(endFrame) if endFrame not in (None, "") else None
+        self.frameSet = None
+        if self.startFrame is not None and self.endFrame is not None:
+            self.frameSet = FrameSet.fromRange(self.startFrame, self.endFrame)
+
+
+    def setFrameSet(self, frameSet):
+        """
+        Set the frames given a FrameSet, which may have holes and steps.  The
+        start and end frames become its first and last frame.
+        """
+        self.frameSet = frameSet if frameSet else None
+        self.startFrame = frameSet.start() if frameSet else None
+        self.endFrame = frameSet.end() if frameSet else None
         
 
+    def _template(self):
+        """
+        Return the compiled template of the filename.
+        """
+        return compileFrameTemplate(self.filename)
+
+
+    def isSequence(self):
+        """
+        Returns whether the framespec has a complete frame range.
+        """
+        return self.frameSet is not None
+
+
+    def frameNumbers(self):
+        """
+        Return the FrameSet of frame numbers this framespec object covers, or
+        None if it doesn't have a complete frame range.
+        """
+        return self.frameSet
+
+
+    def frame(self, frameNumber):
+        """
+        Return the filename of a single frame number.
+        """
+        return self._template().format(frameNumber)
+
+
+    def framesIter(self):
+        """
+        Return an iterator over the filenames this framespec object
+        represents, formatting each one as it is reached.
+        """
+        if not self.isSequence():
+            return iter([self.filename])
+        return itertools.imap(self._template().format, self.frameNumbers())
+
+
     def frames(self):
         """
         Return a complete list of filenames this framespec object represents.
         """
-        frameList = list()
-        if self.startFrame is None or self.endFrame is None:
+        if not self.isSequence():
             return [self.filename]
-        for i in range(self.startFrame, self.endFrame+1):
-            frameList.append(self.replaceFrameSymbols(self.filename, i))
-        return frameList
+        return map(self._template().format, self.frameNumbers())
+
+
+    def __iter__(self):
+        return self.framesIter()
+
+
+    def __len__(self):
+        if not self.isSequence():
+            return 1
+        return len(self.frameSet)
+
+
+    def __getitem__(self, index):
+        """
+        Return the filename of the index'th frame (not frame number), or a 
+        list of them for a slice.
+        """
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("Frame index %d is out of range for %s." % (index, self.filename))
+        if not self.isSequence():
+            return self.filename
+        return self.frame(self.frameSet[index])
 
 
     @staticmethod
@@ -256,11 +1043,7 @@ class framespec(object):
         Return a boolean stating whether or not the given string contains 
         known frame symbols ('#').
         """
-        matchObj = re.finditer(r'((?<!\\)\#+)', checkString)
-        i = next(matchObj, None)
-        if not i:
-            return False
-        return True
+        return _frameSymbols.search(checkString) is not None
         
 
     @staticmethod
@@ -271,12 +1054,67 @@ class framespec(object):
         padded to the number of #s.  Escaped #s with a backslash (\#) will be 
         replaced with a single # character in this function.
         """
-        matchObj = re.finditer(r'((?<!\\)\#+)', replaceString)
-        i = next(matchObj, None)
-        while i:
-            padString = "%s" % str(frameNumber).zfill(len(i.group(0)))
-            replaceString = replaceString[:i.start()] + padString + replaceString[i.end():]
-            matchObj = re.finditer(r'((?<!\\)\#+)', replaceString)
-            i = next(matchObj, None)
-        replaceString = replaceString.replace('\#', '#')
-        return replaceString
+        return compileFrameTemplate(replaceString).format(int(frameNumber))
+
+
+def _sequencePattern(fileString):
+    """
+    Return a regex matching the names a filename containing frame symbols 
+    can expand to, one name per line, with a group holding the digits of 
+    each run of #s.  A number may be wider than its run, so any padding 
+    matches.
+    """
+    pieces = list()
+    literalStart = 0
+    for match in _frameSymbols.finditer(fileString):
+        pieces.append(re.escape(fileString[literalStart:match.start()].replace('\#', '#')))
+        pieces.append(r'(-?\d+)')
+        literalStart = match.end()
+    pieces.append(re.escape(fileString[literalStart:].replace('\#', '#')))
+    return re.compile("^" + "".join(pieces) + "$", re.MULTILINE)
+
+
+def discoverSequence(fileString, listings=None):
+    """
+    Find the files on disk a filename containing frame symbols refers to, 
+    using a single listing of its directory.  Returns a tuple holding a 
+    FrameSet of the frames found, the frame padding they are written with, 
+    and a FrameSet of the frames missing between the first and last.  The 
+    padding comes from the files rather than the number of #s, so "img.#.exr"
+    finds img.0001.exr with a padding of 4; files written with any other 
+    padding are ignored.  Nothing found gives empty FrameSets and a padding 
+    of None.  See directoryListing() for the optional listings dictionary.
+    """
+    (directory, basename) = os.path.split(fileString)
+    if not framespec.hasFrameSymbols(basename):
+        raise RuntimeError("Filename '%s' has no frame symbols to discover a sequence from." % fileString)
+    pattern = _sequencePattern(basename)
+
+    # Matching every name in one pass over the joined listing keeps the work
+    # in the regex engine, which matters for directories of 100,000s of files
+    found = pattern.findall("\n".join(directoryListing(directory, listings)))
+    if pattern.groups > 1:
+        found = [digits[0] for digits in found if digits.count(digits[0]) == len(digits)]
+
+    # Frames found, keyed by the width they're written with; zero padded 
+    # numbers (and only they) pin down the padding exactly
+    paddedFrames = dict()
+    unpaddedFrames = list()
+    for number in found:
+        width = len(number)
+        if width > 1 and (number[0] == '0' or number[:2] == '-0') and number != '-0':
+            paddedFrames.setdefault(width, list()).append(number)
+        else:
+            unpaddedFrames.append(number)
+
+    if not paddedFrames and not unpaddedFrames:
+        return (FrameSet(), None, FrameSet())
+    if paddedFrames:
+        padding = max(paddedFrames, key=lambda width: len(paddedFrames[width]))
+    else:
+        padding = min(len(number) for number in unpaddedFrames)
+    frames = paddedFrames.get(padding, list())
+    frames.extend(number for number in unpaddedFrames if len(number) >= padding)
+    frameSet = FrameSet.fromFrames(frames)
+    missing = FrameSet.fromRange(frameSet.start(), frameSet.end()).difference(frameSet)
+    return (frameSet, padding, missing)
@@ -6,73 +6,317 @@
 
 import os
 import re
+import threading
 
 
 """
-A holder for the global workflow variable dictionary (variableSubstitutions)
-and functions to manipulate it.
+Workflow variables and functions to manipulate them.  Variables live in
+VariableContext objects, which may inherit the variables of a parent context.
+The session's variables are kept in defaultContext, and the module-level
+functions operate on it.  Other contexts can be created to evaluate several
+workflows, or several sets of variables, side by side in one process.
 """
 
 
 ###########################################################################
 ###########################################################################
-# A "static" dict of environment variables, each containing a tuple with 
-# the variable definition string and a "Read Only" boolean
-# TODO: It's likely someone should own this since it would enable multiple
-#       projects to be loaded at once, but this is a non-issue for now.
-variableSubstitutions = dict()
+# Single-dollar (workflow) and double-dollar (environment) variable references
+# that are neither escaped with a backslash nor part of a longer run of dollars
+_singleDollars = re.compile(r"((?<!\\)(?<!\$)\${1}(?!\$)[A-Z0-9_]*)")
+_doubleDollars = re.compile(r"((?<!\\)(?<!\$)\${2}(?!\$)[A-Z0-9_]*)")
+
+# Bumped every time a variable is added, set, or removed in any context
+_version = 0
+_versionLock = threading.Lock()
+
+# Compiled templates keyed by (dollar count, string)
+_templateCache = dict()
+
+# The caches are emptied when they grow past this many strings
+_MAX_CACHED_STRINGS = 10000
+
+
+###########################################################################
+## Templates
+###########################################################################
+def _compileTemplate(incomingString, dollarCount):
+    """
+    Split a string into a tuple alternating between literal text and the
+    names of the variables referenced with the given number of dollar signs
+    (literal, name, literal, ..., literal).  Templates are cached.
+    """
+    key = (dollarCount, incomingString)
+    template = _templateCache.get(key)
+    if template is None:
+        pattern = _singleDollars if dollarCount == 1 else _doubleDollars
+        pieces = list()
+        literalStart = 0
+        for match in pattern.finditer(incomingString):
+            pieces.append(incomingString[literalStart:match.start()])
+            pieces.append(match.group()[dollarCount:])
+            literalStart = match.end()
+        pieces.append(incomingString[literalStart:])
+        template = tuple(pieces)
+        if len(_templateCache) >= _MAX_CACHED_STRINGS:
+            _templateCache.clear()
+        _templateCache[key] = template
+    return template
+
+
+def _renderTemplate(template, dollarCount, lookup):
+    """
+    Join a compiled template back into a string, replacing each variable with
+    the value the given lookup function returns for its name.  Variables the
+    lookup returns None for are left as they were written.
+    """
+    if len(template) == 1:
+        return template[0]
+    pieces = list(template)
+    for i in range(1, len(pieces), 2):
+        name = pieces[i]
+        substitution = lookup(name)
+        pieces[i] = substitution if substitution is not None else "$" * dollarCount + name
+    return "".join(pieces)
+
+
+def _changed():
+    """
+    Note a change to a context's variables, so substitution results made with
+    the old values are no longer used.
+    """
+    global _version
+    with _versionLock:
+        _version += 1
+
+
+###########################################################################
+## Variable contexts
+###########################################################################
+class VariableContext(object):
+    """
+    A set of workflow variables, each holding a value string and a "Read
+    Only" boolean.  A context sees the variables of its parent (and the
+    parent's parent, and so on) unless it defines a variable of the same name
+    itself.  Setting an inherited variable defines it in the child only, so
+    child scopes cost nothing until they are written to.
+
+    Reading and substituting are safe from any number of threads.  Writers
+    replace the variable dictionary rather than changing it, so readers never
+    need to take the lock.
+    """
+
+    def __init__(self, parent=None):
+        """
+        """
+        self.parent = parent
+        self._variables = dict()
+        self._lock = threading.Lock()
+
+        # Substituted strings keyed by the incoming string, along with the
+        # variable version they were computed at
+        self._results = (_version, dict())
+
+
+    def child(self):
+        """
+        Return a new, empty context inheriting this one's variables.
+        """
+        return VariableContext(parent=self)
+
+
+    def _definition(self, variable):
+        """
+        Return the (value, readOnly) tuple of a variable defined here or in a
+        parent context, or None.
+        """
+        context = self
+        while context is not None:
+            definition = context._variables.get(variable)
+            if definition is not None:
+                return definition
+            context = context.parent
+        return None
+
+
+    def _lookup(self, variable):
+        """
+        Return the value of a variable, or None if it isn't defined.
+        """
+        definition = self._definition(variable)
+        return definition[0] if definition is not None else None
+
+
+    def _write(self, variable, definition):
+        """
+        Replace the variable dictionary with one where the given variable has
+        the given definition, or is missing if the definition is None.
+        """
+        newVariables = dict(self._variables)
+        if definition is None:
+            del newVariables[variable]
+        else:
+            newVariables[variable] = definition
+        self._variables = newVariables
+        _changed()
+
+
+    def add(self, variable):
+        """
+        Add a variable that doesn't exist in this context.
+        """
+        with self._lock:
+            if self._definition(variable) is not None:
+                raise RuntimeError("Variable %s already exists in substitution dictionary." % variable)
+            self._write(variable, ("", False))
+
+
+    def remove(self, variable):
+        """
+        Remove a variable defined in this context.  Variables inherited from
+        a parent context can only be removed from the parent.
+        """
+        with self._lock:
+            if variable not in self._variables:
+                if self._definition(variable) is not None:
+                    raise RuntimeError("Variable %s is inherited from a parent context and cannot be removed here." % variable)
+                raise RuntimeError("Variable %s does not exist in substitution dictionary." % variable)
+            self._write(variable, None)
+
+
+    def setx(self, variable, value, readOnly=False):
+        """
+        Set a variable that exists in this context to a given value.  Can
+        also set the "read only" bit while doing so.  (The function is named
+        'setx' to avoid conflicts with the built-in keyword 'set')
+        """
+        with self._lock:
+            if self._definition(variable) is None:
+                raise RuntimeError("Variable %s does not exist in substitution dictionary." % variable)
+            self._write(variable, (value, readOnly))
+
+
+    def substitutions(self):
+        """
+        Return a new dictionary of all the variables this context sees, each
+        containing a tuple with the value string and "Read Only" boolean.
+        """
+        chain = list()
+        context = self
+        while context is not None:
+            chain.append(context._variables)
+            context = context.parent
+        merged = dict()
+        for variables in reversed(chain):
+            merged.update(variables)
+        return merged
+
+
+    def names(self):
+        """
+        Return a list of all variables present.
+        """
+        return list(self.substitutions().keys())
+
+
+    def value(self, variable):
+        """
+        Return a variable's value if it exists.
+        """
+        definition = self._definition(variable)
+        if definition is None:
+            raise RuntimeError("Variable %s does not exist in substitution dictionary." % variable)
+        return definition[0]
+
+
+    def changeableList(self):
+        """
+        Returns a list of dictionaries containing the variable name and its
+        value for all variables that aren't read only.
+        """
+        variables = list()
+        substitutions = self.substitutions()
+        for v in substitutions:
+            if not substitutions[v][1]:
+                variables.append({"NAME":v,
+                                  "VALUE":substitutions[v][0]})
+        return variables
+
+
+    def substitute(self, incomingString):
+        """
+        Find and substitute all variables present in a given string.
+        Returns a new string.  Workflow ($) variables are substituted first,
+        and environment ($$) variables in the result after that, so variable
+        values may refer to the environment.  Results are cached until a
+        variable is changed; the environment is expected to stay put for the
+        session.
+        """
+        # A result computed while a variable changes lands in the stale dict
+        version = _version
+        (resultsVersion, results) = self._results
+        if resultsVersion != version:
+            results = dict()
+            self._results = (version, results)
+        newString = results.get(incomingString)
+        if newString is None:
+            newString = _renderTemplate(_compileTemplate(incomingString, 1), 1, self._lookup)
+            newString = _renderTemplate(_compileTemplate(newString, 2), 2, os.environ.get)
+            newString = newString.replace('\$', '$')
+            if len(results) >= _MAX_CACHED_STRINGS:
+                results.clear()
+            results[incomingString] = newString
+        return newString
 
 
 ###########################################################################
 ## Variable substitution
 ###########################################################################
+# The session's variables
+defaultContext = VariableContext()
+
+
 def add(variable):
     """
-    Add a variable that doesn't exist in variableSubstitutions.
+    Add a variable that doesn't exist in the default context.
     """
-    if variable not in variableSubstitutions:
-        variableSubstitutions.update({variable : ("", False)})
-    else:
-        raise RuntimeError("Variable %s already exists in substitution dictionary." % variable)
-    
-    
+    defaultContext.add(variable)
+
+
 def remove(variable):
     """
-    Remove a variable that exists in variableSubstitutions.
+    Remove a variable that exists in the default context.
     """
-    if variable in variableSubstitutions:
-        variableSubstitutions.pop(variable, None)
-    else:
-        raise RuntimeError("Variable %s does not exist in substitution dictionary." % variable)
-    
-    
+    defaultContext.remove(variable)
+
+
 def setx(variable, value, readOnly=False):
     """
-    Set a variable that exists in variableSubstituions to a given value.
-    Can also set the "read only" bit while doing so.  (The function is named 
-    'setx' to avoid conflicts with the built-in keyword 'set')
+    Set a variable that exists in the default context to a given value.
+    Can also set the "read only" bit while doing so.
+    """
+    defaultContext.setx(variable, value, readOnly)
+
+
+def substitutions():
+    """
+    Return a dictionary of the default context's variables, each containing a
+    tuple with the value string and "Read Only" boolean.
     """
-    if variable in variableSubstitutions:
-        variableSubstitutions.update({variable : (value, readOnly)})
-    else:
-        raise RuntimeError("Variable %s does not exist in substitution dictionary." % variable)
+    return defaultContext.substitutions()
 
 
 def names():
     """
     Return a list of all variables present.
     """
-    return list(variableSubstitutions.keys())
+    return defaultContext.names()
 
 
 def value(variable):
     """
     Return a variable's value if it exists.
     """
-    if variable in variableSubstitutions:
-        return variableSubstitutions[variable][0]
-    else:
-        raise RuntimeError("Variable %s does not exist in substitution dictionary." % variable)
+    return defaultContext.value(variable)
 
 
 def changeableList():
@@ -80,60 +324,24 @@ def changeableList():
     Returns a list of dictionaries containing the variable name and its value for all
     variables that aren't read only.
     """
-    variables = list()
-    for v in variableSubstitutions:
-        if not variableSubstitutions[v][1]:
-            variables.append({"NAME":v,
-                              "VALUE":variableSubstitutions[v][0]})
-    return variables
-    
+    return defaultContext.changeableList()
+
 
 def present(incomingString):
     """
-    Return a tuple containing a list of all single-dollar and a list of all 
+    Return a tuple containing a list of all single-dollar and a list of all
     double-dollar variables present in the given string.
     """
-    # Build a list of single-dollar-signed variables without duplicates
-    presentSingleList = list()
-    singleDollars = re.compile(r"((?<!\\)(?<!\$)\${1}(?!\$)[A-Z0-9_]*)")
-    for match in singleDollars.finditer(incomingString):
-        variableName = match.group()[1:]
-        presentSingleList.append(variableName)
-    presentSingleList = list(set(presentSingleList))
-
-    # Build a list of double-dollar-signed variables without duplicates
-    presentDoubleList = list()
-    doubleDollars = re.compile(r"((?<!\\)(?<!\$)\${2}(?!\$)[A-Z0-9_]*)")
-    for match in doubleDollars.finditer(incomingString):
-        variableName = match.group()[2:]
-        presentDoubleList.append(variableName)
-    presentDoubleList = list(set(presentDoubleList))
-
+    presentSingleList = list(set(_compileTemplate(incomingString, 1)[1::2]))
+    presentDoubleList = list(set(_compileTemplate(incomingString, 2)[1::2]))
     return (presentSingleList, presentDoubleList)
-    
-
-def substitute(incomingString):
-    """
-    Find and substitute all variables present in a given string.
-    Returns a new string.
-    """
-    newString = incomingString
-
-    # Replace all the single-dollar-signed strings with values from our variableSubstitution dictionary
-    singleDollars = re.compile(r"((?<!\\)(?<!\$)\${1}(?!\$)[A-Z0-9_]*)")
-    for match in singleDollars.finditer(newString):
-        variableName = match.group()[1:]
-        if variableName in variableSubstitutions:
-            substitution = variableSubstitutions[variableName][0]
-            newString = newString[:match.start()] + substitution + newString[match.end():]
-            
-    # Replace all the double-dollar-signed strings with values from our variableSubstitution dictionary
-    doubleDollars = re.compile(r"((?<!\\)(?<!\$)\${2}(?!\$)[A-Z0-9_]*)")
-    for match in doubleDollars.finditer(newString):
-        variableName = match.group()[2:]
-        if variableName in os.environ:
-            substitution = os.environ[variableName]
-            newString = newString[:match.start()] + substitution + newString[match.end():]
-
-    newString = newString.replace('\$', '$')
-    return newString
+
+
+def substitute(incomingString, context=None):
+    """
+    Find and substitute all variables present in a given string, using the
+    given context or the default one.  Returns a new string.
+    """
+    if context is None:
+        context = defaultContext
+    return context.substitute(incomingString)
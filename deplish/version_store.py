@@ -0,0 +1,209 @@
+#
+# Depends
+# Copyright (C) 2014 by Andrew Gardner & Jonas Unger.  All rights reserved.
+# BSD license (LICENSE.txt for details).
+#
+
+import os
+import json
+import zlib
+import hashlib
+import threading
+
+import util
+
+
+"""
+A local, content-addressed store of workflow versions.  Every node record is
+kept once, in a file named by the sha1 of its canonical JSON, so the hundreds
+of near-identical versions a workflow accumulates only cost the nodes that
+actually changed between them.  A version is a manifest holding the snapshot
+with each node record replaced by its UUID and hash.  The store lives in a
+hidden directory next to the workflow files:
+
+    .depends_versions/objects/ab/cdef...  - zlib compressed node records
+    .depends_versions/versions/<name>     - zlib compressed manifests
+"""
+
+
+###########################################################################
+###########################################################################
+STORE_DIRECTORY_NAME = ".depends_versions"
+
+
+def storeForFilename(filename):
+    """
+    Return the VersionStore that versions of the given workflow file live in.
+    """
+    return VersionStore(os.path.join(os.path.dirname(os.path.abspath(filename)), STORE_DIRECTORY_NAME))
+
+
+def _canonicalJson(record):
+    """
+    Return a record's JSON representation with sorted keys and no whitespace,
+    so equal records always hash the same.
+    """
+    return json.dumps(record, sort_keys=True, separators=(',', ':'))
+
+
+###########################################################################
+## Version store
+###########################################################################
+class VersionStore(object):
+    """
+    A directory of deduplicated node records and the version manifests that
+    reference them.  Node records are hashed once per record object, and
+    since snapshots share the records of unchanged nodes, committing a new
+    version costs roughly as much as the change since the previous one.
+    """
+
+    def __init__(self, rootDirectory):
+        """
+        """
+        self.rootDirectory = rootDirectory
+        self.objectDirectory = os.path.join(rootDirectory, "objects")
+        self.versionDirectory = os.path.join(rootDirectory, "versions")
+
+        # Hashes of the record objects in the last commit, keyed by id().  The
+        # record itself is kept alongside so its id cannot be reused.
+        self._recordHashes = dict()
+
+        # Decoded node records of the last materialized version, keyed by hash
+        self._objectCache = dict()
+        self._lock = threading.Lock()
+
+
+    def _objectFilename(self, objectHash):
+        """
+        Objects are spread over subdirectories named by the first two
+        characters of their hash.
+        """
+        return os.path.join(self.objectDirectory, objectHash[:2], objectHash[2:])
+
+
+    def _versionFilename(self, versionName):
+        """
+        Manifests are named by the version's name.
+        """
+        return os.path.join(self.versionDirectory, versionName)
+
+
+    def _storeRecord(self, record, recordHashes):
+        """
+        Write a node record to the object store if it isn't there already,
+        and return its hash.  The hash is remembered in the given dict.
+        """
+        cached = self._recordHashes.get(id(record))
+        if cached and cached[0] is record:
+            recordHashes[id(record)] = cached
+            return cached[1]
+        data = _canonicalJson(record.copy())
+        objectHash = hashlib.sha1(data).hexdigest()
+        objectFilename = self._objectFilename(objectHash)
+        if not os.path.exists(objectFilename):
+            if not os.path.exists(os.path.dirname(objectFilename)):
+                os.makedirs(os.path.dirname(objectFilename))
+            util.writeFileAtomically(objectFilename, zlib.compress(data))
+        recordHashes[id(record)] = (record, objectHash)
+        return objectHash
+
+
+    def _loadRecord(self, objectHash, objectCache):
+        """
+        Return the node record stored under the given hash, and remember it
+        in the given dict.
+        """
+        if objectHash in self._objectCache:
+            record = self._objectCache[objectHash]
+        else:
+            objectFilename = self._objectFilename(objectHash)
+            if not os.path.exists(objectFilename):
+                raise RuntimeError("Version store %s is missing object %s." % (self.rootDirectory, objectHash))
+            with open(objectFilename, 'rb') as fp:
+                record = json.loads(zlib.decompress(fp.read()))
+        objectCache[objectHash] = record
+        return record
+
+
+    def _loadManifest(self, versionName):
+        """
+        Return the manifest of the given version.
+        """
+        versionFilename = self._versionFilename(versionName)
+        if not os.path.exists(versionFilename):
+            raise RuntimeError("Version %s does not exist in version store %s." % (versionName, self.rootDirectory))
+        with open(versionFilename, 'rb') as fp:
+            return json.loads(zlib.decompress(fp.read()))
+
+
+    def commit(self, versionName, fullSnap):
+        """
+        Store a full snapshot as the given version, replacing any version of
+        the same name.  Only node records the store doesn't have yet are
+        written.
+        """
+        with self._lock:
+            if not os.path.exists(self.versionDirectory):
+                os.makedirs(self.versionDirectory)
+            manifest = dict((k, v) for (k, v) in fullSnap.items() if k not in ("DAG", "JOURNAL_ID"))
+            manifest["DAG"] = dict(fullSnap["DAG"])
+            recordHashes = dict()
+            manifest["DAG"]["NODES"] = [{"UUID":record["UUID"], "HASH":self._storeRecord(record, recordHashes)} for record in fullSnap["DAG"]["NODES"]]
+            util.writeFileAtomically(self._versionFilename(versionName), zlib.compress(_canonicalJson(manifest)))
+            self._recordHashes = recordHashes
+
+
+    def hasVersion(self, versionName):
+        """
+        Returns whether a version of the given name exists in the store.
+        """
+        return os.path.exists(self._versionFilename(versionName))
+
+
+    def versions(self):
+        """
+        Return a list of the names of all versions in the store, oldest first.
+        Hidden files, such as the temporary files util.writeFileAtomically()
+        leaves behind if it is interrupted, are not versions.
+        """
+        if not os.path.exists(self.versionDirectory):
+            return list()
+        names = [n for n in os.listdir(self.versionDirectory) if not n.startswith(".")]
+        return sorted(names, key=lambda n: (os.path.getmtime(self._versionFilename(n)), n))
+
+
+    def materialize(self, versionName):
+        """
+        Return the full snapshot stored as the given version.  Node records
+        shared with the previously materialized version are not decoded 
+        again.  The records must be treated as read-only.
+        """
+        with self._lock:
+            fullSnap = self._loadManifest(versionName)
+            objectCache = dict()
+            fullSnap["DAG"]["NODES"] = [self._loadRecord(entry["HASH"], objectCache) for entry in fullSnap["DAG"]["NODES"]]
+            self._objectCache = objectCache
+            self._recordHashes = dict((id(record), (record, objectHash)) for (objectHash, record) in objectCache.items())
+            return fullSnap
+
+
+    def diff(self, versionLeft, versionRight):
+        """
+        Compare two versions using their manifests alone, so no node record
+        is decoded.  Returns a dictionary of UUID string lists (NODES_ADDED,
+        NODES_REMOVED, NODES_MODIFIED) and (FROM, TO) tuple lists (EDGES_ADDED,
+        EDGES_REMOVED).  util.dagSnapshotChanges() can be used on the
+        materialized records of the modified nodes for the details.
+        """
+        with self._lock:
+            left = self._loadManifest(versionLeft)["DAG"]
+            right = self._loadManifest(versionRight)["DAG"]
+        leftHashes = dict((e["UUID"], e["HASH"]) for e in left["NODES"])
+        rightHashes = dict((e["UUID"], e["HASH"]) for e in right["NODES"])
+        leftEdges = set((e["FROM"], e["TO"]) for e in left["EDGES"])
+        rightEdges = set((e["FROM"], e["TO"]) for e in right["EDGES"])
+        return {"NODES_ADDED":sorted(set(rightHashes) - set(leftHashes)),
+                "NODES_REMOVED":sorted(set(leftHashes) - set(rightHashes)),
+                "NODES_MODIFIED":sorted(u for u in leftHashes if u in rightHashes and leftHashes[u] != rightHashes[u]),
+                "EDGES_ADDED":sorted(rightEdges - leftEdges),
+                "EDGES_REMOVED":sorted(leftEdges - rightEdges)}
@@ -0,0 +1,496 @@
+#
+# Depends
+# Copyright (C) 2014 by Andrew Gardner & Jonas Unger.  All rights reserved.
+# BSD license (LICENSE.txt for details).
+#
+
+import os
+import json
+import mmap
+import zlib
+import struct
+import uuid
+import threading
+
+import util
+
+
+"""
+Reading and writing of workflow files.  Two formats exist: the original
+(indented) JSON, which remains the interchange format, and a compact binary
+container meant for large workflows.  The binary layout is:
+
+    header     - magic, format version, node count, and the offset and
+                 length of the table and the skeleton (see HEADER_FORMAT)
+    node data  - one zlib compressed, compact JSON block per node, holding
+                 the node's INPUTS, OUTPUTS, and ATTRIBUTES
+    table      - (offset, length) of each node's block, in skeleton order
+    skeleton   - the zlib compressed, compact JSON snapshot with each node
+                 record reduced to its NAME, TYPE, and UUID
+
+Loading a binary file maps it into memory and decodes only the skeleton.  The
+node records it returns are LazyNodeRecords, which decode their block the
+first time a property list is requested.
+
+Either format can be paired with a journal (the filename plus JOURNAL_SUFFIX)
+for incremental saves.  A journaled base snapshot carries a JOURNAL_ID, and
+the journal holds the same id followed by a sequence of entries, each being
+the length and crc32 of a zlib compressed, compact JSON patch (see
+snapshotPatch).  Loading replays the patches onto the base, stopping at the
+first entry that is incomplete or fails its checksum.
+"""
+
+
+###########################################################################
+###########################################################################
+BINARY_EXTENSION = ".dwb"
+BINARY_MAGIC = "DPWB"
+BINARY_VERSION = 1
+
+# magic, version, node count, table offset, skeleton offset, skeleton length
+HEADER_FORMAT = "<4sHIQQQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# offset and length of a single node block
+TABLE_ENTRY_FORMAT = "<QI"
+TABLE_ENTRY_SIZE = struct.calcsize(TABLE_ENTRY_FORMAT)
+
+# Journal header (magic, version, journal id) and entry header (length, crc32)
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_MAGIC = "DPWJ"
+JOURNAL_VERSION = 1
+JOURNAL_HEADER_FORMAT = "<4sH32s"
+JOURNAL_HEADER_SIZE = struct.calcsize(JOURNAL_HEADER_FORMAT)
+JOURNAL_ENTRY_FORMAT = "<II"
+JOURNAL_ENTRY_SIZE = struct.calcsize(JOURNAL_ENTRY_FORMAT)
+
+# A journal is compacted into a new base once it grows past this fraction
+# of the base file's size
+JOURNAL_COMPACTION_RATIO = 0.5
+
+# File dialog filter covering both formats
+FILE_DIALOG_FILTER = "Workflow files (*.json *%s);;JSON workflow files (*.json);;Binary workflow files (*%s)" % (BINARY_EXTENSION, BINARY_EXTENSION)
+
+# The node record keys stored in the per-node blocks rather than the skeleton
+LAZY_KEYS = ("INPUTS", "OUTPUTS", "ATTRIBUTES")
+
+
+###########################################################################
+## Lazy node records
+###########################################################################
+class LazyNodeRecord(dict):
+    """
+    A DAG snapshot node record whose property lists stay compressed inside a
+    mapped binary workflow file until they are first requested.  The NAME,
+    TYPE, and UUID keys are always present.  Any access that needs the whole
+    record (iteration, comparison, copying) decodes it first.
+    """
+
+    def __init__(self, skeletonRecord, buffer, offset, length):
+        """
+        """
+        dict.__init__(self, skeletonRecord)
+        self._buffer = buffer
+        self._offset = offset
+        self._length = length
+        self._lock = threading.Lock()
+
+
+    def isLoaded(self):
+        """
+        Returns whether the property lists have been decoded.
+        """
+        return self._buffer is None
+
+
+    def rawBlock(self):
+        """
+        Return the compressed block this record decodes from, or None if the
+        record has already been decoded.
+        """
+        buffer = self._buffer
+        if buffer is None:
+            return None
+        return buffer[self._offset:self._offset+self._length]
+
+
+    def load(self):
+        """
+        Decode the property lists into the dictionary.  Safe to call from any
+        thread, and any number of times.
+        """
+        with self._lock:
+            if self._buffer is None:
+                return
+            block = json.loads(zlib.decompress(self._buffer[self._offset:self._offset+self._length]))
+            for key in LAZY_KEYS:
+                dict.__setitem__(self, key, block[key])
+            self._buffer = None
+
+
+    def __missing__(self, key):
+        if key in LAZY_KEYS and self._buffer is not None:
+            self.load()
+            return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+
+    def get(self, key, default=None):
+        if key in LAZY_KEYS:
+            self.load()
+        return dict.get(self, key, default)
+
+
+    def __contains__(self, key):
+        return key in LAZY_KEYS or dict.__contains__(self, key)
+
+
+    def __eq__(self, other):
+        self.load()
+        if isinstance(other, LazyNodeRecord):
+            other.load()
+        return dict.__eq__(self, other)
+
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+    def __deepcopy__(self, memo):
+        self.load()
+        return json.loads(json.dumps(dict(self)))
+
+
+    def __reduce__(self):
+        # Pickles as the plain dictionary, since the mapped file can't be
+        return (dict, (self.copy(),))
+
+
+    def __iter__(self):
+        self.load()
+        return dict.__iter__(self)
+
+
+    def __len__(self):
+        self.load()
+        return dict.__len__(self)
+
+
+    def __repr__(self):
+        self.load()
+        return dict.__repr__(self)
+
+
+    def keys(self):
+        self.load()
+        return dict.keys(self)
+
+
+    def values(self):
+        self.load()
+        return dict.values(self)
+
+
+    def items(self):
+        self.load()
+        return dict.items(self)
+
+
+    def iteritems(self):
+        self.load()
+        return dict.iteritems(self)
+
+
+    def copy(self):
+        self.load()
+        return dict(self)
+
+
+###########################################################################
+## Reading
+###########################################################################
+def isBinaryWorkflowFile(filename):
+    """
+    Returns whether the given file starts with the binary workflow magic.
+    """
+    with open(filename, 'rb') as fp:
+        return fp.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def read(filename):
+    """
+    Load a workflow file of either format off disk and return the full
+    snapshot dictionary it contains.
+    """
+    if isBinaryWorkflowFile(filename):
+        fullSnap = _readBinary(filename)
+    else:
+        with open(filename, 'rb') as fp:
+            fullSnap = json.loads(fp.read())
+    return _replayJournal(filename, fullSnap)
+
+
+def _readBinary(filename):
+    """
+    Map a binary workflow file and build its snapshot from the skeleton,
+    with a LazyNodeRecord standing in for every node.
+    """
+    with open(filename, 'rb') as fp:
+        buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    (magic, version, nodeCount, tableOffset, skeletonOffset, skeletonLength) = struct.unpack(HEADER_FORMAT, buffer[:HEADER_SIZE])
+    if magic != BINARY_MAGIC:
+        raise RuntimeError("File %s is not a binary workflow file." % filename)
+    if version > BINARY_VERSION:
+        raise RuntimeError("Binary workflow file %s has version %d, but only versions up to %d are supported." % (filename, version, BINARY_VERSION))
+
+    fullSnap = json.loads(zlib.decompress(buffer[skeletonOffset:skeletonOffset+skeletonLength]))
+    skeletonNodes = fullSnap["DAG"]["NODES"]
+    if len(skeletonNodes) != nodeCount:
+        raise RuntimeError("Binary workflow file %s is damaged (%d nodes listed, %d expected)." % (filename, len(skeletonNodes), nodeCount))
+
+    nodes = list()
+    for i in range(nodeCount):
+        entryOffset = tableOffset + i*TABLE_ENTRY_SIZE
+        (offset, length) = struct.unpack(TABLE_ENTRY_FORMAT, buffer[entryOffset:entryOffset+TABLE_ENTRY_SIZE])
+        nodes.append(LazyNodeRecord(skeletonNodes[i], buffer, offset, length))
+    fullSnap["DAG"]["NODES"] = nodes
+    return fullSnap
+
+
+###########################################################################
+## Writing
+###########################################################################
+def write(filename, fullSnap, binary=None):
+    """
+    Write a full snapshot dictionary to disk.  The binary container is used
+    if requested, or by default if the filename carries BINARY_EXTENSION.
+    The file is written next to its destination, flushed to the disk, and
+    renamed into place, so a crash or an interrupted save never leaves a
+    truncated file behind.  Safe to call from a worker thread as long as
+    the snapshot is not modified while it is written.
+    """
+    if binary is None:
+        binary = filename.lower().endswith(BINARY_EXTENSION)
+    if binary:
+        util.writeFileAtomically(filename, lambda fp: _writeBinary(fp, fullSnap))
+    else:
+        util.writeFileAtomically(filename, json.dumps(_loadedSnapshot(fullSnap), sort_keys=True, indent=4))
+
+    # The file is complete, so any journal that belonged to it is stale
+    if os.path.exists(journalFilename(filename)):
+        os.remove(journalFilename(filename))
+
+
+###########################################################################
+## Journal
+###########################################################################
+def journalFilename(filename):
+    """
+    Return the name of the journal belonging to a workflow file.
+    """
+    return filename + JOURNAL_SUFFIX
+
+
+def snapshotPatch(oldFullSnap, newFullSnap):
+    """
+    Return a patch dictionary that turns one full snapshot into the other
+    when given to applySnapshotPatch().  Its size is proportional to the
+    change: added and modified nodes are stored as whole records, removed
+    nodes by UUID, edges and metadata by key, and the (small) group and
+    variable lists only if they changed.
+    """
+    oldDag = oldFullSnap["DAG"]
+    newDag = newFullSnap["DAG"]
+    changes = util.dagSnapshotChanges(oldDag, newDag)
+    modifiedUUIDs = set(changes["NODES_MODIFIED"])
+    patch = {"NODES_REMOVED":[record["UUID"] for record in changes["NODES_REMOVED"]],
+             "NODES":[record.copy() for record in changes["NODES_ADDED"]],
+             "EDGES_ADDED":changes["EDGES_ADDED"],
+             "EDGES_REMOVED":changes["EDGES_REMOVED"],
+             "NODE_META":dict((k, v[1]) for (k, v) in changes["NODE_META"].items()),
+             "CONNECTION_META":dict((k, v[1]) for (k, v) in changes["CONNECTION_META"].items()),
+             "TOP":dict((k, v) for (k, v) in newFullSnap.items() if k not in ("DAG", "JOURNAL_ID"))}
+    if modifiedUUIDs:
+        patch["NODES"] += [record.copy() for record in newDag["NODES"] if record["UUID"] in modifiedUUIDs]
+    if changes["GROUPS_ADDED"] or changes["GROUPS_REMOVED"] or changes["GROUPS_MODIFIED"]:
+        patch["GROUPS"] = newDag["GROUPS"]
+    if changes["VARIABLE_SUBSTITIONS"]:
+        patch["VARIABLE_SUBSTITIONS"] = newDag["VARIABLE_SUBSTITIONS"]
+    return patch
+
+
+def applySnapshotPatch(fullSnap, patch):
+    """
+    Return a new full snapshot with the given patch (see snapshotPatch())
+    applied.  The snapshot passed in is left untouched.
+    """
+    dagSnap = dict(fullSnap["DAG"])
+
+    removed = set(patch["NODES_REMOVED"])
+    replacements = dict((record["UUID"], record) for record in patch["NODES"])
+    nodes = list()
+    for record in dagSnap["NODES"]:
+        if record["UUID"] in removed:
+            continue
+        nodes.append(replacements.pop(record["UUID"], record))
+    nodes += [record for record in patch["NODES"] if record["UUID"] in replacements]
+    dagSnap["NODES"] = nodes
+
+    edges = set((e["FROM"], e["TO"]) for e in dagSnap["EDGES"])
+    edges -= set(tuple(e) for e in patch["EDGES_REMOVED"])
+    edges |= set(tuple(e) for e in patch["EDGES_ADDED"])
+    dagSnap["EDGES"] = [{"FROM":e[0], "TO":e[1]} for e in sorted(edges)]
+
+    for key in ("NODE_META", "CONNECTION_META"):
+        meta = dict(dagSnap.get(key) or dict())
+        for (metaKey, value) in patch[key].items():
+            if value is None:
+                meta.pop(metaKey, None)
+            else:
+                meta[metaKey] = value
+        dagSnap[key] = meta
+
+    for key in ("GROUPS", "VARIABLE_SUBSTITIONS"):
+        if key in patch:
+            dagSnap[key] = patch[key]
+
+    patchedSnap = dict((k, v) for (k, v) in fullSnap.items() if k == "JOURNAL_ID")
+    patchedSnap.update(patch["TOP"])
+    patchedSnap["DAG"] = dagSnap
+    return patchedSnap
+
+
+def _readJournalId(fp):
+    """
+    Read a journal header from an open file, returning the journal id or 
+    None if the header is not valid.
+    """
+    header = fp.read(JOURNAL_HEADER_SIZE)
+    if len(header) != JOURNAL_HEADER_SIZE:
+        return None
+    (magic, version, journalId) = struct.unpack(JOURNAL_HEADER_FORMAT, header)
+    if magic != JOURNAL_MAGIC or version > JOURNAL_VERSION:
+        return None
+    return journalId
+
+
+def _replayJournal(filename, fullSnap):
+    """
+    Apply the patches in a workflow's journal to its freshly loaded base 
+    snapshot.  A journal that belongs to a different base is ignored.  A 
+    damaged tail (from a crash mid-append) is cut off so later appends 
+    follow the last good entry.
+    """
+    journalName = journalFilename(filename)
+    if "JOURNAL_ID" not in fullSnap or not os.path.exists(journalName):
+        return fullSnap
+    with open(journalName, 'r+b') as fp:
+        if _readJournalId(fp) != fullSnap["JOURNAL_ID"]:
+            return fullSnap
+        goodLength = fp.tell()
+        while True:
+            entryHeader = fp.read(JOURNAL_ENTRY_SIZE)
+            if not entryHeader:
+                break
+            if len(entryHeader) != JOURNAL_ENTRY_SIZE:
+                print "Journal %s has an incomplete entry header.  Ignoring the rest." % journalName
+                break
+            (length, crc) = struct.unpack(JOURNAL_ENTRY_FORMAT, entryHeader)
+            payload = fp.read(length)
+            if len(payload) != length or zlib.crc32(payload) & 0xffffffff != crc:
+                print "Journal %s has a damaged entry.  Ignoring the rest." % journalName
+                break
+            fullSnap = applySnapshotPatch(fullSnap, json.loads(zlib.decompress(payload)))
+            goodLength = fp.tell()
+        fp.truncate(goodLength)
+    return fullSnap
+
+
+def appendJournal(filename, journalId, patch):
+    """
+    Append a patch to a workflow's journal, flushed to the disk before 
+    returning.  A missing journal, or one that belongs to a different base,
+    is started afresh.
+    """
+    journalName = journalFilename(filename)
+    payload = zlib.compress(json.dumps(patch, separators=(',', ':')))
+    entry = struct.pack(JOURNAL_ENTRY_FORMAT, len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+    mode = 'r+b' if os.path.exists(journalName) else 'w+b'
+    with open(journalName, mode) as fp:
+        if _readJournalId(fp) != journalId:
+            fp.seek(0)
+            fp.truncate()
+            fp.write(struct.pack(JOURNAL_HEADER_FORMAT, JOURNAL_MAGIC, JOURNAL_VERSION, str(journalId)))
+        fp.seek(0, os.SEEK_END)
+        fp.write(entry)
+        fp.flush()
+        os.fsync(fp.fileno())
+
+
+def writeJournaled(filename, fullSnap, savedSnap):
+    """
+    Save a full snapshot incrementally.  If savedSnap is the snapshot last
+    saved to (or loaded from) this filename, only the patch between the two
+    is appended to the journal.  Otherwise, or once the journal has grown 
+    past JOURNAL_COMPACTION_RATIO of the base file, the journal is compacted
+    by writing a complete base with a new JOURNAL_ID.  The JOURNAL_ID of the
+    given snapshot is set to match what is on disk, so it can serve as the
+    savedSnap of the next save.
+    """
+    journalName = journalFilename(filename)
+    compact = (not savedSnap or "JOURNAL_ID" not in savedSnap or not os.path.exists(filename))
+    if not compact and os.path.exists(journalName):
+        compact = os.path.getsize(journalName) > os.path.getsize(filename) * JOURNAL_COMPACTION_RATIO
+    if compact:
+        fullSnap["JOURNAL_ID"] = uuid.uuid4().hex
+        write(filename, fullSnap)
+        return
+    fullSnap["JOURNAL_ID"] = savedSnap["JOURNAL_ID"]
+    appendJournal(filename, fullSnap["JOURNAL_ID"], snapshotPatch(savedSnap, fullSnap))
+
+
+def _loadedSnapshot(fullSnap):
+    """
+    Return the full snapshot with every lazy node record replaced by a plain
+    dictionary, as needed by the JSON encoder.
+    """
+    dagSnap = dict(fullSnap["DAG"])
+    dagSnap["NODES"] = [record.copy() for record in dagSnap["NODES"]]
+    loadedSnap = dict(fullSnap)
+    loadedSnap["DAG"] = dagSnap
+    return loadedSnap
+
+
+def _writeBinary(fp, fullSnap):
+    """
+    Write the binary container to an open file.  Lazy node records that
+    were never decoded have their compressed blocks copied across as-is.
+    """
+    nodes = fullSnap["DAG"]["NODES"]
+    fp.write("\0" * HEADER_SIZE)
+
+    offset = HEADER_SIZE
+    table = list()
+    skeletonNodes = list()
+    for record in nodes:
+        block = record.rawBlock() if isinstance(record, LazyNodeRecord) else None
+        if block is None:
+            block = zlib.compress(json.dumps(dict((key, record[key]) for key in LAZY_KEYS), separators=(',', ':')))
+        fp.write(block)
+        table.append(struct.pack(TABLE_ENTRY_FORMAT, offset, len(block)))
+        offset += len(block)
+        skeletonNodes.append({"NAME":record["NAME"], "TYPE":record["TYPE"], "UUID":record["UUID"]})
+
+    tableOffset = offset
+    fp.write("".join(table))
+    offset += len(table) * TABLE_ENTRY_SIZE
+
+    skeletonSnap = dict(fullSnap)
+    skeletonSnap["DAG"] = dict(fullSnap["DAG"])
+    skeletonSnap["DAG"]["NODES"] = skeletonNodes
+    skeleton = zlib.compress(json.dumps(skeletonSnap, sort_keys=True, separators=(',', ':')))
+    fp.write(skeleton)
+
+    fp.seek(0)
+    fp.write(struct.pack(HEADER_FORMAT, BINARY_MAGIC, BINARY_VERSION, len(nodes), tableOffset, offset, len(skeleton)))